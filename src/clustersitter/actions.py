@@ -1,289 +1,494 @@
-
+import heapq
 import logging
-from threading import Thread
+import time
+from collections import deque
+from threading import Condition, Lock, Thread
 
-try:
-    from Queue import Empty, Full, Queue
-    (Empty, Full, Queue)  # pyflakes fix
-except ImportError:
-    from queue import Empty, Full, Queue
+from actiontrace import ActionTracer
 
 logger = logging.getLogger(__name__)
 
+# Action priorities, lower runs first. Actions with a priority of
+# PRIORITY_DEPLOY or above are background work which may not use the workers
+# reserved for more urgent actions.
+PRIORITY_REPAIR = 0
+PRIORITY_TASK = 1
+PRIORITY_DEPLOY = 2
+PRIORITY_CLEANUP = 3
 
-class ClusterActionRunner(Thread):
-    """
-    Run a cluster action in a thread.
-    """
 
-    def __init__(self, action):
-        """Initialize the runner."""
-        self.thread = None
-        self.action = action
-
-    def is_running(self):
-        """
-        Check if the queue consumer is running.
-
-        @return True if the consumer is running or False.
-        """
-        return self.thread is not None and self.thread.is_alive()
+class KeyedWorkerPool(object):
+    """
+    Run actions on a fixed number of worker threads. Each action is queued
+    under a key. Actions with the same key are run one at a time in the order
+    they were queued, on whichever worker is free. Actions with different keys
+    run concurrently.
 
-    def start(self):
-        """
-        Start the action thread.
+    When workers are free the most urgent action is run first, see the
+    PRIORITY_* constants. Urgency is judged by the next action of each key.
+    Some workers are reserved for urgent actions so that background actions
+    can not tie up every worker.
 
-        @return True if the thread was started or False if it was already
-            running.
-        """
-        if self.is_running():
-            return False
+    Workers are started on first use and run until the process exits.
+    """
 
-        def run():
+    def __init__(self, size, notify=None, reserved=None, started=None):
+        """
+        Initialize the pool.
+
+        @param size The number of worker threads.
+        @param notify A callable which is passed each action and its outcome
+            once it has run, see ActionTracer for the outcomes. Optional.
+        @param reserved The number of workers reserved for actions more urgent
+            than PRIORITY_DEPLOY. Defaults to a quarter of the workers.
+        @param started A callable which is passed each action just before it
+            runs. Optional.
+        """
+        self.size = max(size, 1)
+        self.notify = notify
+        self.started = started
+        if reserved is None:
+            reserved = self.size / 4
+        self.background_limit = max(self.size - reserved, 1)
+        self.condition = Condition()
+        self.workers = []
+
+        # Queued actions by key. A key is present while it has actions queued
+        # or running. Keys with an action that can be run now are kept in the
+        # ready heap as (priority, sequence, key) entries. Entries whose
+        # sequence does not match ready_entries are stale and skipped.
+        self.queues = {}
+        self.ready = []
+        self.ready_entries = {}
+        self.sequence = 0
+        self.running = {}
+        self.background_running = 0
+
+        # Metrics.
+        self.start_time = time.time()
+        self.busy_time = 0.0
+        self.completed = 0
+        self.failed = 0
+        self.queued = 0
+        self.max_queued = 0
+
+    def _start_workers(self):
+        """Start the worker threads if they are not running."""
+        while len(self.workers) < self.size:
+            worker = Thread(
+                target=self._work,
+                name="ActionWorker-%s" % len(self.workers))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def _get_priority(self, action):
+        """Get the priority of an action."""
+        return getattr(action, 'priority', PRIORITY_TASK)
+
+    def _make_ready(self, key):
+        """Mark the next action of a key as ready to run."""
+        self.sequence += 1
+        self.ready_entries[key] = self.sequence
+        priority = self._get_priority(self.queues[key][0])
+        heapq.heappush(self.ready, (priority, self.sequence, key))
+
+    def _peek(self):
+        """
+        Get the most urgent ready entry without removing it.
+
+        @return A (priority, sequence, key) entry or None if nothing is
+            ready.
+        """
+        while self.ready:
+            priority, sequence, key = self.ready[0]
+            if self.ready_entries.get(key) == sequence:
+                return self.ready[0]
+            heapq.heappop(self.ready)
+        return None
+
+    def _can_run(self, entry):
+        """Check if a ready entry can be run now."""
+        return (
+            entry is not None and
+            (entry[0] < PRIORITY_DEPLOY or
+             self.background_running < self.background_limit))
+
+    def _next(self):
+        """
+        Wait for the next action to run.
+
+        @return A two-tuple of the key and action.
+        """
+        with self.condition:
+            while not self._can_run(self._peek()):
+                self.condition.wait()
+            priority, sequence, key = heapq.heappop(self.ready)
+            del self.ready_entries[key]
+            action = self.queues[key].popleft()
+            self.queued -= 1
+            self.running[key] = action
+            if priority >= PRIORITY_DEPLOY:
+                self.background_running += 1
+            return key, action
+
+    def _done(self, key, action, elapsed, success):
+        """
+        Record a finished action and make the next action for its key ready.
+        """
+        with self.condition:
+            del self.running[key]
+            if self._get_priority(action) >= PRIORITY_DEPLOY:
+                self.background_running -= 1
+            if self.queues[key]:
+                self._make_ready(key)
+            else:
+                del self.queues[key]
+            self.busy_time += elapsed
+            self.completed += 1
+            if not success:
+                self.failed += 1
+            self.condition.notify_all()
+
+    def _work(self):
+        """Run queued actions forever."""
+        while True:
+            key, action = self._next()
+            start = time.time()
+            outcome = ActionTracer.OUTCOME_ERROR
             try:
-                logger.info("action '%s' running" % self.action)
-                self.action.run()
-                logger.info("action '%s' complete" % self.action)
+                if self.started:
+                    self.started(action)
+                logger.info("action '%s' running" % action)
+                if action.run() is False:
+                    outcome = ActionTracer.OUTCOME_FAILED
+                    logger.info("action '%s' failed" % action)
+                else:
+                    outcome = ActionTracer.OUTCOME_SUCCEEDED
+                    logger.info("action '%s' complete" % action)
             except:
                 import traceback
-                logger.error("action '%s' failed" % self.action)
+                logger.error("action '%s' failed" % action)
                 logger.error(traceback.format_exc())
             finally:
-                self.queue.task_done()
+                try:
+                    if self.notify:
+                        self.notify(action, outcome)
+                finally:
+                    self._done(
+                        key, action, time.time() - start,
+                        outcome == ActionTracer.OUTCOME_SUCCEEDED)
 
-        self.thread = Thread(target=run, name=self.action)
-        self.thread.start()
-        return True
+    def add(self, key, action):
+        """
+        Queue an action.
+
+        @param key The key to serialize the action on.
+        @param action The action to queue.
+        """
+        with self.condition:
+            queue = self.queues.get(key)
+            if queue is None:
+                queue = self.queues[key] = deque()
+            queue.append(action)
+            if key not in self.running and key not in self.ready_entries:
+                self._make_ready(key)
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+            self._start_workers()
+            self.condition.notify()
+
+    def remove(self, key, action):
+        """
+        Remove a queued action which has not started running.
+
+        @param key The key the action was queued under.
+        @param action The action to remove.
+        @return True if the action was removed or False if it is not queued.
+        """
+        with self.condition:
+            queue = self.queues.get(key)
+            if not queue or action not in queue:
+                return False
+            queue.remove(action)
+            self.queued -= 1
+            if key not in self.running:
+                # The next action of the key may have changed.
+                del self.ready_entries[key]
+                if queue:
+                    self._make_ready(key)
+                else:
+                    del self.queues[key]
+            self.condition.notify_all()
+            return True
 
     def stop(self):
         """
-        Signal the action to stop if supported. A method called stop() is
-        checked for on the action and should return True on success. This
+        Drop all queued actions and signal running actions to stop if
+        supported. A method called stop() is checked for on the action. This
         method does not block.
 
-        @return True if the action was signaled to stop or False if the thread
-            was not running or the action does not support stopping.
-        """
-        if self.is_running() and hasattr(self.action, 'stop'):
-            return self.action.stop()
-        return False
+        @return A list of the actions that were dropped.
+        """
+        dropped = []
+        with self.condition:
+            for key, queue in self.queues.items():
+                dropped.extend(queue)
+                queue.clear()
+                if key not in self.running:
+                    del self.queues[key]
+            self.ready = []
+            self.ready_entries = {}
+            self.queued = 0
+            running = self.running.values()
+            self.condition.notify_all()
+
+        for action in running:
+            stop = getattr(action, 'stop', None)
+            if callable(stop):
+                stop()
+        return dropped
 
     def join(self, timeout=None):
         """
-        Block until the thread completes or the given timeout expires.
+        Block until all queued actions have run or the given timeout expires.
 
-        @param timeout The number of seconds to wait for the thread to
-            complete. Defaults to infinite.
-        @return True if the thread has stopped or False if it is still running.
-            If a timeout is not specified it will always be True.
+        @param timeout The number of seconds to wait. Defaults to infinite.
+        @return True if all actions have run or False if some are still queued
+            or running.
         """
-        if self.thread is not None:
-            self.thread.join(timeout)
-        return not self.is_running()
+        end_time = None
+        if timeout is not None:
+            end_time = time.time() + timeout
+        with self.condition:
+            while self.queues:
+                if end_time is None:
+                    self.condition.wait()
+                else:
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+            return True
+
+    def get_stats(self):
+        """
+        Get the queue depth and worker utilization of the pool.
+
+        @return A dictionary of statistics. Utilization is the fraction of
+            worker time spent running actions since the pool was created.
+        """
+        with self.condition:
+            uptime = max(time.time() - self.start_time, 0.001)
+            return {
+                'workers': self.size,
+                'busy': len(self.running),
+                'background_busy': self.background_running,
+                'queued': self.queued,
+                'queued_keys': len(self.queues) - len(self.running),
+                'max_queued': self.max_queued,
+                'completed': self.completed,
+                'failed': self.failed,
+                'utilization': self.busy_time / (self.size * uptime),
+            }
 
 
-class MachineActionQueue(object):
+class ClusterActionManager(object):
     """
-    Queue for running machine actions. Runs queues actions in a single thread
-    until the queue empties.
+    Manage cluster actions. Actions are run by a fixed size pool of worker
+    threads. Actions on the same machine are run one at a time in the order
+    they were added. Other actions are run as soon as a worker is free.
+
+    Actions with the same key, see ClusterAction.get_key(), are only run once
+    at a time. Adding an action while another with the same key is pending,
+    queued or running does nothing, as does adding it within grace_period
+    seconds of the last one completing. Task actions supersede queued task
+    actions of a different type on the same task and machine, so that only
+    the most recent change to a task is made.
+
+    Every action is traced from when it is added until it finishes, see
+    ActionTracer.
     """
 
-    timeout = 30
-
-    def __init__(self, machine):
-        """
-        Initialize the queue.
-
-        @param machine The machine this queue is operating on.
-        """
-        self.machine = machine
-        self.name = "ActionQueue(%s)" % machine
-        self.queue = Queue()
-        self.stop = False
-        self.thread = None
-
-    def add(self, action):
+    def __init__(self, notify=None, workers=32, grace_period=10):
         """
-        Queue an action.
+        Initialize the manager.
 
-        @param action The action to queue.
-        @return True on success or False if the action's machine does not match
-        the queue's machine or if the queue add times out.
+        @param notify A callable which is passed each action once it has run.
+            Optional.
+        @param workers The number of worker threads. Defaults to 32.
+        @param grace_period The number of seconds after an action completes
+            during which it is not run again. Defaults to 10.
         """
-        if self.machine == getattr(action, 'machine', None):
-            try:
-                self.queue.put(action, True, self.timeout)
-                return True
-            except Full:
-                logger.error("%s: timed out while queuing" % action)
-        return False
-
-    def is_empty(self):
-        """
-        Check if the queue is empty.
+        self.notify = notify
+        self.grace_period = grace_period
+        self.pending = []
+        self.tracer = ActionTracer()
+        self.pool = KeyedWorkerPool(
+            workers, self._finished, started=self.tracer.started)
+        self.lock = Lock()
+
+        # Actions which are pending, queued or running by key, and by target
+        # for task actions.
+        self.active = {}
+        self.targets = {}
+
+        # Completion times of recently finished actions by key.
+        self.recent = {}
+
+        self.duplicates = 0
+        self.superseded = 0
+
+    def _get_pool_key(self, action):
+        """Get the key to serialize an action on in the worker pool."""
+        key = getattr(action, 'machine', None)
+        if key is None:
+            key = action
+        return key
+
+    def _forget(self, action):
+        """Stop tracking an action. The lock must be held."""
+        key = action.get_key()
+        if self.active.get(key) is action:
+            del self.active[key]
+        target = action.get_target()
+        actions = self.targets.get(target)
+        if actions and action in actions:
+            actions.remove(action)
+            if not actions:
+                del self.targets[target]
+
+    def _cancel(self, action):
+        """
+        Cancel an action which has not started running. The lock must be
+        held.
+
+        @return True if the action was cancelled or False if it is running or
+            already done.
+        """
+        if action in self.pending:
+            self.pending.remove(action)
+        elif not self.pool.remove(self._get_pool_key(action), action):
+            return False
+        self._forget(action)
+        return True
 
-        @return True if the queue is empty or False.
-        """
-        return self.queue.empty()
+    def _finished(self, action, outcome):
+        """Handle a completed action."""
+        self.tracer.finished(action, outcome)
+        with self.lock:
+            self._forget(action)
+            key = action.get_key()
+            if key is not None:
+                self.recent[key] = time.time()
+        if self.notify:
+            self.notify(action)
 
-    def is_running(self):
+    def add(self, action):
         """
-        Check if the queue consumer is running.
+        Add an action to the queue. The action is not actually queued until
+        process() is called.
 
-        @return True if the consumer is running or False.
-        """
-        return self.thread is not None and self.thread.is_alive()
+        @param action The action to add.
+        @return True if the action was added or False if it is a duplicate of
+            an active or recently completed action.
+        """
+        key = action.get_key()
+        if key is None:
+            self.tracer.enqueued(action)
+            self.pending.append(action)
+            return True
+
+        with self.lock:
+            completed = self.recent.get(key)
+            if key in self.active or (
+                    completed is not None and
+                    time.time() - completed < self.grace_period):
+                logger.debug("dropping duplicate action '%s'" % action)
+                self.duplicates += 1
+                return False
+
+            target = action.get_target()
+            if target is not None:
+                for other in list(self.targets.get(target, ())):
+                    if self._cancel(other):
+                        logger.info(
+                            "action '%s' superseded by '%s'" %
+                            (other, action))
+                        self.superseded += 1
+                        self.tracer.finished(
+                            other, ActionTracer.OUTCOME_SUPERSEDED)
+                self.targets.setdefault(target, []).append(action)
+
+            self.tracer.enqueued(action)
+            self.active[key] = action
+            self.pending.append(action)
+        return True
 
-    def start(self):
+    def process(self):
         """
-        Start the queue consumer thread. The thread will only be run if the
-        queue is non-empty. The thread will terminate once the queue is empty.
-
-        @return True if the consumer thread was started or False if the thread
-            is already running or the queue is empty.
+        Process pending actions. If the action is related to a machine it is
+        queued behind the other actions for that machine. Otherwise the action
+        is queued on its own.
         """
-        if self.is_running() or self.is_empty():
-            return False
+        with self.lock:
+            pending = self.pending
+            self.pending = []
 
-        def run():
-            logger.info("action queue consumer started")
-            self.stop = False
-            while not self.queue.empty() and not self.stop:
-                try:
-                    action = self.queue.get(True, self.timeout)
-                except Empty:
-                    logger.warn("queue timed out, retrying")
-                    continue
+            now = time.time()
+            for key, completed in self.recent.items():
+                if now - completed >= self.grace_period:
+                    del self.recent[key]
+            self.tracer.prune()
 
-                try:
-                    logger.info("action '%s' running" % action)
-                    action.run()
-                    logger.info("action '%s' complete" % action)
-                except:
-                    import traceback
-                    logger.error("action '%s' failed" % action)
-                    logger.error(traceback.format_exc())
-                finally:
-                    self.queue.task_done()
-            logger.info("action queue thread stopped")
-
-        self.thread = Thread(target=run, name=str(self))
-        self.thread.start()
-        return True
+            for action in pending:
+                self.pool.add(self._get_pool_key(action), action)
 
     def stop(self):
         """
-        Signal the queue consumer thread to stop. This method does not block.
-
-        @return True if the consumer thread was signalled to stop or False if
-            the thread is not running.
+        Drop pending and queued actions and signal running actions to stop.
         """
-        if not self.is_running():
-            return False
-        self.stop = True
-        return True
+        with self.lock:
+            dropped = self.pending + self.pool.stop()
+            self.pending = []
+            for action in dropped:
+                self._forget(action)
+                self.tracer.finished(action, ActionTracer.OUTCOME_DROPPED)
+        if dropped:
+            logger.info("dropped %s actions" % len(dropped))
 
     def join(self, timeout=None):
         """
-        Block until the consumer thread completes or the given timeout expires.
-
-        @param timeout The number of seconds to wait for the thread to
-            complete. Defaults to infinite.
-        @return True if the thread has stopped or False if it is still running.
-            If a timeout is not specified it will always be True.
-        """
-        if self.thread is not None:
-            self.thread.join(timeout)
-        return not self.is_running()
-
-    def __str__(self):
-        """Return the name of the action queue."""
-        return self.name
+        Wait for all queued actions to complete.
 
-    def __repr__(self):
-        """Return the name of the action queue."""
-        return self.name
-
-
-class ClusterActionManager(object):
-    """
-    Manage cluster actions. Each machine has a dedicated queue for actions
-    which need to be performed. Each queue has a single consumer thread.
-    Threads are cleaned up when their associated queues empty.
-    """
-
-    def __init__(self):
-        """Initialize the manager."""
-        self.pending = []
-        self.queues = {}
-        self.runners = []
-
-    def add(self, action):
-        """
-        Add an action to the queue. The action is not actually queued until
-        process() is called.
+        @param timeout The number of seconds to block waiting. Defaults to
+            infinite.
+        @return True if all actions have completed or False if some are still
+            queued or running.
         """
-        self.pending.append(action)
+        return self.pool.join(timeout)
 
-    def process(self):
+    def get_stats(self):
         """
-        Process pending actions. If the action is related to a machine it is
-        queued in the associated machine queue. Otherwise the action is run
-        immediately. This method also cleans up completed actions and empty
-        machine queues.
-        """
-        while len(self.pending):
-            action = self.pending.pop(0)
-            if hasattr(action, 'machine'):
-                queue = self.queues.get(action.machine)
-                if not queue:
-                    queue = MachineActionQueue(action.machine)
-                    self.queues[action.machine] = queue
-                if not queue.add(action):
-                    logger.error("%s: failed to queue action" % action)
-                if not queue.is_running():
-                    queue.start()
-            else:
-                runner = ClusterActionRunner(action)
-                result = runner.start()
-                if result:
-                    self.runners.append(runner)
-                else:
-                    logger.error("%: failed to start action" % action)
-
-        for name, queue in dict(self.queues).iteritems():
-            if not queue.is_running() and queue.is_empty():
-                del self.queues[name]
+        Get statistics on the action queue and workers.
 
-        for runner in list(self.runners):
-            if not runner.is_running():
-                self.runners.remove(runner)
-
-    def stop(self):
+        @return A dictionary of statistics, see KeyedWorkerPool.get_stats().
+            Also includes the number of pending actions and the number of
+            actions dropped as duplicates or superseded.
         """
-        Signal all actions to stop.
-        """
-        for queue in self.queues.values():
-            queue.stop()
-        for runner in self.runners:
-            runner.stop()
+        stats = self.pool.get_stats()
+        stats['pending'] = len(self.pending)
+        stats['duplicates'] = self.duplicates
+        stats['superseded'] = self.superseded
+        return stats
 
-    def join(self, timeout=None):
+    def get_trace(self):
         """
-        Wait for all thread queues to complete.
+        Get the action latency statistics and recently finished actions.
 
-        @param timeout The number of seconds to block waiting for a queue
-            thread to join. This will be applied to each queue thread. Defaults
-            to infinite.
-        @return True if all threads are stopped or False if some threads
-            continue to run.
+        @return See ActionTracer.get_stats().
         """
-        running = True
-        for queue in self.queues.values():
-            running = running and queue.join(timeout)
-        for runner in self.runners:
-            running = running and runner.join(timeout)
-        return running
+        return self.tracer.get_stats()
 
 
 class ClusterAction(object):
@@ -292,6 +497,8 @@ class ClusterAction(object):
     method.
     """
 
+    priority = PRIORITY_TASK
+
     def __init__(self, sitter):
         """
         Initialize the action.
@@ -302,8 +509,30 @@ class ClusterAction(object):
         self.sitter = sitter
         self.state = sitter.state
 
+    def get_key(self):
+        """
+        Get the key identifying what the action does. Actions with the same
+        key are not run concurrently or repeated within a grace period.
+
+        @return A hashable key or None if the action is never deduplicated.
+        """
+        return None
+
+    def get_target(self):
+        """
+        Get the target of the action. Queued actions on the same target are
+        superseded by newer actions.
+
+        @return A hashable target or None if the action is never superseded.
+        """
+        return None
+
     def run(self):
-        """Run the action."""
+        """
+        Run the action.
+
+        @return False if the action failed. Any other value is success.
+        """
 
     def __str__(self):
         """Return the name of the action."""
@@ -333,6 +562,10 @@ class MachineAction(ClusterAction):
         self.name = "%s(%s)" % (self.__class__.__name__, machine)
         self.zone = zone
 
+    def get_key(self):
+        """Machine actions are identified by their type and machine."""
+        return (self.__class__.__name__, self.zone, self.machine, None)
+
 
 class TaskAction(MachineAction):
     """
@@ -353,6 +586,14 @@ class TaskAction(MachineAction):
         self.name = "%s(%s, %s)" % (self.__class__.__name__, machine, task)
         self.task = task
 
+    def get_key(self):
+        """Task actions are identified by their type, machine and task."""
+        return (self.__class__.__name__, self.zone, self.machine, self.task)
+
+    def get_target(self):
+        """Task actions supersede each other on the same machine and task."""
+        return (self.machine, self.task)
+
 
 class StartTaskAction(TaskAction):
     """Start a task."""
@@ -362,8 +603,10 @@ class StartTaskAction(TaskAction):
         job = self.state.get_job(self.task)
         if not job:
             logger.error("%s: job does not exist" % self)
+            return False
         elif not self.machine.start_task(job):
             logger.error("%s: failed to start task" % self)
+            return False
 
 
 class RestartTaskAction(TaskAction):
@@ -374,8 +617,10 @@ class RestartTaskAction(TaskAction):
         job = self.state.get_job(self.task)
         if not job:
             logger.error("%s: job does not exist" % self)
+            return False
         elif not self.machine.restart_task(job):
             logger.error("%s: failed to restart task" % self)
+            return False
 
 
 class StopTaskAction(TaskAction):
@@ -386,23 +631,51 @@ class StopTaskAction(TaskAction):
         job = self.state.get_job(self.task)
         if not job:
             logger.error("%s: job does not exist" % self)
+            return False
         elif not self.machine.stop_task(job):
             logger.error("%s: failed to stop task" % self)
+            return False
 
 
 class AddTaskAction(TaskAction):
     """Add a task to a machine."""
 
+    priority = PRIORITY_DEPLOY
+
+    def __init__(self, sitter, zone, machine, task, revision=None):
+        """
+        Initialize the action.
+
+        @param sitter The cluster sitter object.
+        @param zone The zone the job is being deployed to.
+        @param machine The machine to deploy the task to.
+        @param task The task to deploy.
+        @param revision The revision of the job to deploy, see
+            ClusterState.add_job(). Optional.
+        """
+        super(AddTaskAction, self).__init__(sitter, zone, machine, task)
+        self.revision = revision
+
+    def get_key(self):
+        """
+        Adds are also identified by the job revision, so that a newer
+        revision of the job is not dropped as a duplicate of an older one.
+        """
+        return super(AddTaskAction, self).get_key() + (self.revision, )
+
     def run(self):
         """Run the action."""
         job = self.state.get_job(self.task)
         if not job:
             logger.error("%s: job does not exist" % self)
+            return False
         elif not job.deploy(self.zone, self.machine):
             logger.error("%s: failed to deploy task" % self)
+            return False
         elif not self.state.start_task(self.machine, self.task):
             logger.error(
                 "%s: failed to start task after deploying" % self)
+            return False
 
 
 class RemoveTaskAction(TaskAction):
@@ -413,41 +686,56 @@ class RemoveTaskAction(TaskAction):
         job = self.state.get_job(self.task)
         if not job:
             logger.error("%s: job does not exist" % self)
+            return False
         elif not self.machine.stop_task(job):
             logger.error("%s: failed to remove task" % self)
+            return False
 
 
 class DeployMachineAction(ClusterAction):
-    """Deploy a master job to a new machine."""
+    """
+    Deploy a master job to a batch of new machines. The machines are
+    requested from the provider together rather than one action per machine.
+    """
 
-    def __init__(self, sitter, zone, job):
+    priority = PRIORITY_DEPLOY
+
+    def __init__(self, sitter, zone, job, count=1):
         """
         Initialize the action.
 
         @param sitter The cluster sitter object.
         @param zone The zone to deploy the tasks to.
         @param job The job to deploy.
+        @param count The number of new machines to deploy to. Defaults to 1.
         """
         super(DeployMachineAction, self).__init__(sitter)
         self.job = job
-        self.name = "%s(%s, %s)" % (
-            self.__class__.__name__, zone, job.name)
+        self.count = count
+        self.name = "%s(%s, %s, %s)" % (
+            self.__class__.__name__, zone, job.name, count)
         self.stop = False
         self.zone = zone
 
     def run(self):
         """Run the action."""
-        if not self.job.deploy(self.zone):
+        machines = self.job.deploy_new(self.zone, self.count)
+        if len(machines) < self.count:
             logger.error(
-                "%s: failed to deploy new machine" % self)
-            return
-        # Take our new machine out of Deploying mode.
-        self.state.update_machine(self.machine, self.state.Active)
+                "%s: deployed %s of %s new machines" %
+                (self, len(machines), self.count))
+        # Take our new machines out of Deploying mode and hand them the
+        # tasks they were deployed for.
+        self.state.complete_deployment(
+            self.zone, self.job.name, machines, self.count)
+        return len(machines) == self.count
 
 
 class RedeployMachineAction(MachineAction):
     """Redeploy an unreachable machine."""
 
+    priority = PRIORITY_REPAIR
+
     def __init__(self, sitter, zone, machine, job):
         """
         Redeploy a machinesitter job to a machine.
@@ -473,11 +761,14 @@ class RedeployMachineAction(MachineAction):
                 self)
             self.state.detach_machine(self.machine)
             self.sitter.decomission_machine(self.machine)
+            return False
 
 
 class DecomissionMachineAction(MachineAction):
     """Decomission an existing machine."""
 
+    priority = PRIORITY_CLEANUP
+
     def run(self):
         """Run the action."""
         self.sitter.decomission_machine(self.machine)
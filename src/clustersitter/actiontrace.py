@@ -0,0 +1,163 @@
+"""
+Lifecycle tracing and latency statistics for cluster actions.
+"""
+
+import logging
+import time
+from collections import deque
+from threading import Lock
+
+from calcstats import RollingHistogram
+
+logger = logging.getLogger(__name__)
+
+
+class ActionTracer(object):
+    """
+    Trace the lifecycle of cluster actions. Each action is given a trace
+    dictionary, stored on the action as action.trace:
+
+        {
+            'enqueued': unix_time,
+            'started': unix_time or None,
+            'finished': unix_time or None,
+            'outcome': outcome or None,
+            'retries': retry_count,
+        }
+
+    The outcome is one of the OUTCOME_* constants. The retry count is the
+    number of times an action with the same key ran within retry_window
+    seconds before this one was added.
+
+    Queue wait and run times are kept in a histogram per action type and the
+    most recently finished actions are kept in a ring buffer.
+    """
+
+    OUTCOME_SUCCEEDED = 'succeeded'
+    OUTCOME_FAILED = 'failed'
+    OUTCOME_ERROR = 'error'
+    OUTCOME_SUPERSEDED = 'superseded'
+    OUTCOME_DROPPED = 'dropped'
+
+    def __init__(self, history=200, samples=1000, retry_window=600):
+        """
+        Initialize the tracer.
+
+        @param history The number of finished actions to keep.
+        @param samples The number of latency samples to keep per action type.
+        @param retry_window The number of seconds a previous run of an action
+            counts towards its retries.
+        """
+        self.samples = samples
+        self.retry_window = retry_window
+        self.recent = deque(maxlen=history)
+        self.types = {}
+        self.lock = Lock()
+
+        # The retry count and finish time of the last run by action key.
+        self.attempts = {}
+
+    def _get_type(self, name):
+        """Get the statistics for an action type. The lock must be held."""
+        stats = self.types.get(name)
+        if stats is None:
+            stats = self.types[name] = {
+                'wait': RollingHistogram(self.samples),
+                'run': RollingHistogram(self.samples),
+                'outcomes': {},
+            }
+        return stats
+
+    def enqueued(self, action):
+        """
+        Start tracing an action.
+
+        @param action The action which was added.
+        """
+        now = time.time()
+        retries = 0
+        key = action.get_key()
+        with self.lock:
+            attempt = self.attempts.get(key)
+            if attempt and now - attempt[1] < self.retry_window:
+                retries = attempt[0] + 1
+        action.trace = {
+            'enqueued': now,
+            'started': None,
+            'finished': None,
+            'outcome': None,
+            'retries': retries,
+        }
+
+    def started(self, action):
+        """
+        Mark an action as started.
+
+        @param action The action which is about to run.
+        """
+        trace = getattr(action, 'trace', None)
+        if trace is not None:
+            trace['started'] = time.time()
+
+    def finished(self, action, outcome):
+        """
+        Mark an action as finished and record its timings.
+
+        @param action The action which finished or was cancelled.
+        @param outcome The outcome of the action.
+        """
+        trace = getattr(action, 'trace', None)
+        if trace is None:
+            return
+
+        now = time.time()
+        trace['finished'] = now
+        trace['outcome'] = outcome
+        started = trace['started']
+        name = action.__class__.__name__
+        with self.lock:
+            stats = self._get_type(name)
+            stats['outcomes'][outcome] = stats['outcomes'].get(outcome, 0) + 1
+            if started is not None:
+                stats['wait'].add(started - trace['enqueued'])
+                stats['run'].add(now - started)
+                key = action.get_key()
+                if key is not None:
+                    self.attempts[key] = (trace['retries'], now)
+
+            record = dict(trace)
+            record['name'] = str(action)
+            record['type'] = name
+            self.recent.append(record)
+
+        if trace['retries']:
+            logger.debug(
+                "action '%s' %s after %s retries" %
+                (action, outcome, trace['retries']))
+
+    def prune(self):
+        """Forget the attempts which are outside of the retry window."""
+        now = time.time()
+        with self.lock:
+            for key, attempt in self.attempts.items():
+                if now - attempt[1] >= self.retry_window:
+                    del self.attempts[key]
+
+    def get_stats(self):
+        """
+        Get the latency statistics and the recently finished actions.
+
+        @return A dictionary with the wait and run time statistics and the
+            outcome counts by action type, see RollingHistogram.get_stats(),
+            and the recently finished action traces, newest first.
+        """
+        with self.lock:
+            types = {}
+            for name, stats in self.types.iteritems():
+                types[name] = {
+                    'wait': stats['wait'].get_stats(),
+                    'run': stats['run'].get_stats(),
+                    'outcomes': dict(stats['outcomes']),
+                }
+            recent = list(reversed(self.recent))
+        return {'types': types, 'recent': recent}
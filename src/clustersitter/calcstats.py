@@ -0,0 +1,210 @@
+"""
+Timing and health statistics for the state calculator.
+"""
+
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class RollingHistogram(object):
+    """
+    Keep a rolling window of samples and summarize them.
+    """
+
+    percentiles = [50, 90, 99]
+
+    def __init__(self, size=100):
+        """
+        Initialize the histogram.
+
+        @param size The number of most recent samples to keep.
+        """
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value):
+        """
+        Add a sample.
+
+        @param value The value of the sample.
+        """
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def get_stats(self):
+        """
+        Summarize the samples.
+
+        @return A dictionary with the total count and sum of all samples and
+            the last, min, max, mean and percentile values of the samples in
+            the window.
+        """
+        stats = {'count': self.count, 'total': self.total}
+        if not self.samples:
+            return stats
+
+        samples = sorted(self.samples)
+        stats['last'] = self.samples[-1]
+        stats['min'] = samples[0]
+        stats['max'] = samples[-1]
+        stats['mean'] = sum(samples) / len(samples)
+        for percentile in self.percentiles:
+            index = min(len(samples) - 1, len(samples) * percentile / 100)
+            stats['p%s' % percentile] = samples[index]
+        return stats
+
+
+class CalculationProfiler(object):
+    """
+    Profile state calculator cycles. Each phase of a cycle is timed and the
+    actions generated by the cycle are counted by type. A watchdog thread dumps
+    the stack of every thread to the log when a cycle runs past its deadline.
+    """
+
+    def __init__(self, deadline, history=100):
+        """
+        Initialize the profiler.
+
+        @param deadline The number of seconds a cycle may run before it is
+            considered overrun.
+        @param history The number of cycles to keep timings for.
+        """
+        self.deadline = deadline
+        self.history = history
+        self.cycles = RollingHistogram(history)
+        self.phases = {}
+        self.action_counts = {}
+        self.overruns = 0
+        self.cycle_start = None
+        self.current_phase = None
+        self.dumped = False
+        self.running = False
+        self.thread = None
+
+    def start_cycle(self):
+        """Mark the start of a cycle."""
+        self.dumped = False
+        self.cycle_start = time.time()
+
+    def run_phase(self, name, fn):
+        """
+        Run and time a phase of the cycle.
+
+        @param name The name of the phase.
+        @param fn The callable which runs the phase.
+        @return The return value of the phase.
+        """
+        self.current_phase = name
+        start = time.time()
+        try:
+            return fn()
+        finally:
+            if name not in self.phases:
+                self.phases[name] = RollingHistogram(self.history)
+            self.phases[name].add(time.time() - start)
+            self.current_phase = None
+
+    def end_cycle(self, actions):
+        """
+        Mark the end of a cycle.
+
+        @param actions The actions generated by the cycle.
+        """
+        duration = time.time() - self.cycle_start
+        self.cycle_start = None
+        self.cycles.add(duration)
+        if duration > self.deadline:
+            self.overruns += 1
+            logger.warn(
+                "calculate cycle took %.3fs, deadline is %ss" %
+                (duration, self.deadline))
+
+        for action in actions:
+            name = action.__class__.__name__
+            self.action_counts[name] = self.action_counts.get(name, 0) + 1
+
+    def get_stats(self):
+        """
+        Get the profiling statistics.
+
+        @return A dictionary of statistics.
+        """
+        running_time = None
+        cycle_start = self.cycle_start
+        if cycle_start is not None:
+            running_time = time.time() - cycle_start
+
+        return {
+            'deadline': self.deadline,
+            'cycles': self.cycles.get_stats(),
+            'overruns': self.overruns,
+            'phases': dict([
+                (name, histogram.get_stats())
+                for name, histogram in self.phases.items()]),
+            'actions': dict(self.action_counts),
+            'current_phase': self.current_phase,
+            'current_cycle_time': running_time,
+        }
+
+    def dump_threads(self):
+        """
+        Log the stack of every running thread.
+        """
+        names = dict([(t.ident, t.name) for t in threading.enumerate()])
+        lines = []
+        for ident, frame in sys._current_frames().items():
+            lines.append("Thread %s (%s):" % (names.get(ident), ident))
+            lines.extend(
+                [l.rstrip() for l in traceback.format_stack(frame)])
+        logger.error("\n".join(lines))
+
+    def check_deadline(self):
+        """
+        Dump thread stacks if the running cycle is past its deadline. Stacks
+        are only dumped once per cycle.
+
+        @return True if the stacks were dumped or False.
+        """
+        cycle_start = self.cycle_start
+        if (cycle_start is None or self.dumped or
+                time.time() - cycle_start <= self.deadline):
+            return False
+
+        self.dumped = True
+        logger.error(
+            "calculate cycle passed its %ss deadline in phase '%s'" %
+            (self.deadline, self.current_phase))
+        self.dump_threads()
+        return True
+
+    def start_watchdog(self):
+        """
+        Start the watchdog thread.
+        """
+        def run():
+            while self.running:
+                try:
+                    self.check_deadline()
+                except:
+                    logger.error(traceback.format_exc())
+                time.sleep(max(self.deadline / 4.0, 0.1))
+
+        if self.thread is None or not self.thread.is_alive():
+            self.running = True
+            self.thread = threading.Thread(target=run, name="CalcWatchdog")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop_watchdog(self):
+        """
+        Signal the watchdog thread to stop.
+        """
+        self.running = False
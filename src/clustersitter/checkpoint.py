@@ -0,0 +1,148 @@
+"""
+Cluster state checkpoints for warm restarts.
+"""
+
+import logging
+import os
+import time
+import traceback
+
+import simplejson
+
+logger = logging.getLogger(__name__)
+
+
+class StateCheckpoint(object):
+    """
+    Save enough of the cluster state to disk that a restarted sitter can pick
+    up where it left off without probing every machine for its sitter and
+    reloading its tasks before the machine can be used.
+
+    A checkpoint holds the following:
+
+        {
+            'version': checkpoint_format_version,
+            'time': unix_time,
+            'machines': [{
+                'hostname': hostname,
+                'status': machine_status,
+                'portnum': sitter_port,
+                'dns_name': dns_name,
+                'tasks': {
+                    task_name: task_running,
+                },
+                'desired': {
+                    task_name: desired_task_status,
+                },
+            }],
+            'pending': [[task_name, zone, desired_task_status]],
+            'repairs': [hostname],
+            'fillers': [[job_name, zone, count]],
+        }
+
+    Only the task names and whether they are running are kept from the
+    machine task data, the rest is reloaded by the machine monitors. The
+    current job state is not saved, it is rebuilt from the machine task data
+    by the first calculate cycle.
+
+    Repairs and fillers are recorded for reference only. Their threads do not
+    survive a restart so their machines and tasks are deployed again instead.
+    """
+
+    version = 1
+
+    def __init__(self, location):
+        """
+        Initialize the checkpoint.
+
+        @param location The directory to keep the checkpoint file in.
+        """
+        self.checkpoint_file = os.path.join(location, "state.checkpoint")
+
+    def dump(self, state):
+        """
+        Build a checkpoint of the cluster state. The state lock should be held
+        by the caller. The checkpoint does not share any objects with the
+        state so it may be saved after the lock is released.
+
+        @param state The cluster state to checkpoint.
+        @return The checkpoint data.
+        """
+        machines = []
+        for machine, item in state.machines.iteritems():
+            portnum = None
+            if machine.is_initialized():
+                portnum = machine.datamanager.portnum
+            tasks = dict([
+                (name, bool(task.get('running')))
+                for name, task in machine.get_tasks().iteritems()])
+            desired = dict([
+                (name, state.desired_jobs.get_task_status(name, machine))
+                for name in state.desired_jobs.get_machine_tasks(machine)])
+            machines.append({
+                'hostname': machine.hostname,
+                'status': item['status'],
+                'portnum': portnum,
+                'dns_name': machine.config.dns_name,
+                'tasks': tasks,
+                'desired': desired,
+            })
+
+        fillers = []
+        for job in state.jobs.values():
+            for zone, zone_fillers in job.fillers.iteritems():
+                for filler in zone_fillers:
+                    fillers.append([job.name, zone, filler.num_remaining()])
+
+        return {
+            'version': self.version,
+            'time': time.time(),
+            'machines': machines,
+            'pending': state.desired_jobs.get_unassigned_tasks(),
+            'repairs': sorted(state.repair_jobs.keys()),
+            'fillers': fillers,
+        }
+
+    def save(self, data):
+        """
+        Atomically write a checkpoint to disk.
+
+        @param data The checkpoint data, see dump().
+        @return True on success or False on failure.
+        """
+        temp_file = "%s.tmp" % self.checkpoint_file
+        try:
+            with open(temp_file, 'w') as fd:
+                fd.write(simplejson.dumps(data))
+                fd.flush()
+                os.fsync(fd.fileno())
+            os.rename(temp_file, self.checkpoint_file)
+        except (IOError, OSError):
+            logger.error(
+                "failed to write checkpoint '%s'" % self.checkpoint_file)
+            logger.error(traceback.format_exc())
+            return False
+        return True
+
+    def load(self):
+        """
+        Read the checkpoint from disk.
+
+        @return The checkpoint data or None if there is no usable checkpoint.
+        """
+        if not os.path.exists(self.checkpoint_file):
+            return None
+        try:
+            with open(self.checkpoint_file) as fd:
+                data = simplejson.loads(fd.read())
+        except (IOError, ValueError):
+            logger.error(
+                "failed to read checkpoint '%s'" % self.checkpoint_file)
+            logger.error(traceback.format_exc())
+            return None
+
+        if data.get('version') != self.version:
+            logger.warn(
+                "ignoring checkpoint with version %s" % data.get('version'))
+            return None
+        return data
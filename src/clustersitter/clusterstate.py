@@ -3,13 +3,21 @@ Cluster state tracking and maintenance.
 """
 
 import logging
-import simplejson
 import time
 from actions import (
     AddTaskAction, ClusterActionManager, DecomissionMachineAction,
     DeployMachineAction, RedeployMachineAction, RemoveTaskAction,
     RestartTaskAction, StartTaskAction, StopTaskAction)
+from calcstats import CalculationProfiler
+from checkpoint import StateCheckpoint
+from jobgraph import JobGraph
+from jobstore import JobStore
+from machinemonitor import MachineMonitor
+from monitoredmachine import MonitoredMachine
+from multiprocessing.pool import ThreadPool
+from placement import DEFAULT_DEMAND, ResourcePacker
 from productionjob import ProductionJob
+from scheduler import CalculationScheduler
 from threading import RLock, Thread
 
 logger = logging.getLogger(__name__)
@@ -49,29 +57,186 @@ class JobState(object):
         """
         Initialize an empty state object.
 
-        State attributes are structured as follows:
+        Tasks are stored in a set of indexes so that lookups by task, machine
+        or zone do not need to scan the whole state. Each task item is a
+        dictionary that looks like this:
+
+            {
+                'machine': machine_object,
+                'status': task_status,
+                'zone': zone,
+            }
+
+        The indexes are structured as follows:
 
             tasks = {
-                task_name: [
-                    {
-                        'machine': machine_object,
-                        'status': task_status,
-                        'zone': zone,
-                    },
-                ],
+                task_name: {
+                    machine_object: task_item,
+                },
+            }
+
+            pending = {
+                task_name: [task_item],
+            }
+
+            machines = {
+                machine_object: set([task_name]),
+            }
+
+            zones = {
+                zone: {
+                    task_name: task_count,
+                },
+            }
+
+            pending_counts = {
+                zone: {
+                    task_name: pending_task_count,
+                },
             }
+
+        Task items that do not have a machine assigned live in pending until a
+        machine is assigned to them. The pending counts only include pending
+        items that are not being deployed.
+
+        Changes to tasks assigned to machines are journaled as (name, machine)
+        keys in dirty until they are collected with pop_dirty().
         """
         self.tasks = {}
+        self.pending = {}
+        self.machines = {}
+        self.zones = {}
+        self.pending_counts = {}
+        self.dirty = set()
 
     def _get_task_item(self, name, machine):
         """
-        Get the list item from self.tasks[name] that contains the given task.
+        Get the task item for the named task on the given machine.
         """
-        if name in self.tasks:
-            for task in self.tasks[name]:
-                if task['machine'] == machine:
-                    return task
-        return None
+        return self.tasks.get(name, {}).get(machine)
+
+    def _count(self, index, zone, name, delta):
+        """
+        Adjust a zone/name counter in the given index. Counters that drop to
+        zero are removed.
+        """
+        counts = index.setdefault(zone, {})
+        counts[name] = counts.get(name, 0) + delta
+        if counts[name] <= 0:
+            del counts[name]
+            if not counts:
+                del index[zone]
+
+    def _is_pending(self, item):
+        """Check if a task item is waiting for a machine."""
+        return not item['machine'] and item['status'] != self.Deploying
+
+    def _add_item(self, name, item):
+        """
+        Add a task item to the indexes.
+        """
+        machine = item['machine']
+        if machine:
+            self.tasks.setdefault(name, {})[machine] = item
+            self.machines.setdefault(machine, set()).add(name)
+            self.dirty.add((name, machine))
+        else:
+            self.pending.setdefault(name, []).append(item)
+            if self._is_pending(item):
+                self._count(self.pending_counts, item['zone'], name, 1)
+        self._count(self.zones, item['zone'], name, 1)
+
+    def _remove_item(self, name, item):
+        """
+        Remove a task item from the indexes.
+        """
+        machine = item['machine']
+        if machine:
+            machine_items = self.tasks[name]
+            del machine_items[machine]
+            if not machine_items:
+                del self.tasks[name]
+            names = self.machines[machine]
+            names.discard(name)
+            if not names:
+                del self.machines[machine]
+            self.dirty.add((name, machine))
+        else:
+            pending_items = self.pending[name]
+            pending_items.remove(item)
+            if not pending_items:
+                del self.pending[name]
+            if self._is_pending(item):
+                self._count(self.pending_counts, item['zone'], name, -1)
+        self._count(self.zones, item['zone'], name, -1)
+
+    def _set_item_status(self, name, item, status):
+        """
+        Update the status of a task item and the pending counts.
+        """
+        if item['status'] == status:
+            return
+        was_pending = self._is_pending(item)
+        item['status'] = status
+        if item['machine']:
+            self.dirty.add((name, item['machine']))
+        is_pending = self._is_pending(item)
+        if was_pending != is_pending:
+            self._count(
+                self.pending_counts, item['zone'], name,
+                1 if is_pending else -1)
+
+    def _iter_items(self, name):
+        """
+        Iterate over all of the task items for a name, including pending
+        items.
+        """
+        for item in self.tasks.get(name, {}).itervalues():
+            yield item
+        for item in self.pending.get(name, []):
+            yield item
+
+    def pop_dirty(self):
+        """
+        Collect the journal of changed tasks and start a new one.
+
+        @return A set of (name, machine) keys for tasks which were added,
+            removed or changed status since the last call.
+        """
+        dirty = self.dirty
+        self.dirty = set()
+        return dirty
+
+    def touch_machine(self, machine):
+        """
+        Journal all of the tasks on a machine as changed. Used when something
+        outside of the job state, such as the machine status, changes.
+
+        @param machine The machine to journal.
+        """
+        for name in self.machines.get(machine, ()):
+            self.dirty.add((name, machine))
+
+    def get_unassigned_tasks(self):
+        """
+        Get the tasks that do not have machines, including those being
+        deployed.
+
+        @return A list of (name, zone, status) tuples.
+        """
+        tasks = []
+        for name in sorted(self.pending.keys()):
+            for item in self.pending[name]:
+                tasks.append((name, item['zone'], item['status']))
+        return tasks
+
+    def get_task_names(self):
+        """
+        Get the names of all tasks in the state.
+
+        @return A set of task names.
+        """
+        return set(self.tasks.keys()) | set(self.pending.keys())
 
     def flatten(self):
         """
@@ -84,12 +249,30 @@ class JobState(object):
         @return The flattened job set.
         """
         flat = set()
-        for name, task_items in self.tasks.iteritems():
-            for task in task_items:
-                if task['machine'] is not None:
-                    flat.add((task['zone'], task['machine'], name))
+        for name, machine_items in self.tasks.iteritems():
+            for machine, task in machine_items.iteritems():
+                flat.add((task['zone'], machine, name))
         return flat
 
+    def get_zoned_task_keys(self, names=None):
+        """
+        Get the tasks which have machines assigned grouped by zone.
+
+        @param names Only include tasks with these names. Optional.
+        @return A dictionary of zone/task key set mappings. Task keys are
+            (name, machine) tuples.
+        """
+        zoned_keys = {}
+        for name, machine_items in self.tasks.iteritems():
+            if names is not None and name not in names:
+                continue
+            for machine, task in machine_items.iteritems():
+                zone = task['zone']
+                if zone not in zoned_keys:
+                    zoned_keys[zone] = set()
+                zoned_keys[zone].add((name, machine))
+        return zoned_keys
+
     def is_machine_idle(self, machine):
         """
         Check if a machine has any tasks assigned to it.
@@ -97,11 +280,7 @@ class JobState(object):
         @param machine The machine to check.
         @return True if the machine is idle or False.
         """
-        for task_items in self.tasks.values():
-            for task in task_items:
-                if task['machine'] == machine:
-                    return False
-        return True
+        return machine not in self.machines
 
     def remove_machine(self, machine):
         """
@@ -109,12 +288,8 @@ class JobState(object):
 
         @param machine The machine to remove tasks from.
         """
-        for name in self.tasks.keys():
-            for task in list(self.tasks[name]):
-                if task['machine'] == machine:
-                    self.tasks[name].remove(task)
-            if not self.tasks[name]:
-                del self.tasks[name]
+        for name in list(self.machines.get(machine, ())):
+            self._remove_item(name, self.tasks[name][machine])
 
     def has_task(self, name, machine=None):
         """
@@ -127,7 +302,7 @@ class JobState(object):
         if machine:
             return self._get_task_item(name, machine) is not None
         else:
-            return name in self.tasks
+            return name in self.tasks or name in self.pending
 
     def is_task_deploying(self, name, machine):
         """
@@ -153,6 +328,19 @@ class JobState(object):
             return item['status']
         return None
 
+    def get_task_zone(self, name, machine):
+        """
+        Get the zone of the task on the given machine.
+
+        @param name The name of the task.
+        @param machine The machine to check in.
+        @return The zone of the task or None if not present.
+        """
+        item = self._get_task_item(name, machine)
+        if item:
+            return item['zone']
+        return None
+
     def get_task_machines(self, name=None, zones=None):
         """
         Get machines that have tasks allocated to them.
@@ -176,14 +364,12 @@ class JobState(object):
         else:
             task_items = self.tasks
 
-        for name, tasks in task_items.iteritems():
-            for task in tasks:
+        for name, machine_items in task_items.iteritems():
+            for machine, task in machine_items.iteritems():
                 zone = task['zone']
-                machine = task['machine']
-                if machine:
-                    if zone not in zoned_machines:
-                        zoned_machines[zone] = []
-                    zoned_machines[zone].append(machine)
+                if zone not in zoned_machines:
+                    zoned_machines[zone] = []
+                zoned_machines[zone].append(machine)
         return zoned_machines
 
     def get_machine_tasks(self, machine, status=None):
@@ -195,13 +381,12 @@ class JobState(object):
         @return A set of task names running on the machine. An empty list if
             the machine is not present.
         """
-        names = set()
-        for name, tasks in self.tasks.iteritems():
-            for task in tasks:
-                if task['machine'] == machine:
-                    if status is None or status == task['status']:
-                        names.add(name)
-        return names
+        names = self.machines.get(machine, ())
+        if status is None:
+            return set(names)
+        return set([
+            name for name in names
+            if self.tasks[name][machine]['status'] == status])
 
     def add_tasks(self, name, zone, machines, create=None, status=None):
         """
@@ -222,17 +407,14 @@ class JobState(object):
         if not status:
             status = self.Running
 
-        if name not in self.tasks:
-            self.tasks[name] = []
-
         for machine in machines:
             if not self.has_task(name, machine):
-                self.tasks[name].append({
+                self._add_item(name, {
                     'machine': machine,
                     'status': status,
                     'zone': zone})
         for n in range(create):
-            self.tasks[name].append({
+            self._add_item(name, {
                 'machine': None,
                 'status': status,
                 'zone': zone})
@@ -247,16 +429,16 @@ class JobState(object):
         @return A list of tasks that were removed.
         """
         removed = []
-        if name in self.tasks:
+        if self.has_task(name):
             removed.append(name)
             if machines is None:
-                del self.tasks[name]
+                for task in list(self._iter_items(name)):
+                    self._remove_item(name, task)
             else:
-                for task in list(self.tasks[name]):
-                    if task['machine'] in machines:
-                        self.tasks[name].remove(task)
-                if not self.tasks[name]:
-                    del self.tasks[name]
+                for machine in machines:
+                    task = self._get_task_item(name, machine)
+                    if task:
+                        self._remove_item(name, task)
         return removed
 
     def update_tasks(self, name, status, machines=None):
@@ -266,69 +448,111 @@ class JobState(object):
         @param name The name of the task to update.
         @param machines The machines to update the task status on.
         """
-        if name in self.tasks:
-            for task in self.tasks[name]:
-                if not machines or task['machine'] in machines:
-                    task['status'] = status
+        if machines:
+            tasks = [self._get_task_item(name, m) for m in machines]
+        else:
+            tasks = list(self._iter_items(name))
+        for task in tasks:
+            if task:
+                self._set_item_status(name, task, status)
 
     def set_pending_deploying(self, zone, name, count):
         """
-        Flag a pending task as currently being deployed.
+        Flag pending tasks as currently being deployed.
 
         @param zone The zone the task is running in.
         @param name The name of the task to flag.
         @param count The max number of task in a zone to flag.
         """
-        if name in self.tasks:
-            flagged = 0
-            for task in self.tasks[name]:
-                if not task['machine'] and task['zone'] == zone:
-                    flagged += 1
-                    task['status'] = self.Deploying
-                    if flagged >= count:
-                        break
+        flagged = 0
+        for task in self.pending.get(name, []):
+            if flagged >= count:
+                break
+            if task['zone'] == zone and task['status'] != self.Deploying:
+                flagged += 1
+                self._set_item_status(name, task, self.Deploying)
+
+    def get_pending_count(self, name, zone):
+        """
+        Count the tasks without machines, including those being deployed.
+
+        @param name The name of the task.
+        @param zone The zone to count in.
+        @return The number of tasks without machines.
+        """
+        return len([
+            task for task in self.pending.get(name, [])
+            if task['zone'] == zone])
 
     def get_pending_tasks(self):
         """
         Find the tasks that require machines.
 
-        @param zones Only return required machines for these zones.
-        @param tasks Only return required machines for these tasks.
         @return A dictionary describing what tasks in which zones require
             machines. The key is the zone name and the value is another
             dictionary. That dictionary's keys are the task names and the
             values are the number of machines required.
         """
         required = {}
-        for name, tasks in self.tasks.iteritems():
-            for task in tasks:
-                zone = task['zone']
-                if zone not in required:
-                    required[zone] = {}
-                if name not in required[zone]:
-                    required[zone][name] = 0
-                if not task['machine'] and task['status'] != self.Deploying:
-                    required[zone][name] += 1
+        for zone, names in self.zones.iteritems():
+            pending_counts = self.pending_counts.get(zone, {})
+            required[zone] = {}
+            for name in names:
+                required[zone][name] = pending_counts.get(name, 0)
         return required
 
     def set_pending_machines(self, zone, name, machines, deploying=False):
         """
         Assign machines to tasks that do not have machines. Each machine will
-        be assigned to the given task.
+        be assigned to the given task. Machines which already have the task
+        are skipped.
 
         @param zone The zone to assign to.
         @param name The name of the task to assign machines to.
         @param machines The machines to assign to the task.
-        @param deploying True to replace machines that have the deploying flag
-        set. Defaults to False.
+        @param deploying True to assign machines to tasks that have the
+            deploying flag set instead of tasks waiting for a machine. Defaults
+            to False.
         """
         for machine in machines:
-            for task in self.tasks.get(name, []):
-                if (not task['machine'] and task['zone'] == zone and
-                        task['status'] == self.Deploying):
+            if self.has_task(name, machine):
+                continue
+            for task in self.pending.get(name, []):
+                is_deploying = task['status'] == self.Deploying
+                if task['zone'] == zone and is_deploying == deploying:
+                    self._remove_item(name, task)
                     task['machine'] = machine
+                    self._add_item(name, task)
                     break
 
+    def complete_pending_deploying(self, zone, name, machines, count):
+        """
+        Resolve tasks flagged as deploying once their machines have been
+        deployed. A flagged task is assigned to each machine as running. If a
+        machine already has the task, the flagged task is dropped instead.
+        Flagged tasks left over are returned to waiting for a machine.
+
+        @param zone The zone the tasks were deployed to.
+        @param name The name of the task.
+        @param machines The machines that were deployed.
+        @param count The number of flagged tasks to resolve.
+        """
+        flagged = [
+            task for task in self.pending.get(name, [])
+            if task['zone'] == zone and task['status'] == self.Deploying]
+        flagged = flagged[:count]
+        for machine in machines:
+            if not flagged:
+                break
+            task = flagged.pop(0)
+            self._remove_item(name, task)
+            if not self.has_task(name, machine):
+                task['machine'] = machine
+                task['status'] = self.Running
+                self._add_item(name, task)
+        for task in flagged:
+            self._set_item_status(name, task, self.Running)
+
     def get_job_fill(self):
         """
         Calculate the job fill. returns a two-tuple with the job fill and job
@@ -350,10 +574,10 @@ class JobState(object):
         """
         job_fill = {}
         job_fill_machines = {}
-        for name, tasks in self.tasks.iteritems():
+        for name in self.get_task_names():
             job_fill[name] = {}
             job_fill_machines[name] = {}
-            for task in tasks:
+            for task in self._iter_items(name):
                 if task['zone'] not in job_fill[name]:
                     job_fill[name][task['zone']] = 0
                     job_fill_machines[name][task['zone']] = []
@@ -362,6 +586,58 @@ class JobState(object):
         return (job_fill, job_fill_machines)
 
 
+class ClusterSnapshot(object):
+    """
+    A read-only copy of the cluster state. A new snapshot is published at the
+    end of every calculate cycle so that readers such as the HTTP handlers can
+    inspect the cluster without taking the state lock. Snapshots are never
+    modified once published; readers must not modify them either.
+    """
+
+    def __init__(self, version, state):
+        """
+        Copy the current cluster state. The caller must hold the state lock.
+
+        @param version The version number of the snapshot.
+        @param state The cluster state to copy.
+        """
+        def freeze(zoned_machines):
+            return dict([
+                (zone, tuple(machines))
+                for zone, machines in zoned_machines.iteritems()])
+
+        self.version = version
+        self.timestamp = time.time()
+        self.machines = freeze(state.get_machines())
+        self.idle_machines = freeze(state.get_machines(idle=True))
+        self.unreachable_machines = freeze(
+            state.get_machines(unreachable=True))
+        self.machine_status = dict([
+            (machine, item['status'])
+            for machine, item in state.machines.iteritems()])
+        self.jobs = dict(state.jobs)
+        self.repair_jobs = dict(state.repair_jobs)
+
+        job_fill, job_fill_machines = state.current_jobs.get_job_fill()
+        self.job_fill = job_fill
+        self.job_fill_machines = dict([
+            (name, freeze(zoned_machines))
+            for name, zoned_machines in job_fill_machines.iteritems()])
+
+        self.idle = frozenset([
+            machine for machines in self.idle_machines.itervalues()
+            for machine in machines])
+
+    def is_machine_idle(self, machine):
+        """
+        Check if a machine was idle when the snapshot was taken.
+
+        @param machine The machine to check.
+        @return True if the machine is idle or False.
+        """
+        return machine in self.idle
+
+
 class ClusterState(object):
     """
     Cluster state. Manages the state of the cluster and generates actions as a
@@ -383,6 +659,19 @@ class ClusterState(object):
     Pending = 'pending'
     Unreachable = 'unreachable'
 
+    # The phases of a calculate cycle, in the order they are run.
+    phases = [
+        'calculate_ready_machines',
+        'calculate_current_state',
+        'calculate_job_deployment',
+        'calculate_job_cleanup',
+        'calculate_idle_cleanup',
+        'calculate_unreachable_machines',
+        'publish_snapshot',
+        'checkpoint_state',
+        'rebalance_monitors',
+    ]
+
     def __init__(self, sitter):
         """
         Initialize an empty state object.
@@ -393,13 +682,30 @@ class ClusterState(object):
                 name: provider,
             }
 
-            machines = [
-                {
-                    'machine': machine_status,
+            machines = {
+                machine_object: {
+                    'machine': machine_object,
                     'status': machine_status,
                     'zone': zone,
                 },
-            ]
+            }
+
+        The machine registry is indexed by zone, status and monitor:
+
+            zone_machines = {
+                zone: set([machine_object]),
+            }
+
+            status_machines = {
+                status: set([machine_object]),
+            }
+
+            machine_monitors = {
+                machine_object: monitor,
+            }
+
+        Machines are idle when they have no tasks in the desired job state,
+        which keeps its own machine index.
 
         @param sitter The cluster sitter object.
         """
@@ -411,40 +717,81 @@ class ClusterState(object):
         self.zones = {}
         self.providers = {}
         self.max_idle_per_zone = -1
-        self.machines = []
-        self.jobs = {}
-        self.job_file = "%s/jobs.json" % sitter.log_location
-        self.job_chains = {}
+        self.machines = {}
+        self.zone_machines = {}
+        self.status_machines = {}
+        self.machine_monitors = {}
+        self.job_graph = JobGraph()
+        self.jobs = self.job_graph.jobs
+        # Revisions by job name, bumped each time a job is added so that
+        # redeploys of a newer revision are not taken for duplicates.
+        self.job_revisions = {}
+        self.job_store = JobStore(sitter.log_location)
         self.repair_jobs = {}
         self.desired_jobs = JobState()
         self.current_jobs = JobState()
-        self.actions = ClusterActionManager()
+        # Actions are not repeated until the machine monitors have had a
+        # chance to poll their results.
+        self.actions = ClusterActionManager(
+            notify=self.notify_action, workers=sitter.action_workers,
+            grace_period=2 * sitter.stats_poll_interval)
+        self.scheduler = CalculationScheduler(self.sleep)
+        self.profiler = CalculationProfiler(sitter.calculate_deadline)
         self.lock = RLock()
+        self.snapshot = None
+        self.publish_snapshot()
+
+        # Job deployment only diffs tasks journaled as changed by the job
+        # states. Every full_reconcile_interval cycles, or whenever the set of
+        # jobs changes, every task is diffed instead.
+        self.full_reconcile_interval = 10
+        self.reconcile_countdown = 0
+        self.reconcile_jobs = None
+
+        # Number of threads used to plan job deployment across zones.
+        self.deployment_workers = sitter.deployment_workers
+        self.pool = None
+
+        # The state is checkpointed to disk every checkpoint_interval seconds
+        # so that a restarted sitter can restore it, see restore_checkpoint().
+        self.checkpoint = StateCheckpoint(sitter.log_location)
+        self.checkpoint_interval = 60
+        self.last_checkpoint = 0
+        self.checkpoint_thread = None
+
+        # Machine monitors are added and removed to keep about
+        # machines_per_monitor machines on each, within min_monitors and
+        # max_monitors. Machines are moved off monitors whose polls run more
+        # than monitor_lag_threshold seconds behind. Both are checked every
+        # rebalance_interval seconds.
+        self.machines_per_monitor = 250
+        self.min_monitors = 1
+        self.max_monitors = 32
+        self.monitor_lag_threshold = sitter.stats_poll_interval
+        self.rebalance_interval = 60
+        self.last_rebalance = time.time()
+        self.monitor_number = 0
 
         #TODO: Move this to the sitter. State is not a catch-all.
         self.loggers = []
 
-    @lock
     def _get_machine_item(self, machine):
         """
-        Get the list item from self.machines that contains the given machine.
+        Get the registry item for the given machine.
         """
-        for item in self.machines:
-            if item['machine'] == machine:
-                return item
-        return None
+        return self.machines.get(machine)
 
-    @lock
-    def _get_master_job(self, job):
-        """Get the master job in a job chain."""
-        if job.name not in self.jobs:
-            return None
-        current_job = job
-        next_job = job.find_linked_job()
-        while next_job:
-            current_job = next_job
-            next_job = current_job.find_linked_job()
-        return current_job
+    def _index_machine(self, index, key, machine):
+        """Add a machine to a registry index."""
+        index.setdefault(key, set()).add(machine)
+
+    def _unindex_machine(self, index, key, machine):
+        """Remove a machine from a registry index."""
+        machines = index.get(key)
+        if machines is not None:
+            machines.discard(machine)
+            if not machines:
+                del index[key]
 
     def get_job(self, name):
         """
@@ -504,6 +851,19 @@ class ClusterState(object):
         """
         return self._get_machine_item(machine) is not None
 
+    def find_machine(self, hostnames):
+        """
+        Find a machine by hostname. This scans every machine and does not
+        take the state lock.
+
+        @param hostnames The hostnames or addresses the machine may have.
+        @return The machine or None if none has any of the hostnames.
+        """
+        for machine in self.machines.keys():
+            if machine.hostname in hostnames:
+                return machine
+        return None
+
     def is_machine_mutable(self, machine):
         """
         Check if a machine is allowed to have actions run against it.
@@ -538,18 +898,15 @@ class ClusterState(object):
         item = self._get_machine_item(machine)
         return item and self.desired_jobs.is_machine_idle(machine)
 
-    @lock
     def is_machine_monitored(self, machine):
         """
-        Check if a machine is being or is queued to be monitored.
+        Check if a machine is being or is queued to be monitored. This reads
+        the monitor index directly and does not take the state lock.
 
         @param machine The machine to check.
         @return True if the machine is monitored or False.
         """
-        for monitor, thread in self.monitors:
-            if monitor.has_machine(machine):
-                return True
-        return False
+        return machine in self.machine_monitors
 
     @lock
     def is_machine_unreachable(self, machine):
@@ -578,38 +935,41 @@ class ClusterState(object):
             reachable machines. Defaults to both.
         @return A dictionary of zone to machine list mappings.
         """
+        zoned_machines = dict([(z, []) for z in self.zone_machines])
         if zones:
-            zoned_machines = {z: [] for z in zones}
-        else:
-            zoned_machines = {}
+            for zone in zones:
+                zoned_machines.setdefault(zone, [])
 
-        for item in self.machines:
-            zone = item['zone']
-            machine = item['machine']
-            if item['zone'] not in zoned_machines:
-                zoned_machines[item['zone']] = []
+        # Check for the requested status.
+        status_machines = None
+        if status:
+            status_machines = self.status_machines.get(status, set())
 
+        for zone, machines in self.zone_machines.iteritems():
             # Check for the requested zone.
             if zones is not None and zone not in zones:
                 continue
 
-            # Check for the requested status.
-            if status and item['status'] != status:
-                continue
-
-            # Check for the requested idle state.
-            is_idle = self.is_machine_idle(machine)
-            if idle is not None and idle != is_idle:
-                continue
-
-            # Check for the requested unreachable state.
-            is_unreachable = self.is_machine_unreachable(machine)
-            if (unreachable is not None
-                    and is_unreachable != unreachable):
-                continue
+            if status_machines is not None:
+                machines = machines & status_machines
 
-            # Append the machine to the results if all checks passed.
-            zoned_machines[zone].append(machine)
+            for machine in machines:
+                # Check for the requested idle state.
+                if idle is not None:
+                    is_idle = self.desired_jobs.is_machine_idle(machine)
+                    if idle != is_idle:
+                        continue
+
+                # Check for the requested unreachable state.
+                if unreachable is not None:
+                    is_unreachable = (
+                        machine not in self.machine_monitors and
+                        not self.get_machine_repair_job(machine))
+                    if is_unreachable != unreachable:
+                        continue
+
+                # Append the machine to the results if all checks passed.
+                zoned_machines[zone].append(machine)
         return zoned_machines
 
     def get_machine_zone(self, machine):
@@ -670,11 +1030,13 @@ class ClusterState(object):
                     status = self.Active
 
             zone = machine.config.shared_fate_zone
-            self.machines.append({
+            self.machines[machine] = {
                 'machine': machine,
                 'status': status,
                 'zone': zone,
-            })
+            }
+            self._index_machine(self.zone_machines, zone, machine)
+            self._index_machine(self.status_machines, status, machine)
 
             if existing and status != self.Pending:
                 self.add_machine_tasks(machine)
@@ -721,9 +1083,11 @@ class ClusterState(object):
         """
         self.desired_jobs.remove_machine(machine)
         self.current_jobs.remove_machine(machine)
-        item = self._get_machine_item(machine)
+        item = self.machines.pop(machine, None)
         if item:
-            self.machines.remove(item)
+            self._unindex_machine(self.zone_machines, item['zone'], machine)
+            self._unindex_machine(
+                self.status_machines, item['status'], machine)
 
     @lock
     def update_machine(self, machine, status):
@@ -736,10 +1100,35 @@ class ClusterState(object):
         """
         item = self._get_machine_item(machine)
         if item:
-            item['status'] = status
+            if item['status'] != status:
+                self._unindex_machine(
+                    self.status_machines, item['status'], machine)
+                self._index_machine(self.status_machines, status, machine)
+                item['status'] = status
+                self.desired_jobs.touch_machine(machine)
+                self.current_jobs.touch_machine(machine)
             return True
         return False
 
+    @lock
+    def complete_deployment(self, zone, name, machines, count):
+        """
+        Finish deploying a master job to new machines. The machines are made
+        active and the tasks flagged as deploying for them are assigned. If
+        fewer machines than requested were deployed the remaining tasks are
+        left for the next deployment calculation.
+
+        @param zone The zone the machines were deployed to.
+        @param name The name of the master job.
+        @param machines The machines that were deployed.
+        @param count The number of machines that were requested.
+        """
+        machines = [m for m in machines if self.has_machine(m)]
+        for machine in machines:
+            self.update_machine(machine, self.Active)
+        self.desired_jobs.complete_pending_deploying(
+            zone, name, machines, count)
+
     @lock
     def monitor_machine(self, machine):
         """
@@ -757,7 +1146,65 @@ class ClusterState(object):
 
         # Always add to the monitor with the least amount of machines.
         self.monitors.sort(key=sort_monitors)
-        return self.monitors[0][0].add_machine(machine)
+        monitor = self.monitors[0][0]
+        if not monitor.add_machine(machine):
+            return False
+        self.machine_monitors[machine] = monitor
+        return True
+
+    @lock
+    def add_monitor(self, start=True):
+        """
+        Add a machine monitor.
+
+        @param start Whether to start the monitor thread. Defaults to True.
+        @return The new monitor.
+        """
+        monitor = MachineMonitor(parent=self.sitter,
+                                 number=self.monitor_number)
+        thread = Thread(target=monitor.start,
+                        name='Monitoring-%s' % self.monitor_number)
+        self.monitor_number += 1
+        self.monitors.append((monitor, thread))
+        if start:
+            thread.start()
+        return monitor
+
+    @lock
+    def remove_monitor(self, monitor):
+        """
+        Stop a machine monitor and move its machines to the other monitors.
+
+        @param monitor The monitor to remove.
+        @return True if the monitor was removed or False if it is the last
+            monitor.
+        """
+        others = [m for m, _ in self.monitors if m is not monitor]
+        if not others:
+            return False
+
+        self.monitors = [item for item in self.monitors
+                         if item[0] is not monitor]
+        with monitor.lock:
+            machines = list(monitor.members)
+        for machine in machines:
+            target = min(others, key=lambda m: m.num_monitored_machines())
+            self._move_machine(machine, monitor, target)
+        monitor.stop()
+        return True
+
+    def _move_machine(self, machine, source, target):
+        """
+        Move a machine between monitors, along with its poll history so that
+        failing machines keep their failure streak. The lock must be held.
+        """
+        with source.lock:
+            history = source.get_poll_history(machine)
+            if not source.remove_machine(machine):
+                return False
+            target.add_machine(machine, history)
+        self.machine_monitors[machine] = target
+        return True
 
     @lock
     def unmonitor_machine(self, machine):
@@ -768,10 +1215,11 @@ class ClusterState(object):
         @return True if the machine was removed or False if the machine was not
             being monitored.
         """
-        for monitor, thread in self.monitors:
-            if monitor.remove_machine(machine):
-                return True
-        return False
+        monitor = self.machine_monitors.pop(machine, None)
+        if monitor is None:
+            return False
+        monitor.remove_machine(machine)
+        return True
 
     @lock
     def repair_machine(self, machine):
@@ -813,32 +1261,35 @@ class ClusterState(object):
         """
         zone = self.get_machine_zone(machine)
         tasks = self.desired_jobs.get_machine_tasks(machine)
-        job_chains = {}
+        masters = []
         for task in tasks:
-            if task in self.job_chains:
-                job_chains[task] = self.job_chains[task]
+            if task in self.job_graph.chains:
+                masters.append(task)
             self.desired_jobs.remove_tasks(task, [machine])
 
-        for master in job_chains.keys():
+        for master in masters:
             self.desired_jobs.add_tasks(master, zone, [], 1)
 
     @lock
     def add_job(self, job, redeploy=False):
         """
-        Add a job to the cluster. Master jobs are immediately allocated to
-        machines. Child jobs are attached to their associated master job and
-        deployed simultenously as a job "chain". Existing jobs will be
-        redeployed if requested. If the name of this job matches existing tasks
-        that do not have jobs then those tasks will be assigned to this job.
+        Add a job to the cluster. Master jobs are queued for placement on
+        machines by the next deployment calculation. Child jobs are attached
+        to their associated master job and deployed simultenously as a job
+        "chain". Existing jobs will be redeployed if requested. If the name
+        of this job matches existing tasks that do not have jobs then those
+        tasks will be assigned to this job.
 
         @param job The job to add to the cluster. The job is configured with
             the required zones and number of machines.
         @param redeploy Whether or not to redeploy existing jobs.
         @return True if the job was added or False if it was not.
         """
-        self.jobs[job.name] = job
+        if not self.job_graph.add_job(job):
+            return False
+        self.job_revisions[job.name] = self.job_revisions.get(job.name, 0) + 1
+        self._store_job(job)
         zoned_existing_machines = self.desired_jobs.get_task_machines(job.name)
-        zoned_idle_machines = self.get_machines(idle=True)
         job_zones = job.get_shared_fate_zones()
         all_zones = set(job_zones) | set(zoned_existing_machines.keys())
 
@@ -852,37 +1303,47 @@ class ClusterState(object):
             elif job.linked_job:
                 # Redeploy child tasks to their current machines.
                 if redeploy:
-                    self.desired_jobs.update_tasks(
-                        job.name, JobState.Deploying, existing_machines)
-                    for machine in existing_machines:
-                        self.actions.add(
-                            AddTaskAction(self.sitter, zone, machine, job.name))
+                    self._redeploy_tasks(job, zone, existing_machines)
             else:
-                # Redeploy master job across the cluster.
-                idle_machines = zoned_idle_machines.get(zone, [])
+                # Redeploy master job across the cluster. New instances are
+                # placed on machines by the deployment calculation.
                 num_required = job.get_num_required_machines_in_zone(zone)
 
                 redeploy_machines = existing_machines[:num_required]
                 undeploy_machines = existing_machines[num_required:]
-                num_idle = num_required - len(redeploy_machines)
-                deploy_machines = idle_machines[:num_idle]
                 num_create = (
                     num_required - len(redeploy_machines) -
-                    len(deploy_machines))
+                    self.desired_jobs.get_pending_count(job.name, zone))
 
-                self.desired_jobs.add_tasks(
-                    job.name, zone, deploy_machines, num_create)
+                self.desired_jobs.add_tasks(job.name, zone, [], num_create)
                 self.desired_jobs.remove_tasks(
                     job.name, undeploy_machines)
 
                 if redeploy:
-                    self.desired_jobs.update_tasks(
-                        job.name, JobState.Deploying, redeploy_machines)
-                    for machine in redeploy_machines:
-                        self.actions.add(
-                            AddTaskAction(self.sitter, zone, machine, job.name))
+                    self._redeploy_tasks(job, zone, redeploy_machines)
         return True
 
+    def _redeploy_tasks(self, job, zone, machines):
+        """
+        Redeploy the tasks of a job to the machines they are on. Only the
+        machines whose add action is queued are marked as deploying. The lock
+        must be held.
+
+        @param job The job to redeploy.
+        @param zone The zone the machines are in.
+        @param machines The machines to redeploy to.
+        """
+        revision = self.job_revisions.get(job.name)
+        deploying = []
+        for machine in machines:
+            action = AddTaskAction(
+                self.sitter, zone, machine, job.name, revision)
+            if self.actions.add(action):
+                deploying.append(machine)
+        if deploying:
+            self.desired_jobs.update_tasks(
+                job.name, JobState.Deploying, deploying)
+
     @lock
     def update_job(self, job, version=None):
         """
@@ -898,6 +1359,7 @@ class ClusterState(object):
         if not job:
             return False
         job.do_update_deployment(self, version)
+        self._store_job(job)
         return True
 
     @lock
@@ -914,8 +1376,7 @@ class ClusterState(object):
             job = self.jobs.get(job)
         else:
             tasks.append(job.name)
-            children = job.find_dependent_jobs()
-            for child in children:
+            for child in self.job_graph.get_dependents(job.name):
                 tasks.append(child.name)
 
         removed = []
@@ -924,13 +1385,31 @@ class ClusterState(object):
         return removed
 
     @lock
-    def persist_jobs(self):
+    def load_jobs(self):
+        """
+        Add the jobs saved in the job store. Should be called after existing
+        machines have been added so their tasks are matched to the jobs.
+
+        @return A list of the names of the jobs that were added.
+        """
+        added = []
+        for data in self.job_store.load():
+            job = ProductionJob.deserialize(data, self.sitter)
+            if self.add_job(job):
+                added.append(job.name)
+        return added
+
+    def _store_job(self, job):
         """
-        Persist jobs to the jobs file.
+        Save or remove a job in the job store depending on whether or not it
+        is persistent.
+
+        @param job The job to store.
         """
-        jobs = [j for j in self.jobs.values() if j.persistent]
-        with open(self.job_file, 'w') as fd:
-            fd.write(simplejson.dumps([j.to_dict() for j in jobs]))
+        if job.persistent:
+            self.job_store.save_job(job.to_dict())
+        else:
+            self.job_store.remove_job(job.name)
 
     @lock
     def start_task(self, machine, task):
@@ -1001,15 +1480,53 @@ class ClusterState(object):
                 (task, machine.hostname))
         return True
 
+    def notify(self, event):
+        """
+        Notify the state calculator of a change. The calculator will run a
+        cycle shortly, coalescing events which arrive close together.
+
+        @param event A short description of the change.
+        """
+        self.scheduler.post(event)
+
+    def notify_action(self, action):
+        """
+        Notify the state calculator that an action finished running. The
+        machine the action ran on is polled right away so that the next cycle
+        sees its result.
+
+        @param action The action that finished.
+        """
+        machine = getattr(action, 'machine', None)
+        if machine is not None:
+            self.expedite_poll([machine])
+        self.notify("action %s" % action.__class__.__name__)
+
+    def expedite_poll(self, machines=None):
+        """
+        Have the machine monitors poll machines as soon as possible. This
+        reads the monitor index directly and does not take the state lock.
+
+        @param machines The machines to poll. Defaults to all machines.
+        """
+        if machines is None:
+            for monitor, _ in self.monitors:
+                monitor.expedite()
+            return
+
+        for machine in machines:
+            monitor = self.machine_monitors.get(machine)
+            if monitor is not None:
+                monitor.expedite([machine])
+
     def calculate_ready_machines(self):
         """
         Convert ready pending machines to active.
         """
-        for machine in self.machines:
-            if (machine['status'] == self.Pending and
-                    machine['machine'].is_initialized()):
-                if self.add_machine_tasks(machine['machine']):
-                    machine['status'] = self.Active
+        for machine in list(self.status_machines.get(self.Pending, ())):
+            if machine.is_initialized():
+                if self.add_machine_tasks(machine):
+                    self.update_machine(machine, self.Active)
 
     def calculate_current_state(self):
         """
@@ -1017,14 +1534,11 @@ class ClusterState(object):
         """
         #TODO: Check providers for new zones.
         zoned_machines = self.get_machines()
-        job_machines = self.current_jobs.get_task_machines()
 
         # Remove missing machines.
-        for zone, machines in job_machines.iteritems():
-            for machine in machines:
-                if (zone not in zoned_machines or
-                        machine not in zoned_machines[zone]):
-                    self.current_jobs.remove_machine(machine)
+        for machine in self.current_jobs.machines.keys():
+            if not self.has_machine(machine):
+                self.current_jobs.remove_machine(machine)
 
         # Update tasks.
         for zone, machines in zoned_machines.iteritems():
@@ -1056,102 +1570,250 @@ class ClusterState(object):
                     self.current_jobs.update_tasks(
                         task, actual_tasks[task], [machine])
 
-    def calculate_job_chains(self):
-        """
-        Generate job chains for use in job deployment.
-        """
-        # Build job chains.
-        job_chains = {}
-        for name, job in self.jobs.iteritems():
-            master = self._get_master_job(job)
-            if not master:
-                continue
-            if master.name not in job_chains:
-                job_chains[master.name] = []
-            if master.name != job.name:
-                job_chains[master.name].append(job.name)
-        self.job_chains = job_chains
-
     def calculate_job_deployment(self):
         """
         Generate the actions necessary to convert the current job state to the
-        desired job state.
-        """
-        # Assign chain tasks to machines.
-        for master, children in self.job_chains.iteritems():
-            # Find machines where the master is running.
+        desired job state. Only tasks which changed since the last cycle are
+        compared, see _get_reconcile_tasks().
+
+        Zones are independent of each other so a deployment plan is computed
+        for each zone, in parallel if deployment_workers is greater than one.
+        Plans are then applied to the desired job state and their actions
+        queued in zone order.
+        """
+        # Gather the inputs of the zone plans.
+        zoned_keys = self._get_reconcile_tasks()
+        zoned_chains = {}
+        for master, children in self.job_graph.chains.iteritems():
+            if not children:
+                continue
             zoned_master_machines = self.desired_jobs.get_task_machines(master)
             for zone, master_machines in zoned_master_machines.iteritems():
-                for child in children:
-                    # Assign child tasks.
-                    machines = []
-                    for machine in master_machines:
-                        tasks = self.desired_jobs.get_machine_tasks(machine)
-                        if child not in tasks:
-                            machines.append(machine)
-                    self.desired_jobs.add_tasks(child, zone, machines)
-
-        # Assign idle machines to pending tasks.
+                zoned_chains.setdefault(zone, []).append(
+                    (master, children, master_machines))
+
         pending_tasks = self.desired_jobs.get_pending_tasks()
-        for zone, tasks in pending_tasks.iteritems():
-            for master, required in tasks.iteritems():
-                if required > 0:
-                    master_job = self.get_job(master)
+        zones = sorted(
+            set(zoned_keys.keys()) | set(zoned_chains.keys()) |
+            set(pending_tasks.keys()))
+
+        def plan(zone):
+            return self._plan_zone_deployment(
+                zone, zoned_keys.get(zone, set()), zoned_chains.get(zone, []),
+                pending_tasks.get(zone, {}))
+
+        if self.deployment_workers > 1 and len(zones) > 1:
+            if self.pool is None:
+                self.pool = ThreadPool(self.deployment_workers)
+            plans = self.pool.map(plan, zones)
+        else:
+            plans = [plan(zone) for zone in zones]
+
+        # Merge the plans. Operations which go with an action are only
+        # applied if the action is queued, a duplicate of a recently completed
+        # action is dropped and must not leave its task deploying.
+        for operations, actions in plans:
+            for method, args in operations:
+                getattr(self.desired_jobs, method)(*args)
+            for action, action_operations in actions:
+                if self.actions.add(action):
+                    for method, args in action_operations:
+                        getattr(self.desired_jobs, method)(*args)
+
+    def _get_task_demand(self, name, zone):
+        """
+        Get the resources required by an instance of a task.
+
+        @param name The name of the task.
+        @param zone The zone the task is deployed to.
+        @return A two-tuple of cpu and memory in MB.
+        """
+        job = self.get_job(name)
+        if not job:
+            return DEFAULT_DEMAND
+        return job.get_resource_demand(zone)
 
-                    # Find some idle machines.
-                    idle_machines = self.get_machines(
-                        zones=[zone], idle=True)[zone]
-                    idle_machines = idle_machines[:required]
-                    required = required - len(idle_machines)
+    def _get_chain_demand(self, master, zone):
+        """
+        Get the resources required by an instance of a job chain. Child jobs
+        are always placed with their master so they are packed as a unit.
 
-                    # Assign idle machines to task chain.
-                    self.desired_jobs.set_pending_machines(
-                        zone, master, idle_machines)
+        @param master The name of the master job of the chain.
+        @param zone The zone the chain is deployed to.
+        @return A two-tuple of cpu and memory in MB.
+        """
+        cpu, mem = self._get_task_demand(master, zone)
+        for child in self.job_graph.get_chain(master):
+            child_cpu, child_mem = self._get_task_demand(child, zone)
+            cpu += child_cpu
+            mem += child_mem
+        return (cpu, mem)
 
-                    # Deploy master job to new machines.
-                    self.desired_jobs.set_pending_deploying(
-                        zone, master, required)
-                    for n in range(required):
-                        self.actions.add(
-                            DeployMachineAction(self.sitter, zone, master_job))
+    def _get_zone_packer(self, zone):
+        """
+        Build a packer for the active machines in a zone. The free resources
+        of each machine are its configured cpu and memory less the demand of
+        the tasks in the desired job state on the machine.
+
+        @param zone The zone to build the packer for.
+        @return A ResourcePacker.
+        """
+        packer = ResourcePacker()
+        demands = {}
+        machines = (
+            self.zone_machines.get(zone, set()) &
+            self.status_machines.get(self.Active, set()))
+        for machine in machines:
+            cpu = machine.config.cpus
+            mem = machine.config.mem
+            names = self.desired_jobs.get_machine_tasks(machine)
+            for name in names:
+                if name not in demands:
+                    demands[name] = self._get_task_demand(name, zone)
+                cpu -= demands[name][0]
+                mem -= demands[name][1]
+            packer.add_machine(machine, cpu, mem, names)
+        return packer
+
+    def _plan_zone_deployment(self, zone, keys, chains, pending_tasks):
+        """
+        Plan job deployment for a zone. The plan is computed from the current
+        state without modifying it and without taking the state lock, so plans
+        for different zones may be computed concurrently.
+
+        @param zone The zone to plan for.
+        @param keys The (name, machine) task keys in the zone to diff.
+        @param chains A list of (master, children, master_machines) tuples for
+            the job chains in the zone.
+        @param pending_tasks A dictionary of task name/required machine count
+            mappings for the zone.
+        @return A two-tuple containing a list of (method, args) operations to
+            apply to the desired job state and a list of (action, operations)
+            tuples, the actions to queue along with the operations to apply
+            if the action is queued.
+        """
+        operations = []
+        actions = []
+
+        # Tasks added to the desired state by this plan and their status.
+        planned = {}
+
+        # Assign chain tasks to machines.
+        for master, children, master_machines in chains:
+            for child in children:
+                machines = []
+                for machine in master_machines:
+                    if not self.desired_jobs.has_task(child, machine):
+                        machines.append(machine)
+                        planned[(child, machine)] = JobState.Running
+                if machines:
+                    operations.append(('add_tasks', (child, zone, machines)))
+
+        # Pack pending tasks onto machines with free resources.
+        requests = []
+        for master, required in sorted(pending_tasks.iteritems()):
+            if required > 0:
+                cpu, mem = self._get_chain_demand(master, zone)
+                requests.extend([(master, cpu, mem)] * required)
+
+        if requests:
+            packer = self._get_zone_packer(zone)
+            placements, unplaced = packer.pack(requests)
+            for master in sorted(set([r[0] for r in requests])):
+                machines = placements.get(master, [])
+                required = unplaced.get(master, 0)
+                if machines:
+                    operations.append(
+                        ('set_pending_machines', (zone, master, machines)))
+                    for machine in machines:
+                        planned[(master, machine)] = JobState.Running
+
+                # Deploy master job to new machines for the remainder.
+                if required:
+                    master_job = self.get_job(master)
+                    operations.append(
+                        ('set_pending_deploying', (zone, master, required)))
+                    actions.append((DeployMachineAction(
+                        self.sitter, zone, master_job, required), []))
 
         # Calculate changes to existing tasks.
-        def filter_valid_tasks(tasks):
-            return set([t for t in tasks if t[2] in self.jobs])
-        desired_tasks = filter_valid_tasks(self.desired_jobs.flatten())
-        current_tasks = filter_valid_tasks(self.current_jobs.flatten())
-
-        add_tasks = desired_tasks - current_tasks
-        remove_tasks = current_tasks - desired_tasks
-        check_tasks = desired_tasks & current_tasks
-
-        # Add actions for existing tasks.
-        for task in add_tasks:
-            if not self.desired_jobs.is_task_deploying(task[2], task[1]):
-                self.desired_jobs.update_tasks(
-                    task[2], JobState.Deploying, [task[1]])
-                self.actions.add(AddTaskAction(self.sitter, *task))
-
-        for task in remove_tasks:
-            #TODO: Remove status check when undeploying job code works.
-            if (self.current_jobs.get_task_status(task[2], task[1]) ==
-                    JobState.Stopped):
+        for name, machine in keys | set(planned.keys()):
+            desired_status = planned.get((name, machine))
+            if desired_status is None:
+                desired_status = self.desired_jobs.get_task_status(
+                    name, machine)
+            current_status = self.current_jobs.get_task_status(name, machine)
+            if desired_status is None and current_status is None:
                 continue
-            if self.is_machine_mutable(task[1]):
-                self.actions.add(RemoveTaskAction(self.sitter, *task))
 
-        for task in check_tasks:
-            if (not self.desired_jobs.is_task_deploying(task[2], task[1])
-                    and self.is_machine_mutable(task[1])):
-                desired_status = self.desired_jobs.get_task_status(
-                    task[2], task[1])
-                current_status = self.current_jobs.get_task_status(
-                    task[2], task[1])
-                if desired_status != current_status:
-                    if desired_status == JobState.Running:
-                        self.actions.add(StartTaskAction(self.sitter, *task))
-                    else:
-                        self.actions.add(StopTaskAction(self.sitter, *task))
+            if current_status is None:
+                # Add actions for new tasks.
+                if desired_status != JobState.Deploying:
+                    actions.append((
+                        AddTaskAction(self.sitter, zone, machine, name,
+                                      self.job_revisions.get(name)),
+                        [('update_tasks',
+                          (name, JobState.Deploying, [machine]))]))
+            elif desired_status is None:
+                #TODO: Remove status check when undeploying job code works.
+                if current_status == JobState.Stopped:
+                    continue
+                if self.is_machine_mutable(machine):
+                    actions.append((
+                        RemoveTaskAction(self.sitter, zone, machine, name),
+                        []))
+            elif (desired_status != JobState.Deploying and
+                    desired_status != current_status and
+                    self.is_machine_mutable(machine)):
+                if desired_status == JobState.Running:
+                    actions.append((
+                        StartTaskAction(self.sitter, zone, machine, name), []))
+                else:
+                    actions.append((
+                        StopTaskAction(self.sitter, zone, machine, name), []))
+
+        # Keep the action order independent of set ordering.
+        actions.sort(key=lambda item: str(item[0]))
+        return (operations, actions)
+
+    def _get_reconcile_tasks(self):
+        """
+        Get the tasks to diff between the desired and current job states. This
+        is normally the set of tasks journaled as changed since the last
+        cycle. A full reconcile of every task is done periodically as a safety
+        net and whenever the set of jobs changes.
+
+        Tasks which do not have a job object are left out.
+
+        @return A dictionary of zone/task key set mappings. Task keys are
+            (name, machine) tuples.
+        """
+        dirty = self.desired_jobs.pop_dirty() | self.current_jobs.pop_dirty()
+        job_names = set(self.jobs.keys())
+        if self.reconcile_countdown > 0 and job_names == self.reconcile_jobs:
+            self.reconcile_countdown -= 1
+            zoned_keys = {}
+            for key in dirty:
+                name, machine = key
+                if name not in self.jobs:
+                    continue
+                zone = (self.desired_jobs.get_task_zone(name, machine) or
+                        self.current_jobs.get_task_zone(name, machine))
+                if zone:
+                    zoned_keys.setdefault(zone, set()).add(key)
+            return zoned_keys
+
+        logger.debug("running a full job state reconcile")
+        self.reconcile_countdown = self.full_reconcile_interval
+        self.reconcile_jobs = job_names
+        zoned_keys = self.desired_jobs.get_zoned_task_keys(job_names)
+        current_keys = self.current_jobs.get_zoned_task_keys(job_names)
+        for zone, keys in current_keys.iteritems():
+            if zone in zoned_keys:
+                zoned_keys[zone] |= keys
+            else:
+                zoned_keys[zone] = keys
+        return zoned_keys
 
     def calculate_idle_cleanup(self):
         """
@@ -1180,11 +1842,13 @@ class ClusterState(object):
         machines. Also remove finished repair jobs.
         """
         for job in self.jobs.values():
-            master = self._get_master_job(job)
-            if (master and not self.desired_jobs.has_task(master.name) and
+            # Jobs whose master was removed have no master.
+            master = self.job_graph.get_master(job.name)
+            if (not master or
+                    not self.desired_jobs.has_task(master.name) and
                     not self.current_jobs.has_task(master.name)):
-                del self.jobs[job.name]
-        self.persist_jobs()
+                self.job_graph.remove_job(job.name)
+                self.job_store.remove_job(job.name)
 
         for name, job in dict(self.repair_jobs).iteritems():
             remove = True
@@ -1211,17 +1875,210 @@ class ClusterState(object):
     @lock
     def calculate(self):
         """
-        Handle all state calculations.
+        Handle all state calculations. Each phase is timed by the profiler.
+        """
+        self.profiler.start_cycle()
+        try:
+            for phase in self.phases:
+                self.profiler.run_phase(phase, getattr(self, phase))
+        finally:
+            self.profiler.end_cycle(self.actions.pending)
+
+    def checkpoint_state(self):
+        """
+        Checkpoint the state if the checkpoint interval has passed. The
+        checkpoint is written to disk in the background.
+        """
+        if time.time() - self.last_checkpoint >= self.checkpoint_interval:
+            self.save_checkpoint(wait=False)
+
+    def rebalance_monitors(self):
+        """
+        Scale the machine monitors and move machines off lagging monitors if
+        the rebalance interval has passed. Only done while the calculator is
+        running since new monitors are started right away.
+        """
+        if not self.running:
+            return
+        if time.time() - self.last_rebalance < self.rebalance_interval:
+            return
+        self.last_rebalance = time.time()
+        self.scale_monitors()
+        self.steal_machines()
+
+    @lock
+    def scale_monitors(self):
+        """
+        Add or remove machine monitors to fit the number of machines. New
+        monitors take an even share of the machines from the fullest
+        monitors.
+
+        @return The change in the number of monitors.
+        """
+        count = len(self.machine_monitors)
+        wanted = (count + self.machines_per_monitor - 1) / \
+            self.machines_per_monitor
+        wanted = min(max(wanted, self.min_monitors), self.max_monitors)
+        change = wanted - len(self.monitors)
+
+        if change < 0:
+            for _ in range(-change):
+                monitor = min([m for m, _ in self.monitors],
+                              key=lambda m: m.num_monitored_machines())
+                self.remove_monitor(monitor)
+        elif change > 0:
+            monitors = [m for m, _ in self.monitors]
+            new_monitors = [
+                self.add_monitor(start=self.running) for _ in range(change)]
+            share = count / wanted
+            for target in new_monitors:
+                while target.num_monitored_machines() < share:
+                    source = max(monitors,
+                                 key=lambda m: m.num_monitored_machines())
+                    needed = share - target.num_monitored_machines()
+                    excess = source.num_monitored_machines() - share
+                    candidates = source.get_migration_candidates(
+                        min(needed, excess))
+                    if excess <= 0 or not candidates:
+                        break
+                    for machine in candidates:
+                        self._move_machine(machine, source, target)
+
+        if change:
+            logger.info(
+                "scaled machine monitors by %s to %s for %s machines" %
+                (change, len(self.monitors), count))
+        return change
+
+    @lock
+    def steal_machines(self):
+        """
+        Move a quarter of the machines of each lagging monitor to the monitors
+        which are keeping up, emptiest first.
+
+        @return The number of machines moved.
+        """
+        monitors = [m for m, _ in self.monitors]
+        lagging = [m for m in monitors
+                   if m.get_lag() > self.monitor_lag_threshold]
+        idle = [m for m in monitors if m not in lagging]
+        if not lagging or not idle:
+            return 0
+
+        moved = 0
+        for source in lagging:
+            count = source.num_monitored_machines() / 4
+            for machine in source.get_migration_candidates(count):
+                target = min(idle, key=lambda m: m.num_monitored_machines())
+                if self._move_machine(machine, source, target):
+                    moved += 1
+            logger.info(
+                "moved %s machines off monitor %s lagging by %.1fs" %
+                (count, source.number, source.get_lag()))
+        return moved
+
+    @lock
+    def save_checkpoint(self, wait=True):
+        """
+        Save a checkpoint of the state to disk. Only one checkpoint is written
+        at a time.
+
+        @param wait Write the checkpoint before returning. Defaults to True.
+            Otherwise the checkpoint is written by a background thread.
+        @return True if the checkpoint was written or is being written, or
+            False on failure or if a checkpoint is already being written.
+        """
+        if self.checkpoint_thread and self.checkpoint_thread.is_alive():
+            if not wait:
+                return False
+            self.checkpoint_thread.join()
+
+        self.last_checkpoint = time.time()
+        data = self.checkpoint.dump(self)
+        if wait:
+            return self.checkpoint.save(data)
+        self.checkpoint_thread = Thread(
+            target=self.checkpoint.save, args=(data,), name="Checkpoint")
+        self.checkpoint_thread.start()
+        return True
+
+    @lock
+    def restore_checkpoint(self, machines):
+        """
+        Restore machines and their tasks from the last checkpoint. Only active
+        and maintenance machines with a known sitter are restored. They are
+        monitored without probing for their sitter and their desired tasks
+        are restored without reloading the machine. The machine monitors
+        revalidate them on their next poll and the current job state is
+        rebuilt from their last known tasks by the next calculate cycle.
+
+        Machines which were not restored should be added as usual. Tasks
+        without machines are restored as waiting for a machine.
+
+        @param machines The machines listed by the providers. Machines in the
+            checkpoint which are no longer listed are dropped.
+        @return A list of the machines that were not restored.
+        """
+        data = self.checkpoint.load()
+        if not data:
+            return list(machines)
+
+        saved = dict([(m['hostname'], m) for m in data['machines']])
+        restored = {}
+        remaining = []
+        for machine in machines:
+            if not isinstance(machine, MonitoredMachine):
+                machine = MonitoredMachine(machine)
+            item = saved.get(machine.hostname)
+            if (not item or not item['portnum'] or
+                    item['status'] not in (self.Active, self.Maintenance)):
+                remaining.append(machine)
+                continue
+
+            tasks = dict([
+                (name, {'name': name, 'running': running})
+                for name, running in item['tasks'].iteritems()])
+            machine.restore(item['portnum'], tasks)
+            machine.config.dns_name = item['dns_name']
+            self.monitor_machine(machine)
+            self.add_machine(machine, status=item['status'])
+            restored[machine.hostname] = machine
+
+        # Actions in progress did not survive the restart. Tasks they were
+        # deploying are planned again.
+        for hostname, machine in restored.iteritems():
+            zone = machine.config.shared_fate_zone
+            for name, status in saved[hostname]['desired'].iteritems():
+                if status == JobState.Deploying:
+                    status = JobState.Running
+                self.desired_jobs.add_tasks(
+                    name, zone, [machine], status=status)
+        for name, zone, status in data['pending']:
+            if status == JobState.Deploying:
+                status = JobState.Running
+            self.desired_jobs.add_tasks(name, zone, [], 1, status)
+
+        logger.info(
+            "restored %s of %s machines from checkpoint taken at %s" %
+            (len(restored), len(saved), time.ctime(data['time'])))
+        if data['repairs'] or data['fillers']:
+            logger.info(
+                "repairs %s and fillers %s in progress at checkpoint will be "
+                "redone" % (data['repairs'], data['fillers']))
+        return remaining
+
+    @lock
+    def publish_snapshot(self):
+        """
+        Publish a new read-only snapshot of the cluster state.
 
-        @return Actions generated by the state calculations.
+        @return The new snapshot.
         """
-        self.calculate_ready_machines()
-        self.calculate_current_state()
-        self.calculate_job_chains()
-        self.calculate_job_deployment()
-        self.calculate_job_cleanup()
-        self.calculate_idle_cleanup()
-        self.calculate_unreachable_machines()
+        version = 1
+        if self.snapshot:
+            version = self.snapshot.version + 1
+        self.snapshot = ClusterSnapshot(version, self)
+        return self.snapshot
 
     def process(self):
         """
@@ -1244,16 +2101,18 @@ class ClusterState(object):
 
     def start(self):
         """
-        Run the state calculator until stopped.
+        Run the state calculator until stopped. A cycle is run whenever a
+        change is posted with notify() and at least every self.sleep seconds.
         """
         def run_loop():
             while self.running:
                 self.run()
-                time.sleep(self.sleep)
+                self.scheduler.wait()
 
         if self.thread is None or not self.thread.is_alive():
             self.thread = Thread(target=run_loop, name="Calculator")
         self.running = True
+        self.profiler.start_watchdog()
         self.thread.start()
 
     def stop(self, timeout=None):
@@ -1261,4 +2120,10 @@ class ClusterState(object):
         Stop the state calculator.
         """
         self.running = False
+        self.profiler.stop_watchdog()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        self.notify("stop")
         self.thread.join()
+        self.save_checkpoint()
@@ -19,24 +19,56 @@ class ClusterStats(StatsCollector):
         else:
             return data
 
+    def calc_stats(self, args):
+        """
+        Timing statistics for the state calculator, action workers, machine
+        monitors, telemetry and provider rate limits.
+        """
+        stats = self.harness.state.profiler.get_stats()
+        stats['action_workers'] = self.harness.state.actions.get_stats()
+        stats['monitors'] = [
+            monitor.get_stats()
+            for monitor, thread in self.harness.state.monitors]
+        stats['rate_limits'] = dict([
+            (name, bucket.get_stats())
+            for name, bucket in self.harness.rate_limits.iteritems()])
+        if self.harness.telemetry is not None:
+            stats['telemetry'] = self.harness.telemetry.get_stats()
+        return stats
+
+    def actions(self, args):
+        """
+        Latency statistics by action type and the recently finished actions.
+        """
+        data = self.harness.state.actions.get_trace()
+        data['stats'] = self.harness.state.actions.get_stats()
+        if "nohtml" in args:
+            return data
+
+        engine = args['engine']
+        return engine.render('actions.html', {'data': data})
+
     def get_live_data(self):
         data = {}
 
         data['events'] = ClusterEventManager.get_events()
 
+        # Read from the last published snapshot so that we never wait on a
+        # running calculate cycle.
         state = self.harness.state
-        job_fill, job_machine_fill = state.current_jobs.get_job_fill()
-        idle_machines = []
-        zoned_idle_machines = state.get_machines(idle=True)
-        for zone, machines in zoned_idle_machines.iteritems():
-            idle_machines.extend(machines)
+        snapshot = state.snapshot
+        job_fill = snapshot.job_fill
+        job_machine_fill = snapshot.job_fill_machines
 
+        data['snapshot_version'] = snapshot.version
+        data['snapshot_time'] = snapshot.timestamp
         data['providers'] = state.get_providers().keys()
-        data['machines_by_zone'] = str(state.get_machines())
+        data['machines_by_zone'] = str(snapshot.machines)
         data['job_fill'] = str(job_fill)
-        data['idle_machines'] = str(state.get_machines(idle=True))
+        data['idle_machines'] = str(snapshot.idle_machines)
         data['unreachable_machines'] = [
-            str(m) for m in state.get_machines(unreachable=True)]
+            str(m) for machines in snapshot.unreachable_machines.values()
+            for m in machines]
 
         monitors = []
         machines = []
@@ -46,19 +78,17 @@ class ClusterStats(StatsCollector):
             monitor_data['monitored_machines'] = [
                 repr(m) for m in monitor.monitored_machines]
             monitor_data['add_queue'] = [repr(m) for m in monitor.add_queue]
+            pull_failures = monitor.get_pull_failures()
             monitor_data['pull_failures'] = dict([
-                (str(k), v) for k, v in monitor.pull_failures.iteritems()])
+                (str(k), v) for k, v in pull_failures.iteritems()])
             monitor_data['failure_threshold'] = monitor.failure_threshold
             monitor_data['number'] = monitor.number
             monitors.append(monitor_data)
 
-            pull_failures = dict(monitor.pull_failures)
-
             for machine in monitor.monitored_machines:
                 machine_data = machine.serialize()
                 machine_data['pull_failures'] = pull_failures.get(machine, 0)
-                machine_data['idle'] = machine in (zoned_idle_machines.get(
-                    machine_data['config']['shared_fate_zone'], []))
+                machine_data['idle'] = snapshot.is_machine_idle(machine)
 
                 machines.append(machine_data)
 
@@ -66,7 +96,7 @@ class ClusterStats(StatsCollector):
         data['monitors'] = monitors
 
         jobs = []
-        check_jobs = state.jobs.values() + state.repair_jobs.values()
+        check_jobs = snapshot.jobs.values() + snapshot.repair_jobs.values()
         for job in check_jobs:
             job_data = {}
             job_data['name'] = job.name
@@ -90,9 +120,9 @@ class ClusterStats(StatsCollector):
             job_data['fillers'] = fillers
             job_data['fill'] = job_fill.get(job.name, {})
 
-            fill_machines = job_machine_fill.get(job.name, {})
-            for zone in fill_machines.keys():
-                fill_machines[zone] = [str(m) for m in fill_machines[zone]]
+            fill_machines = {}
+            for zone, machines in job_machine_fill.get(job.name, {}).items():
+                fill_machines[zone] = [str(m) for m in machines]
 
             job_data['fill_machines'] = fill_machines
 
@@ -111,8 +141,8 @@ class ClusterStats(StatsCollector):
         threads = {}
 
         std_threads = ['MainThread', 'Calculator', 'HTTPServer']
-        for i in range(self.harness.worker_thread_count):
-            std_threads.append("Monitoring-%s" % i)
+        for monitor, thread in self.harness.state.monitors:
+            std_threads.append(thread.getName())
 
         for name in std_threads:
             if name in alive_thread_names:
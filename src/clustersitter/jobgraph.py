@@ -0,0 +1,208 @@
+"""
+Job dependency tracking.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class JobGraph(object):
+    """
+    Track the links between jobs. A job may be linked to another job, in
+    which case it is always deployed to the same machines as that job. Linked
+    jobs form chains which are rooted at a master job that is not linked to
+    anything.
+
+    The graph is updated incrementally as jobs are added and removed so that
+    looking up the master, chain or dependents of a job does not need to
+    walk the job links. Adding a job that would create a cycle of links is
+    refused.
+    """
+
+    def __init__(self):
+        """
+        Initialize an empty graph.
+
+        The graph is structured as follows:
+
+            jobs = {
+                name: job_object,
+            }
+
+            dependents = {
+                linked_job_name: set([name]),
+            }
+
+            masters = {
+                name: master_name,
+            }
+
+            chains = {
+                master_name: set([name]),
+            }
+
+        Dependents are kept for links to jobs which are not in the graph so
+        that they are reattached when the linked job is added. Jobs which link
+        to a missing job have no master and are not part of any chain.
+        """
+        self.jobs = {}
+        self.dependents = {}
+        self.masters = {}
+        self.chains = {}
+
+    def _find_master(self, name):
+        """
+        Walk the links from a job to its master.
+
+        @return The name of the master job or None if the chain is broken.
+        """
+        seen = set()
+        while name not in seen:
+            seen.add(name)
+            job = self.jobs.get(name)
+            if job is None:
+                return None
+            if not job.linked_job:
+                return name
+            name = job.linked_job
+        return None
+
+    def _get_descendants(self, name):
+        """
+        Get a job and all of the jobs linked to it, directly or not.
+
+        @return A set of job names.
+        """
+        descendants = set([name])
+        queue = [name]
+        while queue:
+            for dependent in self.dependents.get(queue.pop(), ()):
+                if dependent not in descendants:
+                    descendants.add(dependent)
+                    queue.append(dependent)
+        return descendants
+
+    def _reindex(self, names):
+        """
+        Recalculate the masters and chains of the given jobs.
+        """
+        for name in names:
+            master = self.masters.pop(name, None)
+            if master == name:
+                self.chains.pop(name, None)
+            elif master in self.chains:
+                self.chains[master].discard(name)
+
+        for name in names:
+            master = self._find_master(name)
+            if master is None:
+                continue
+            self.masters[name] = master
+            chain = self.chains.setdefault(master, set())
+            if master != name:
+                chain.add(name)
+
+    def has_cycle(self, job):
+        """
+        Check if adding a job would create a cycle of links.
+
+        @param job The job to check.
+        @return True if the job would create a cycle or False.
+        """
+        seen = set()
+        name = job.linked_job
+        while name and name not in seen:
+            if name == job.name:
+                return True
+            seen.add(name)
+            linked = self.jobs.get(name)
+            name = linked and linked.linked_job
+        return False
+
+    def add_job(self, job):
+        """
+        Add a job to the graph. An existing job with the same name is
+        replaced.
+
+        @param job The job to add.
+        @return True if the job was added or False if it would create a cycle.
+        """
+        if self.has_cycle(job):
+            logger.error(
+                "job '%s' linked to '%s' creates a cycle" %
+                (job.name, job.linked_job))
+            return False
+
+        old_job = self.jobs.get(job.name)
+        if old_job is not None and old_job.linked_job:
+            self._remove_dependent(old_job)
+        self.jobs[job.name] = job
+        if job.linked_job:
+            self.dependents.setdefault(job.linked_job, set()).add(job.name)
+        self._reindex(self._get_descendants(job.name))
+        return True
+
+    def _remove_dependent(self, job):
+        """Remove a job from the dependents of its linked job."""
+        dependents = self.dependents.get(job.linked_job)
+        if dependents is not None:
+            dependents.discard(job.name)
+            if not dependents:
+                del self.dependents[job.linked_job]
+
+    def remove_job(self, name):
+        """
+        Remove a job from the graph. Jobs linked to it are left without a
+        master until it is added again.
+
+        @param name The name of the job to remove.
+        @return True if the job was removed or False if it was not present.
+        """
+        job = self.jobs.pop(name, None)
+        if job is None:
+            return False
+        if job.linked_job:
+            self._remove_dependent(job)
+        self._reindex(self._get_descendants(name))
+        return True
+
+    def get_job(self, name):
+        """
+        Get a job by name.
+
+        @return The job object or None if it does not exist.
+        """
+        return self.jobs.get(name)
+
+    def get_master(self, name):
+        """
+        Get the master of a job's chain.
+
+        @param name The name of the job.
+        @return The master job object, which is the job itself for masters,
+            or None if the job is not present or its chain is broken.
+        """
+        return self.jobs.get(self.masters.get(name))
+
+    def get_chain(self, master):
+        """
+        Get the jobs in a master job's chain.
+
+        @param master The name of the master job.
+        @return A sorted list of the names of the jobs in the chain, not
+            including the master.
+        """
+        return sorted(self.chains.get(master, ()))
+
+    def get_dependents(self, name):
+        """
+        Get the jobs directly linked to a job.
+
+        @param name The name of the job.
+        @return A list of job objects.
+        """
+        return [
+            self.jobs[dependent]
+            for dependent in sorted(self.dependents.get(name, ()))
+            if dependent in self.jobs]
@@ -0,0 +1,202 @@
+"""
+Job definition persistence.
+"""
+
+import logging
+import os
+import traceback
+
+import simplejson
+
+logger = logging.getLogger(__name__)
+
+
+class JobStore(object):
+    """
+    Persist job definitions to disk. The store is made up of a snapshot file,
+    which holds a list of job definitions, and a journal of changes made since
+    the snapshot was written. Each change is appended to the journal as a
+    single line of JSON and synced to disk before returning. Once the journal
+    grows past compact_after records it is folded into a new snapshot.
+
+    Only changes are written. Saving a job definition that matches the last
+    one written for that job does nothing.
+
+    The store does no locking of its own, callers are expected to serialize
+    access.
+    """
+
+    def __init__(self, location, compact_after=100):
+        """
+        Initialize the store.
+
+        @param location The directory to keep the snapshot and journal in.
+        @param compact_after The number of journal records to allow before
+            compacting. Defaults to 100.
+        """
+        self.snapshot_file = os.path.join(location, "jobs.json")
+        self.journal_file = os.path.join(location, "jobs.journal")
+        self.compact_after = compact_after
+        self.journal_records = 0
+        self.jobs = {}
+
+    def _read_snapshot(self):
+        """
+        Read the job definitions in the snapshot file.
+
+        @return A list of job definitions.
+        """
+        if not os.path.exists(self.snapshot_file):
+            return []
+        try:
+            with open(self.snapshot_file) as fd:
+                return simplejson.loads(fd.read())
+        except (IOError, ValueError):
+            logger.error(
+                "failed to read job snapshot '%s'" % self.snapshot_file)
+            logger.error(traceback.format_exc())
+            return []
+
+    def _read_journal(self):
+        """
+        Read the records in the journal file. A record which fails to parse,
+        such as one left partially written by a crash, is skipped.
+
+        @return A list of journal records.
+        """
+        if not os.path.exists(self.journal_file):
+            return []
+        records = []
+        with open(self.journal_file) as fd:
+            for number, line in enumerate(fd):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(simplejson.loads(line))
+                except ValueError:
+                    logger.warn(
+                        "skipping corrupt job journal record on line %s" %
+                        (number + 1))
+        return records
+
+    def _write_file(self, path, data):
+        """
+        Atomically replace a file. The data is written to a temporary file
+        which is synced and then renamed over the original.
+
+        @param path The path of the file to replace.
+        @param data The new contents of the file.
+        """
+        temp_path = "%s.tmp" % path
+        with open(temp_path, 'w') as fd:
+            fd.write(data)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.rename(temp_path, path)
+
+    def _append(self, record):
+        """
+        Append a record to the journal and sync it to disk.
+
+        @param record The record to append.
+        @return True on success or False if the record could not be written.
+        """
+        try:
+            with open(self.journal_file, 'a') as fd:
+                fd.write(simplejson.dumps(record) + "\n")
+                fd.flush()
+                os.fsync(fd.fileno())
+        except (IOError, OSError):
+            logger.error(
+                "failed to write job journal '%s'" % self.journal_file)
+            logger.error(traceback.format_exc())
+            return False
+
+        self.journal_records += 1
+        return True
+
+    def _check_compact(self):
+        """Compact the journal if it has grown too large."""
+        if self.journal_records >= self.compact_after:
+            self.compact()
+
+    def load(self):
+        """
+        Load the job definitions from disk. The journal is replayed on top of
+        the snapshot and then compacted.
+
+        @return A list of job definitions.
+        """
+        self.jobs = {}
+        for job in self._read_snapshot():
+            self.jobs[job['task_configuration']['name']] = job
+
+        records = self._read_journal()
+        for record in records:
+            if record['op'] == 'remove':
+                self.jobs.pop(record['name'], None)
+            else:
+                self.jobs[record['name']] = record['job']
+
+        if records:
+            self.compact()
+        return [self.jobs[name] for name in sorted(self.jobs)]
+
+    def compact(self):
+        """
+        Write all job definitions to the snapshot and clear the journal.
+
+        @return True on success or False on failure.
+        """
+        jobs = [self.jobs[name] for name in sorted(self.jobs)]
+        try:
+            self._write_file(self.snapshot_file, simplejson.dumps(jobs))
+            # Replaying the journal over the new snapshot is harmless so it
+            # is fine to crash before it is cleared.
+            self._write_file(self.journal_file, "")
+        except (IOError, OSError):
+            logger.error("failed to compact job store")
+            logger.error(traceback.format_exc())
+            return False
+        self.journal_records = 0
+        return True
+
+    def save_job(self, job):
+        """
+        Save a job definition if it has changed.
+
+        @param job The job definition, see ProductionJob.to_dict().
+        @return True if the job was written or False if it was unchanged or
+            could not be written.
+        """
+        name = job['task_configuration']['name']
+        # Keep a copy so later changes to the job are seen as changes.
+        job = simplejson.loads(simplejson.dumps(job))
+        if self.jobs.get(name) == job:
+            return False
+        if name in self.jobs:
+            op = 'update'
+        else:
+            op = 'add'
+        if not self._append({'op': op, 'name': name, 'job': job}):
+            return False
+        self.jobs[name] = job
+        self._check_compact()
+        return True
+
+    def remove_job(self, name):
+        """
+        Remove a job definition.
+
+        @param name The name of the job to remove.
+        @return True if the job was removed or False if it was not present or
+            could not be removed.
+        """
+        if name not in self.jobs:
+            return False
+        if not self._append({'op': 'remove', 'name': name}):
+            return False
+        del self.jobs[name]
+        self._check_compact()
+        return True
@@ -1,7 +1,13 @@
+import heapq
 import logging
+import random
+import threading
 import time
 from datetime import datetime
 
+from calcstats import RollingHistogram
+from pollengine import PollEngine
+
 logger = logging.getLogger(__name__)
 
 
@@ -13,8 +19,39 @@ class MachineMonitor:
         # amoung threads
         self.monitored_machines = [m for m in monitored_machines]
         self.add_queue = []
+        # Every machine in monitored_machines or add_queue.
+        self.members = set(self.monitored_machines)
+        self.running = True
         self.pull_failures = {}
+        # Guards changes to the members and their pull failures, which are
+        # made by the cluster state as well as the monitor thread. Never
+        # held while calling into the cluster state.
+        self.lock = threading.RLock()
         self.failure_threshold = 5
+        self.failing_since = {}
+        self.engine = None
+
+        # Each machine is polled on its own schedule. Machines which are
+        # deploying, failing or changing are polled every min_poll_interval
+        # seconds. Stable machines back off from stats_poll_interval up to
+        # max_poll_interval. Deadlines are jittered by poll_jitter so that
+        # machines do not stay in lockstep.
+        self.min_poll_interval = 1
+        self.max_poll_interval = 6 * parent.stats_poll_interval
+        self.poll_backoff = 2
+        self.poll_jitter = 0.2
+        self.poll_intervals = {}
+        self.poll_entries = {}
+        self.poll_queue = []
+        self.poll_sequence = 0
+        self.expedited = []
+        self.wakeup = threading.Event()
+
+        # Time spent on each cycle, and how late the most overdue poll of
+        # each cycle ran. A monitor with more machines than it can keep up
+        # with shows up as lag.
+        self.cycle_times = RollingHistogram(20)
+        self.lag = RollingHistogram(20)
 
         logger.info(
             "Initialized a machine monitor for %s" %
@@ -30,9 +67,7 @@ class MachineMonitor:
         @param monitored_machine The machine to check for.
         @return True if the monitor has the machine or False.
         """
-        return (
-            monitored_machine in self.monitored_machines or
-            monitored_machine in self.add_queue)
+        return monitored_machine in self.members
 
     def remove_machine(self, monitored_machine):
         """
@@ -42,35 +77,179 @@ class MachineMonitor:
         @return True if the machine was removed or False if the machine was not
             being monitored.
         """
-        if monitored_machine in self.add_queue:
-            self.add_queue.remove(monitored_machine)
-            return True
-        if monitored_machine in self.monitored_machines:
-            self.monitored_machines.remove(monitored_machine)
-            if monitored_machine in self.pull_failures:
-                del self.pull_failures[monitored_machine]
-            return True
-        return False
+        with self.lock:
+            if monitored_machine not in self.members:
+                return False
+            self.members.discard(monitored_machine)
+            self.pull_failures.pop(monitored_machine, None)
+            self.failing_since.pop(monitored_machine, None)
+            self.poll_intervals.pop(monitored_machine, None)
+            if monitored_machine in self.add_queue:
+                self.add_queue.remove(monitored_machine)
+                return True
+            if monitored_machine in self.monitored_machines:
+                self.monitored_machines.remove(monitored_machine)
+                self.poll_entries.pop(monitored_machine, None)
+                return True
+            return False
 
-    def add_machine(self, monitored_machine):
+    def get_poll_history(self, monitored_machine):
+        """
+        Get the poll history of a machine, so that it can be carried over
+        when the machine moves to another monitor.
+
+        @param monitored_machine The machine.
+        @return A (pull failures, failing since, poll interval) tuple. The
+            last two are None if unknown.
+        """
+        with self.lock:
+            return (self.pull_failures.get(monitored_machine, 0),
+                    self.failing_since.get(monitored_machine),
+                    self.poll_intervals.get(monitored_machine))
+
+    def add_machine(self, monitored_machine, history=None):
         """
         Add a machine to the monitor.
 
         @param monitored_machine The machine to add to the monitor.
+        @param history The poll history of the machine on its previous
+            monitor, see get_poll_history(). Optional.
         @return True if the machine is added to monitoring or False if the
             machine is already being monitored.
         """
-        if self.has_machine(monitored_machine):
-            return False
+        with self.lock:
+            if self.has_machine(monitored_machine):
+                return False
 
-        self.add_queue.append(monitored_machine)
-        self.pull_failures[monitored_machine] = 0
+            self.members.add(monitored_machine)
+            self.add_queue.append(monitored_machine)
+            self.pull_failures[monitored_machine] = 0
+            if history is not None:
+                failures, failing_since, interval = history
+                self.pull_failures[monitored_machine] = failures
+                if failing_since is not None:
+                    self.failing_since[monitored_machine] = failing_since
+                if interval is not None:
+                    self.poll_intervals[monitored_machine] = interval
 
         logger.info(
             "Queued %s for inclusion in next stats run in %s" %
             (monitored_machine, self.number))
+        self.wakeup.set()
         return True
 
+    def get_pull_failures(self):
+        """
+        Get the number of consecutive failed polls of each machine.
+
+        @return A dictionary of machine/failure count mappings.
+        """
+        with self.lock:
+            return dict(self.pull_failures)
+
+    def expedite(self, machines=None):
+        """
+        Poll machines as soon as possible, for when the state calculator
+        needs fresh data. Safe to call from any thread.
+
+        @param machines The machines to poll. Defaults to all machines.
+        """
+        if machines is None:
+            self.expedited.append(None)
+        else:
+            self.expedited.extend(machines)
+        self.wakeup.set()
+
+    def schedule_poll(self, machine, interval, jitter=True):
+        """
+        Schedule the next poll of a machine.
+
+        @param machine The machine to poll.
+        @param interval The number of seconds until the poll.
+        @param jitter Whether to randomize the deadline. Defaults to True.
+        """
+        self.poll_intervals[machine] = interval
+        if jitter:
+            interval *= 1 + random.uniform(-self.poll_jitter, self.poll_jitter)
+        self.poll_sequence += 1
+        self.poll_entries[machine] = self.poll_sequence
+        heapq.heappush(
+            self.poll_queue,
+            (time.time() + interval, self.poll_sequence, machine))
+
+    def get_poll_interval(self, machine, success, changed):
+        """
+        Get the number of seconds until a machine should be polled again.
+
+        @param machine The machine which was polled.
+        @param success Whether the poll succeeded.
+        @param changed Whether the machine's tasks changed.
+        @return The poll interval.
+        """
+        state = self.clustersitter.state
+        status = state.get_machine_status(machine)
+        if (not success or changed or
+                status in (state.Pending, state.Deploying)):
+            return self.min_poll_interval
+
+        interval = self.clustersitter.stats_poll_interval
+        if machine in self.poll_intervals:
+            interval = max(
+                self.poll_intervals[machine] * self.poll_backoff, interval)
+        return min(interval, self.max_poll_interval)
+
+    def _peek_poll(self):
+        """
+        Get the next scheduled poll, dropping stale entries.
+
+        @return A (deadline, sequence, machine) entry or None.
+        """
+        while self.poll_queue:
+            deadline, sequence, machine = self.poll_queue[0]
+            if self.poll_entries.get(machine) == sequence:
+                return self.poll_queue[0]
+            heapq.heappop(self.poll_queue)
+        return None
+
+    def get_due_machines(self):
+        """
+        Take the machines whose poll deadline has passed off the schedule.
+        Expedited machines are always due.
+
+        @return A list of machines to poll.
+        """
+        expedited = self.expedited
+        self.expedited = []
+        if None in expedited:
+            expedited = list(self.monitored_machines)
+        for machine in expedited:
+            if machine in self.poll_entries:
+                self.schedule_poll(machine, 0, jitter=False)
+
+        now = time.time()
+        due = []
+        lag = 0
+        while True:
+            entry = self._peek_poll()
+            if entry is None or entry[0] > now:
+                break
+            heapq.heappop(self.poll_queue)
+            del self.poll_entries[entry[2]]
+            due.append(entry[2])
+            lag = max(lag, now - entry[0])
+        if due:
+            self.lag.add(lag)
+        return due
+
+    def get_sleep_time(self):
+        """
+        Get the number of seconds until the next scheduled poll.
+        """
+        entry = self._peek_poll()
+        if entry is None:
+            return self.clustersitter.stats_poll_interval
+        return max(entry[0] - time.time(), 0)
+
     def initialize_machines(self, monitored_machines):
         for m in monitored_machines:
             val = True
@@ -82,7 +261,11 @@ class MachineMonitor:
                 traceback.print_exc()
                 logger.error(traceback.format_exc())
             if not val:
-                self.pull_failures[m] += 1
+                with self.lock:
+                    if m not in self.members:
+                        continue
+                    self.pull_failures[m] += 1
+                    self.failing_since.setdefault(m, time.time())
 
     def __repr__(self):
         return str(self)
@@ -100,58 +283,214 @@ class MachineMonitor:
 
         return False
 
+    def _get_task_signature(self, machine):
+        """
+        Summarize the tasks on a machine so that changes between polls can be
+        detected.
+        """
+        tasks = machine.get_tasks() or {}
+        return set([
+            (name, bool(task.get('running')))
+            for name, task in tasks.iteritems()])
+
+    def stop(self):
+        """Stop the monitor after its current cycle."""
+        self.running = False
+        self.wakeup.set()
+
+    def get_lag(self):
+        """
+        Get the average number of seconds the monitor's polls have recently
+        run behind schedule.
+        """
+        return self.lag.get_stats().get('mean', 0)
+
+    def get_migration_candidates(self, count):
+        """
+        Choose machines to move to another monitor. Failing machines are the
+        most expensive to poll so they are chosen first, then machines which
+        have not been polled yet.
+
+        @param count The number of machines to choose.
+        @return A list of up to count machines.
+        """
+        pull_failures = self.get_pull_failures()
+        machines = list(self.monitored_machines)
+        machines.sort(key=lambda m: pull_failures.get(m, 0), reverse=True)
+        failing = [m for m in machines if pull_failures.get(m, 0)]
+        machines = failing + list(self.add_queue) + machines[len(failing):]
+        return machines[:count]
+
+    def get_stats(self):
+        """
+        Get statistics on the monitor.
+
+        @return A dictionary with the number of machines, the cycle times,
+            the poll lag and the poll engine statistics.
+        """
+        stats = {
+            'number': self.number,
+            'machines': self.num_monitored_machines(),
+            'failing': len(
+                [c for c in self.get_pull_failures().values() if c > 0]),
+            'cycle_times': self.cycle_times.get_stats(),
+            'lag': self.lag.get_stats(),
+        }
+        if self.engine:
+            stats['engine'] = self.engine.get_stats()
+        return stats
+
+    def _record_poll(self, machine, success):
+        """Update the failure count of a machine after a poll."""
+        with self.lock:
+            if machine not in self.members:
+                return
+            if success:
+                self.pull_failures[machine] = 0
+                self.failing_since.pop(machine, None)
+                return
+
+            self.pull_failures[machine] += 1
+            self.failing_since.setdefault(machine, time.time())
+            failures = self.pull_failures[machine]
+        logger.info(
+            "Detected a pull failure for %s, total: %s" % (
+                machine, failures))
+
+    def _is_failed(self, machine):
+        """
+        Check if a machine has failed enough polls to be removed. Failing
+        machines are polled quickly, so the failures must also span
+        failure_threshold poll intervals.
+        """
+        since = self.failing_since.get(machine)
+        return (
+            self.pull_failures.get(machine, 0) >= self.failure_threshold and
+            since is not None and
+            time.time() - since >=
+            self.failure_threshold * self.clustersitter.stats_poll_interval)
+
     def start(self):
-        self.initialize_machines(self.monitored_machines)
+        self.engine = PollEngine(self.clustersitter.poll_concurrency,
+                                 self.clustersitter.poll_timeout)
 
-        while True:
+        # Machines restored from a checkpoint are already initialized, they
+        # are revalidated by the first poll instead of probed for again.
+        self.initialize_machines([
+            m for m in self.monitored_machines if not m.is_initialized()])
+
+        # Spread the first polls over one interval.
+        for machine in self.monitored_machines:
+            self.schedule_poll(
+                machine,
+                random.uniform(0, self.clustersitter.stats_poll_interval),
+                jitter=False)
+
+        while self.running:
             start_time = datetime.now()
+            # Whether anything the state calculator cares about changed
+            # during this poll.
+            changed = False
+            due = []
             try:
                 logger.debug(
                     "Processing add queue %s at %s" % (
                     self.add_queue, self.number))
                 while len(self.add_queue) > 0:
                     machine = self.add_queue[-1]
-                    self.initialize_machines([machine])
-                    self.monitored_machines.append(machine)
-                    self.add_queue.remove(machine)
+                    if not machine.is_initialized():
+                        self.initialize_machines([machine])
+                    # The machine may have been removed or moved to another
+                    # monitor in the meantime.
+                    with self.lock:
+                        if machine in self.add_queue:
+                            self.add_queue.remove(machine)
+                            self.monitored_machines.append(machine)
+                            # Polled right away, but keeping the interval
+                            # of a machine moved from another monitor.
+                            interval = self.poll_intervals.get(machine)
+                            self.schedule_poll(machine, 0, jitter=False)
+                            if interval is not None:
+                                self.poll_intervals[machine] = interval
+                            changed = True
 
                 logger.debug("Finished processing add queue")
+
+                due = self.get_due_machines()
                 logger.debug(
                     "Beggining machine monitoring poll for %s at %s" % (
-                        [str(a) for a in self.monitored_machines],
-                        self.number))
-
-                for machine in self.monitored_machines:
-                    if machine.is_initialized():
-                        val = True
-                        try:
-                            val = machine._api_get_stats()
-                        except:
-                            val = False
-                            import traceback
-                            traceback.print_exc()
-                            logger.error(traceback.format_exc())
-
-                        if not val:
-                            self.pull_failures[machine] += 1
-                            logger.info(
-                                "Detected a pull failure for %s, total: %s" % (
-                                    machine, self.pull_failures[machine]))
+                        [str(a) for a in due], self.number))
+
+                # Machines pushing their stats don't need polling.
+                pushed = set()
+                telemetry = self.clustersitter.telemetry
+                if telemetry is not None:
+                    pushed = set([m for m in due if telemetry.is_live(m)])
+
+                # Poll every other due initialized machine at once.
+                polled = [m for m in due
+                          if m.is_initialized() and m not in pushed]
+                signatures = dict([
+                    (m, self._get_task_signature(m)) for m in polled])
+                results = {}
+                try:
+                    results = self.engine.poll_machines(polled)
+                except:
+                    import traceback
+                    traceback.print_exc()
+                    logger.error(traceback.format_exc())
 
+                for machine in due:
+                    if not self.has_machine(machine):
+                        # Removed or moved to another monitor while polling.
+                        continue
+                    # The machine is off the schedule until it is put back,
+                    # whatever goes wrong handling it.
+                    success = False
+                    machine_changed = False
+                    try:
+                        if machine in pushed:
+                            # The telemetry ingest notifies the state of
+                            # changes itself.
+                            success = True
+                            self._record_poll(machine, success)
+                        elif machine in signatures:
+                            success = bool(results.get(machine))
+                            self._record_poll(machine, success)
+                            machine_changed = (
+                                success and
+                                signatures[machine] !=
+                                self._get_task_signature(machine))
                         else:
-                            self.pull_failures[machine] = 0
-                    else:
-                        self.initialize_machines([machine])
+                            self.initialize_machines([machine])
+                            success = machine.is_initialized()
+                            machine_changed = success
+                    except:
+                        import traceback
+                        logger.error(traceback.format_exc())
+                    finally:
+                        with self.lock:
+                            if machine in self.members:
+                                self.schedule_poll(
+                                    machine, self.get_poll_interval(
+                                        machine, success, machine_changed))
+
+                    changed = changed or machine_changed
 
+                pull_failures = self.get_pull_failures()
                 logger.debug("Pull Failures: %s" % ([
                     (m.hostname, count) for m, count in
-                    self.pull_failures.items()]))
+                    pull_failures.items()]))
 
-                for machine, count in self.pull_failures.items():
-                    if count >= self.failure_threshold:
-                        self.monitored_machines.remove(machine)
-                        del self.pull_failures[machine]
+                for machine in pull_failures.keys():
+                    if self._is_failed(machine):
+                        # Go through the state so its monitor index stays
+                        # in sync with our machine list.
+                        state = self.clustersitter.state
+                        if not state.unmonitor_machine(machine):
+                            self.remove_machine(machine)
                         machine.detected_sitter_failures += 1
+                        changed = True
                         logger.warn((
                             "Removing '%s' because we can't contact "
                             "the sitter!") % machine.hostname)
@@ -160,14 +499,21 @@ class MachineMonitor:
                 traceback.print_exc()
                 logger.error(traceback.format_exc())
 
+            if changed:
+                self.clustersitter.state.notify("monitor %s" % self.number)
+
+            self.wakeup.clear()
             time_spent = datetime.now() - start_time
-            sleep_time = self.clustersitter.stats_poll_interval - \
-                time_spent.seconds
+            if due:
+                self.cycle_times.add(time_spent.total_seconds())
+            sleep_time = self.get_sleep_time()
             logger.debug(
-                "Finished poll run for %s.  Time_spent: %s, sleep_time: %s" % (
-                    [str(a) for a in self.monitored_machines],
-                    time_spent,
-                    sleep_time))
+                "Finished poll run of %s machines at %s.  Time_spent: %s, "
+                "sleep_time: %s" % (
+                    len(due), self.number, time_spent, sleep_time))
+
+            if (sleep_time > 0 and self.running and not self.expedited and
+                    not self.add_queue):
+                self.wakeup.wait(sleep_time)
 
-            if sleep_time > 0:
-                time.sleep(sleep_time)
+        logger.info("Machine monitor %s stopped" % self.number)
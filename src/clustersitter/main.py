@@ -29,6 +29,15 @@ def parse_args(args):
     parser.add_argument("--login-user", dest="username",
                         default="ubuntu", help="User to login as")
 
+    parser.add_argument("--telemetry-port", dest="telemetry_port",
+                        default=None,
+                        help="Port to accept stats pushed by machine sitters")
+
+    parser.add_argument("--calculate-deadline", dest="calculate_deadline",
+                        default=30,
+                        help="Seconds after which a calculate cycle is "
+                        "counted as an overrun")
+
     return parser.parse_args(args=args)
 
 
@@ -85,7 +94,10 @@ def main(sys_args=None):
                            dns_provider_config=settings.dns_provider_config,
                            keys=settings.keys, login_user=settings.login_user,
                            log_location=settings.log_location,
-                           launch_location=launch_location)
+                           launch_location=launch_location,
+                           calculate_deadline=float(args.calculate_deadline))
+    if args.telemetry_port:
+        sitter.telemetry_port = int(args.telemetry_port)
     sitter.start()
 
     if False:
@@ -5,6 +5,9 @@ from sittercommon.utils import strip_html
 
 logger = logging.getLogger(__name__)
 
+# The first port machine sitters are probed for on.
+SITTER_PORT = 40000
+
 
 class HasMachineSitter(object):
     """
@@ -56,7 +59,7 @@ class HasMachineSitter(object):
             "Attempting to find a machinesitter at %s" %
             self.hostname)
         if not self.datamanager:
-            self.datamanager = MachineData(self.hostname, 40000)
+            self.datamanager = MachineData(self.hostname, SITTER_PORT)
         else:
             self.datamanager._find_portnum()
 
@@ -67,6 +70,19 @@ class HasMachineSitter(object):
 
         return self.datamanager.portnum
 
+    def _api_restore_sitter(self, portnum, tasks):
+        """
+        Restore the machine sitter connection from saved data without probing
+        for it. The data is revalidated by the next stats poll.
+
+        @param portnum The port the machine sitter was last seen on.
+        @param tasks The last known task data of the machine.
+        """
+        self.datamanager = MachineData(
+            self.hostname, SITTER_PORT, portnum=portnum)
+        self.datamanager.tasks = tasks
+        self.loaded = False
+
     def _api_get_endpoint(self, path):
         return "%s/%s" % (
             self.datamanager.url, path)
@@ -92,6 +108,19 @@ class HasMachineSitter(object):
             str(self), self.loaded))
         return self.loaded
 
+    def _api_update_stats(self, tasks):
+        """
+        Update the task data with the result of a poll made outside of the
+        data manager, see PollEngine.
+
+        @param tasks The new task data or None if the poll failed.
+        @return True if the task data was updated or False.
+        """
+        if tasks is not None:
+            self.datamanager.tasks = tasks
+        self.loaded = tasks is not None
+        return self.loaded
+
     def _get_machinename(self):
         if self.datamanager:
             return "%s:%s" % (self.datamanager.hostname,
@@ -167,6 +196,9 @@ class MonitoredMachine(HasMachineSitter):
     def initialize(self):
         return self._api_identify_sitter()
 
+    def restore(self, portnum, tasks):
+        return self._api_restore_sitter(portnum, tasks)
+
     def is_initialized(self):
         if not self.datamanager:
             return False
@@ -0,0 +1,118 @@
+"""
+Resource aware task placement.
+"""
+
+import logging
+from bisect import bisect_left, insort
+
+logger = logging.getLogger(__name__)
+
+# The (cpu, mem) demand of a task which does not declare its resources.
+DEFAULT_DEMAND = (1.0, 0.0)
+
+
+class ResourcePacker(object):
+    """
+    Pack task instances onto machines by cpu and memory using best fit
+    decreasing. The largest requests are placed first, each on the machine
+    with the least free cpu (then memory) that can still hold it. A machine
+    never holds more than one instance of the same task.
+
+    Free capacity is kept in a list sorted by free cpu so that the best fit
+    for a request is found with a binary search rather than a scan of every
+    machine.
+    """
+
+    def __init__(self):
+        """
+        Initialize an empty packer.
+        """
+        self.machines = {}
+        self.free = []
+
+    def _get_key(self, machine):
+        """Get the sort key of a machine in the free list."""
+        cpu, mem, names = self.machines[machine]
+        return (cpu, mem, machine.hostname, machine)
+
+    def add_machine(self, machine, cpu, mem, names=None):
+        """
+        Add a machine to pack tasks onto.
+
+        @param machine The machine to add.
+        @param cpu The free cpu on the machine.
+        @param mem The free memory on the machine in MB.
+        @param names The names of the tasks already on the machine. Optional.
+        """
+        if machine in self.machines:
+            return False
+        self.machines[machine] = (
+            round(cpu, 6), round(mem, 6), set(names or ()))
+        if cpu > 0:
+            insort(self.free, self._get_key(machine))
+        return True
+
+    def get_free(self, machine):
+        """
+        Get the free resources on a machine.
+
+        @param machine The machine to check.
+        @return A two-tuple of free cpu and memory or None if the machine is
+            not present.
+        """
+        if machine not in self.machines:
+            return None
+        cpu, mem, names = self.machines[machine]
+        return (cpu, mem)
+
+    def place(self, name, cpu, mem):
+        """
+        Place a single task instance.
+
+        @param name The name of the task.
+        @param cpu The cpu required by the task.
+        @param mem The memory required by the task in MB.
+        @return The machine the task was placed on or None if no machine has
+            room for it.
+        """
+        index = bisect_left(self.free, (cpu,))
+        while index < len(self.free):
+            free_cpu, free_mem, hostname, machine = self.free[index]
+            if free_mem >= mem and name not in self.machines[machine][2]:
+                break
+            index += 1
+        else:
+            return None
+
+        self.free.pop(index)
+        free_cpu, free_mem, names = self.machines[machine]
+        names.add(name)
+        self.machines[machine] = (
+            round(free_cpu - cpu, 6), round(free_mem - mem, 6), names)
+        if free_cpu - cpu > 0:
+            insort(self.free, self._get_key(machine))
+        return machine
+
+    def pack(self, requests):
+        """
+        Place a set of task instances, largest first.
+
+        @param requests A list of (name, cpu, mem) tuples. One tuple per task
+            instance.
+        @return A two-tuple of placements and unplaced counts. Placements is
+            a dictionary of task name/machine list mappings. Unplaced counts is
+            a dictionary of task name/instance count mappings for instances
+            which did not fit on any machine.
+        """
+        placements = {}
+        unplaced = {}
+        ordered = sorted(
+            requests, key=lambda request: (request[1], request[2]),
+            reverse=True)
+        for name, cpu, mem in ordered:
+            machine = self.place(name, cpu, mem)
+            if machine is None:
+                unplaced[name] = unplaced.get(name, 0) + 1
+            else:
+                placements.setdefault(name, []).append(machine)
+        return (placements, unplaced)
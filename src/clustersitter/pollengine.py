@@ -0,0 +1,432 @@
+"""
+Non-blocking polling of machine sitters.
+"""
+
+import asyncore
+import logging
+import select
+import socket
+import sys
+import threading
+import time
+import urlparse
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import simplejson
+
+logger = logging.getLogger(__name__)
+
+
+class HTTPFetch(asyncore.dispatcher):
+    """
+    A single non-blocking HTTP GET request. The response is read until the
+    server closes the connection.
+    """
+
+    def __init__(self, engine, url, callback):
+        """
+        Initialize the request. The request is not sent until it is started
+        by the engine.
+
+        @param engine The PollEngine running the request.
+        @param url The URL to get.
+        @param callback A callable which is passed the response body and an
+            error message once the request completes. The body is None if
+            the request failed and the error is None if it succeeded.
+        """
+        asyncore.dispatcher.__init__(self, map=engine.socket_map)
+        self.engine = engine
+        self.url = url
+        self.callback = callback
+        self.response = []
+        self.deadline = None
+        self.done = False
+
+        parts = urlparse.urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        path = parts.path or '/'
+        if parts.query:
+            path = "%s?%s" % (path, parts.query)
+        self.request = (
+            "GET %s HTTP/1.0\r\nHost: %s:%s\r\nConnection: close\r\n\r\n" %
+            (path, self.host, self.port))
+
+    def start(self, address, timeout):
+        """
+        Connect and send the request.
+
+        @param address The (ip, port) address to connect to.
+        @param timeout The number of seconds the request may take, unless
+            the engine already gave it a deadline.
+        """
+        if self.deadline is None:
+            self.deadline = time.time() + timeout
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(address)
+
+    def finish(self, body, error=None):
+        """
+        Close the connection and hand the result to the engine.
+
+        @param body The response body or None if the request failed.
+        @param error The reason the request failed.
+        """
+        if self.done:
+            return
+        self.done = True
+        if self.socket is not None:
+            # Requests which never connected have no socket to close.
+            self.close()
+        self.engine._finished(self, body, error)
+
+    def get_body(self):
+        """
+        Get the body of the response. Responses without a status line, as
+        sent by the sitter HTTP monitors, are all body.
+
+        @return A two-tuple of the body and an error message.
+        """
+        data = ''.join(self.response)
+        if not data.startswith('HTTP/'):
+            return data, None
+
+        head, _, body = data.partition('\r\n\r\n')
+        try:
+            status = int(head.split(None, 2)[1])
+        except (IndexError, ValueError):
+            return None, "invalid status line"
+        if status != 200:
+            return None, "status %s" % status
+        return body, None
+
+    def handle_connect(self):
+        """The connection was made, the request is sent when writable."""
+
+    def writable(self):
+        """Wait to send the request until the socket is connected."""
+        return not self.connected or bool(self.request)
+
+    def handle_write(self):
+        """Send as much of the request as possible."""
+        sent = self.send(self.request)
+        self.request = self.request[sent:]
+
+    def handle_read(self):
+        """Read the response."""
+        data = self.recv(65536)
+        if data:
+            self.response.append(data)
+
+    def handle_close(self):
+        """The server closed the connection, the response is complete."""
+        if not self.response:
+            self.finish(None, "no response")
+            return
+        body, error = self.get_body()
+        self.finish(body, error)
+
+    def handle_error(self):
+        """Fail the request on any socket error."""
+        self.finish(None, str(sys.exc_info()[1]))
+
+
+class PollEngine(object):
+    """
+    Run many HTTP requests concurrently from a single thread with an event
+    loop, at most concurrency at a time. Used by the machine monitors to poll
+    all of their machine sitters at once instead of one after another.
+
+    Host names are resolved and moved machine sitters looked for on small
+    thread pools, so that neither blocks the event loop.
+    """
+
+    # Threads resolving host names and looking for moved machine sitters.
+    # The pools are created on first use.
+    resolve_workers = 4
+    rediscover_workers = 8
+
+    def __init__(self, concurrency=256, timeout=5):
+        """
+        Initialize the engine.
+
+        @param concurrency The maximum number of requests open at once.
+        @param timeout The number of seconds each request may take.
+        """
+        self.concurrency = max(concurrency, 1)
+        self.timeout = timeout
+        self.socket_map = {}
+        self.queue = deque()
+
+        # Running requests by id. Dispatchers pass hashing through to their
+        # socket so they can not be kept in a set.
+        self.active = {}
+
+        # Resolved addresses by hostname. Requests to hosts being resolved
+        # wait in resolving by hostname, resolved holds the (hostname,
+        # address, error) results of the lookups until the loop picks them
+        # up.
+        self.addresses = {}
+        self.resolving = {}
+        self.resolved = deque()
+        self.resolver = None
+
+        # Machines whose machine sitter is being looked for on other ports.
+        # They are not polled until it is found or given up on.
+        self.rediscovering = set()
+        self.rediscover_lock = threading.Lock()
+        self.rediscoverer = None
+
+        self.requests = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.last_run_time = 0.0
+
+    def fetch(self, url, callback):
+        """
+        Queue a request. Requests are only run by run().
+
+        @param url The URL to get.
+        @param callback See HTTPFetch.
+        """
+        self.queue.append(HTTPFetch(self, url, callback))
+
+    def _lookup(self, fetch):
+        """Resolve the host of a request in the background."""
+        if not fetch.host:
+            fetch.finish(None, "no host to connect to")
+            return
+        waiting = self.resolving.get(fetch.host)
+        if waiting is not None:
+            waiting.append(fetch)
+            return
+
+        self.resolving[fetch.host] = [fetch]
+        if self.resolver is None:
+            self.resolver = ThreadPool(self.resolve_workers)
+        self.resolver.apply_async(self._resolve, (fetch.host, ))
+
+    def _resolve(self, host):
+        """Resolve a host name. Runs on the resolver pool."""
+        try:
+            self.resolved.append((host, socket.gethostbyname(host), None))
+        except socket.error, e:
+            self.resolved.append((host, None, str(e)))
+
+    def _start_resolved(self):
+        """Start the requests whose host has been resolved."""
+        while self.resolved:
+            host, address, error = self.resolved.popleft()
+            if address is not None:
+                self.addresses[host] = address
+            for fetch in self.resolving.pop(host, []):
+                if fetch.done:
+                    # Timed out while resolving.
+                    continue
+                if address is None:
+                    fetch.finish(None, error)
+                else:
+                    self._connect(fetch, address)
+
+    def _connect(self, fetch, address):
+        """Start a request to a resolved address."""
+        try:
+            fetch.start((address, fetch.port), self.timeout)
+        except socket.error, e:
+            self.addresses.pop(fetch.host, None)
+            fetch.finish(None, str(e))
+
+    def _start_next(self):
+        """Start queued requests until the concurrency limit is reached."""
+        while self.queue and len(self.active) < self.concurrency:
+            fetch = self.queue.popleft()
+            self.active[id(fetch)] = fetch
+            # The time spent resolving the host counts towards the timeout.
+            fetch.deadline = time.time() + self.timeout
+            address = self.addresses.get(fetch.host)
+            if address is None:
+                self._lookup(fetch)
+            else:
+                self._connect(fetch, address)
+
+    def _finished(self, fetch, body, error):
+        """Handle a completed request."""
+        self.active.pop(id(fetch), None)
+        self.requests += 1
+        if error:
+            self.failures += 1
+            # The host may have moved.
+            self.addresses.pop(fetch.host, None)
+        try:
+            fetch.callback(body, error)
+        except:
+            import traceback
+            logger.error(traceback.format_exc())
+
+    def run(self):
+        """
+        Run requests until the queue is empty, including any requests queued
+        by callbacks.
+        """
+        start = time.time()
+        use_poll = hasattr(select, 'poll')
+        while self.queue or self.active:
+            self._start_resolved()
+            self._start_next()
+            if self.socket_map:
+                asyncore.loop(
+                    timeout=0.05, use_poll=use_poll, map=self.socket_map,
+                    count=1)
+            elif self.active:
+                # Only waiting for host names to resolve.
+                time.sleep(0.01)
+
+            now = time.time()
+            for fetch in self.active.values():
+                if now > fetch.deadline:
+                    self.timeouts += 1
+                    fetch.finish(None, "timed out")
+        self.last_run_time = time.time() - start
+
+    def poll_machines(self, machines):
+        """
+        Reload the task data of machines concurrently. Machine sitters which
+        serve /stats_all are polled with a single request. For the others the
+        stats page of the machine sitter is fetched, then the stats page of
+        each running task. Task data is only replaced once all of a machine's
+        pages have loaded.
+
+        Machine sitters that refuse the connection are probed for on other
+        ports in the background, as MachineData does after a failed request.
+        Their machines are not polled again until the probe is done.
+
+        @param machines The initialized machines to poll.
+        @return A dictionary of True if the poll succeeded or False by
+            machine.
+        """
+        results = {}
+        moved = []
+        for machine in machines:
+            results[machine] = False
+            if not self.is_rediscovering(machine):
+                self._poll_machine(machine, results, moved)
+        self.run()
+
+        for machine in moved:
+            self._rediscover(machine)
+        return results
+
+    def is_rediscovering(self, machine):
+        """
+        Check if a machine's sitter is being looked for on other ports.
+
+        @param machine The machine to check.
+        @return True if the machine sitter is being looked for or False.
+        """
+        with self.rediscover_lock:
+            return machine in self.rediscovering
+
+    def _rediscover(self, machine):
+        """Look for a machine sitter which moved in the background."""
+        with self.rediscover_lock:
+            if machine in self.rediscovering:
+                return
+            self.rediscovering.add(machine)
+        if self.rediscoverer is None:
+            self.rediscoverer = ThreadPool(self.rediscover_workers)
+        self.rediscoverer.apply_async(self._find_portnum, (machine, ))
+
+    def _find_portnum(self, machine):
+        """Find a moved machine sitter. Runs on the rediscovery pool."""
+        try:
+            machine.datamanager._find_portnum()
+        except:
+            import traceback
+            logger.error(traceback.format_exc())
+        finally:
+            with self.rediscover_lock:
+                self.rediscovering.discard(machine)
+
+    def _poll_machine(self, machine, results, moved):
+        """Queue the requests to poll a machine."""
+        datamanager = machine.datamanager
+
+        def failed(error):
+            logger.warn("failed to poll %s: %s" % (machine, error))
+            machine._api_update_stats(None)
+            if error != "timed out":
+                moved.append(machine)
+
+        def stats_all_loaded(body, error):
+            if error is not None:
+                failed(error)
+                return
+
+            data = datamanager.decode_stats_all(body)
+            if data is None:
+                # An older machine sitter, load each task separately.
+                self.fetch(datamanager.get_stats_url(), stats_loaded)
+                return
+            results[machine] = machine._api_update_stats(
+                datamanager.apply_stats_all(data))
+
+        def stats_loaded(body, error):
+            if error is not None:
+                failed(error)
+                return
+
+            try:
+                tasks = datamanager.parse_stats(simplejson.loads(body))
+            except ValueError:
+                logger.warn("invalid stats from %s" % machine)
+                machine._api_update_stats(None)
+                return
+
+            running = [task for task in tasks.values() if task['running']]
+            remaining = [len(running)]
+            if not running:
+                results[machine] = machine._api_update_stats(tasks)
+                return
+
+            for task in running:
+                self.fetch(
+                    datamanager.get_task_stats_url(task),
+                    task_loaded(tasks, task, remaining))
+
+        def task_loaded(tasks, task, remaining):
+            def callback(body, error):
+                if error is None:
+                    try:
+                        datamanager.set_task_stats(
+                            task, simplejson.loads(body))
+                    except ValueError:
+                        error = "invalid stats"
+                if error is not None:
+                    logger.warn(
+                        "couldn't update task %s on %s: %s" %
+                        (task['name'], machine, error))
+
+                remaining[0] -= 1
+                if not remaining[0]:
+                    results[machine] = machine._api_update_stats(tasks)
+            return callback
+
+        if datamanager.stats_all is False:
+            self.fetch(datamanager.get_stats_url(), stats_loaded)
+        else:
+            self.fetch(datamanager.get_stats_all_url(), stats_all_loaded)
+
+    def get_stats(self):
+        """
+        Get statistics on the requests made by the engine.
+
+        @return A dictionary of statistics.
+        """
+        return {
+            'concurrency': self.concurrency,
+            'requests': self.requests,
+            'failures': self.failures,
+            'timeouts': self.timeouts,
+            'last_run_time': self.last_run_time,
+        }
@@ -49,8 +49,10 @@ class ProductionJob(object):
             self.fillers[zone] = []
             self.currently_spawning[zone] = 0
 
-        #!MACHINEASSUMPTION!
-        # Hack to make num_machines == num_cpu, for now.
+        # The layout cpu count is the number of instances of the job to run
+        # in the zone. ClusterState packs instances onto machines by their
+        # resource demand, see get_resource_demand(). JobFiller still assumes
+        # one instance per machine.
         for zone in self.deployment_layout.keys():
             self.deployment_layout[zone]['num_machines'] = \
                 self.deployment_layout[zone]['cpu']
@@ -66,8 +68,8 @@ class ProductionJob(object):
                   persistent=data.get('persistent', False),
                   linked_job=data.get('linked_job'),
                   )
-        obj.currently_spawning = data.get('spawning')
-        obj.fillers = data.get('fillers')
+        obj.currently_spawning = data.get('spawning', obj.currently_spawning)
+        obj.fillers = data.get('fillers', obj.fillers)
         obj.fill = data.get('fill')
         obj.fill_machines = data.get('fill_machines')
 
@@ -78,9 +80,8 @@ class ProductionJob(object):
 
     def get_num_required_machines_in_zone(self, zone):
         """
-        Return the total number of machines needed in this zone
+        Return the total number of instances needed in this zone
         """
-        #!MACHINEASSUMPTION!
         if not self.linked_job:
             return self.deployment_layout.get(zone, {}).get('num_machines', 0)
 
@@ -89,6 +90,22 @@ class ProductionJob(object):
         return self.linked_job_object.deployment_layout.get(
             zone, {}).get('num_machines', 0)
 
+    def get_resource_demand(self, zone):
+        """
+        Get the resources required by a single instance of the job. The cpu
+        and mem limits in the task configuration are used when present. Memory
+        defaults to the per instance memory in the deployment layout and cpu
+        defaults to one.
+
+        @param zone The zone the instance is deployed to.
+        @return A two-tuple of cpu and memory in MB.
+        """
+        cpu = self.task_configuration.get('cpu') or 1
+        mem = self.task_configuration.get('mem')
+        if mem is None:
+            mem = self.deployment_layout.get(zone, {}).get('mem', 0)
+        return (float(cpu), float(mem))
+
     def get_name(self):
         return self.task_configuration['name']
 
@@ -100,6 +117,7 @@ class ProductionJob(object):
 
     def to_dict(self):
         return {
+            'dns_basename': self.dns_basename,
             'task_configuration': self.task_configuration,
             'deployment_layout': self.deployment_layout,
             'deployment_recipe': self.deployment_recipe,
@@ -145,12 +163,7 @@ class ProductionJob(object):
                 self.fillers[zone].append(filler)
 
     def find_dependent_jobs(self):
-        dependent_jobs = []
-        for job in self.sitter.state.jobs.values():
-            if job.linked_job == self.name:
-                dependent_jobs.append(job)
-
-        return dependent_jobs
+        return self.sitter.state.job_graph.get_dependents(self.name)
 
     def find_linked_job(self):
         """
@@ -158,8 +171,9 @@ class ProductionJob(object):
 
         @return The linked job object.
         """
-        if self.linked_job and not self.linked_job_object:
-            self.linked_job_object = self.sitter.state.jobs[self.linked_job]
+        if self.linked_job:
+            self.linked_job_object = self.sitter.state.get_job(
+                self.linked_job)
         return self.linked_job_object
 
     def ensure_on_linked_job(self, state, sitter):
@@ -242,19 +256,50 @@ class ProductionJob(object):
         if version is not None:
             self.recipe_options['version'] = version
 
+        machines = self._run_filler(
+            zone, 1, machines, raw_machines, fail_on_error=repair)
+        if machines:
+            return machines[0]
+        return None
+
+    def deploy_new(self, zone, count):
+        """
+        Deploy the job to a batch of new machines. The machines are requested
+        from the zone's provider in a single call.
+
+        @param zone The zone to deploy to.
+        @param count The number of new machines to spin up.
+        @return A list of the machines the job was deployed to. Empty if
+            deployment failed.
+        """
+        return self._run_filler(zone, count, [], [])
+
+    def _run_filler(self, zone, count, machines, raw_machines,
+                    fail_on_error=False):
+        """
+        Run a job filler in the current thread.
+
+        @param zone The zone to fill.
+        @param count The number of machines to fill. New machines are spun up
+            for any not provided.
+        @param machines Machines with the machine sitter deployed.
+        @param raw_machines Machines without the machine sitter deployed.
+        @param fail_on_error Give up on the first error. Defaults to False.
+        @return A list of the machines filled. Empty on failure.
+        """
         filler = JobFiller(
-            1, self, zone, machines, raw_machines=raw_machines,
-            fail_on_error=repair)
+            count, self, zone, machines, raw_machines=raw_machines,
+            fail_on_error=fail_on_error)
         self.fillers[zone].append(filler)
-        self.currently_spawning[zone] += 1
+        self.currently_spawning[zone] += count
         try:
             if filler.run():
-                return filler.machines[0]
+                return filler.machines
         finally:
             if filler in self.fillers[zone]:
                 self.fillers[zone].remove(filler)
-            self.currently_spawning[zone] -= 1
-        return None
+            self.currently_spawning[zone] -= count
+        return []
 
     def refill(self, state, sitter):
         self.sitter = sitter
@@ -0,0 +1,123 @@
+"""
+Rate limiting for calls to external services.
+"""
+
+import logging
+import time
+from threading import Condition
+
+logger = logging.getLogger(__name__)
+
+# Provider methods which call out to the provider's API.
+PROVIDER_CALLS = ('fill_request', 'decomission', 'get_machine_list')
+
+# DNS provider methods which call out to the provider's API.
+DNS_CALLS = ('add_record', 'remove_record', 'get_records')
+
+
+class TokenBucket(object):
+    """
+    A thread safe token bucket. Tokens are added at a fixed rate up to a
+    maximum burst size. Each call takes a token, waiting for one to be added
+    if the bucket is empty. Bursts of up to the burst size go through at once
+    and anything more is spread out at the fill rate.
+    """
+
+    def __init__(self, rate, burst):
+        """
+        Initialize the bucket. The bucket starts full.
+
+        @param rate The number of tokens added per second.
+        @param burst The maximum number of tokens in the bucket.
+        """
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last_fill = time.time()
+        self.condition = Condition()
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def _fill(self):
+        """Add the tokens accrued since the last fill."""
+        now = time.time()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.last_fill) * self.rate)
+        self.last_fill = now
+
+    def acquire(self, timeout=None):
+        """
+        Take a token from the bucket, waiting for one if it is empty.
+
+        @param timeout The maximum number of seconds to wait. Defaults to
+            infinite.
+        @return True if a token was taken or False if the timeout expired.
+        """
+        start = time.time()
+        with self.condition:
+            self._fill()
+            if self.tokens < 1:
+                self.waits += 1
+            while self.tokens < 1:
+                wait = (1 - self.tokens) / self.rate
+                if timeout is not None:
+                    remaining = start + timeout - time.time()
+                    if remaining <= 0:
+                        return False
+                    wait = min(wait, remaining)
+                self.condition.wait(wait)
+                self._fill()
+            self.tokens -= 1
+            self.wait_time += time.time() - start
+            return True
+
+    def get_stats(self):
+        """
+        Get statistics on the bucket.
+
+        @return A dictionary with the current token count, the number of
+            calls which had to wait and the total time spent waiting.
+        """
+        with self.condition:
+            self._fill()
+            return {
+                'rate': self.rate,
+                'burst': self.burst,
+                'tokens': self.tokens,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+            }
+
+
+class RateLimited(object):
+    """
+    Proxy an object, taking a token from a bucket before each call to one of
+    the given methods. Everything else is passed straight through.
+    """
+
+    def __init__(self, target, bucket, methods):
+        """
+        Initialize the proxy.
+
+        @param target The object to proxy.
+        @param bucket The TokenBucket to take tokens from.
+        @param methods The names of the methods to rate limit.
+        """
+        self.target = target
+        self.bucket = bucket
+        self.methods = set(methods)
+
+    def __getattr__(self, name):
+        """Get an attribute of the proxied object."""
+        value = getattr(self.target, name)
+        if name not in self.methods or not callable(value):
+            return value
+
+        def limited(*args, **kwargs):
+            self.bucket.acquire()
+            return value(*args, **kwargs)
+        return limited
+
+    def __repr__(self):
+        """Return the representation of the proxied object."""
+        return "RateLimited(%r)" % self.target
@@ -0,0 +1,79 @@
+"""
+Wake-up scheduling for the state calculator.
+"""
+
+import logging
+import time
+from threading import Condition
+
+logger = logging.getLogger(__name__)
+
+
+class CalculationScheduler(object):
+    """
+    Decide when the state calculator runs. Anything that changes cluster state
+    posts an event and the calculator wakes up to handle it. Events are
+    coalesced: once the first event arrives the scheduler waits for a short
+    debounce window so that a burst of events results in a single run. The
+    calculator is always woken at least once every max_interval seconds as a
+    safety tick.
+    """
+
+    def __init__(self, max_interval, debounce=0.05):
+        """
+        Initialize the scheduler.
+
+        @param max_interval The maximum number of seconds between runs.
+        @param debounce The number of seconds to wait for more events after
+            the first one arrives.
+        """
+        self.max_interval = max_interval
+        self.debounce = debounce
+        self.condition = Condition()
+        self.events = {}
+
+    def post(self, event):
+        """
+        Post a change event. Wakes up the calculator if it is waiting.
+
+        @param event A short description of what changed.
+        """
+        self.condition.acquire()
+        try:
+            self.events[event] = self.events.get(event, 0) + 1
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def wait(self):
+        """
+        Block until the calculator should run.
+
+        @return A dictionary of event/count mappings for the events that were
+            posted since the last call. Empty if the wait ended on the safety
+            tick.
+        """
+        deadline = time.time() + self.max_interval
+        self.condition.acquire()
+        try:
+            while not self.events:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+        finally:
+            self.condition.release()
+
+        if self.events and self.debounce > 0:
+            time.sleep(self.debounce)
+
+        self.condition.acquire()
+        try:
+            events = self.events
+            self.events = {}
+        finally:
+            self.condition.release()
+
+        if events:
+            logger.debug("woken by events: %s" % events)
+        return events
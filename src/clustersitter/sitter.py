@@ -2,42 +2,50 @@ import logging
 import os
 import socket
 import sys
-import threading
 from datetime import datetime
 from logging import FileHandler
 
 import actions
+import actiontrace
+import calcstats
+import checkpoint
 import clusterstate
 import deploymentrecipe
 import dynect
 import eventmanager
 import jobfiller
+import jobgraph
+import jobstore
 import machinemonitor
 import monitoredmachine
+import placement
+import pollengine
 import productionjob
 import providers.aws
+import ratelimit
+import scheduler
 import sittercommon.machinedata
+import telemetry
 
 from clusterstate import ClusterState
 from clusterstats import ClusterStats
 from eventmanager import ClusterEventManager
-from machinemonitor import MachineMonitor
 from monitoredmachine import MonitoredMachine
 from productionjob import ProductionJob
 from providers.aws import AmazonEC2
+from ratelimit import DNS_CALLS, PROVIDER_CALLS, RateLimited, TokenBucket
+from telemetry import TelemetryIngest
 from sittercommon import http_monitor
 from sittercommon import logmanager
 
 logger = logging.getLogger(__name__)
 
 """
-In an ideal world this is written such that we always speak
-in terms of CPUs and RAM requirements for each job.  This allows
-us to put multiple jobs on a machine whilst keeping track
-of total theoretical machine utilization.  However, for simplicities
-sake we're cutting some corners (FOR NOW) and assuming one job
-per machine.  These sections are noted with the comment
-#!MACHINEASSUMPTION!
+Jobs are described in terms of CPUs and RAM requirements. ClusterState
+packs job instances onto machines by those requirements (see placement.py)
+and only provisions new machines for instances that do not fit.  The
+JobFiller code paths still assume one job per machine.  These sections are
+noted with the comment #!MACHINEASSUMPTION!
 """
 
 
@@ -47,7 +55,8 @@ class ClusterSitter(object):
                  dns_provider_config,
                  keys=None, login_user=None,
                  starting_port=30000,
-                 launch_location=None):
+                 launch_location=None,
+                 calculate_deadline=30):
         self.worker_thread_count = 4
         self.daemon = daemon
         self.keys = keys
@@ -62,6 +71,37 @@ class ClusterSitter(object):
         # In seconds
         self.stats_poll_interval = 5
 
+        # Calculate cycles running longer than this many seconds are counted
+        # as overruns and have their thread stacks dumped to the log.
+        self.calculate_deadline = calculate_deadline
+
+        # Number of threads used to plan job deployment across zones.
+        self.deployment_workers = 1
+
+        # Number of threads used to run cluster actions. Actions on the same
+        # machine always run one at a time.
+        self.action_workers = 32
+
+        # Each machine monitor polls up to this many machine sitters at once,
+        # giving up on a request after poll_timeout seconds.
+        self.poll_concurrency = 256
+        self.poll_timeout = 5
+
+        # Calls to each machine provider and the DNS provider are limited to
+        # this many per second, with bursts of up to the burst size.
+        self.provider_rate_limit = 2
+        self.provider_burst = 10
+        self.dns_rate_limit = 5
+        self.dns_burst = 20
+        self.rate_limits = {}
+
+        # Machine sitters started with --telemetry push their stats to this
+        # port and are not polled while connected. Off when None. Machines
+        # which send nothing for telemetry_timeout seconds are polled again.
+        self.telemetry_port = None
+        self.telemetry_timeout = 30
+        self.telemetry = None
+
         self.state = ClusterState(self)
 
         self.orig_starting_port = starting_port
@@ -77,8 +117,9 @@ class ClusterSitter(object):
         if 'class' in dns_provider_config:
             (module, clsname) = dns_provider_config['class'].split(':')
             clz = self._get_recipe_class(module, find_func=clsname)
-            self.dns_provider = getattr(clz, clsname)(
-                dns_provider_config)
+            self.dns_provider = self._rate_limit(
+                'dns', getattr(clz, clsname)(dns_provider_config),
+                self.dns_rate_limit, self.dns_burst, DNS_CALLS)
 
         self.stats = ClusterStats(self)
         self.http_monitor = http_monitor.HTTPMonitor(self.stats,
@@ -86,6 +127,8 @@ class ClusterSitter(object):
                                                      30000)
 
         self.http_monitor.add_handler('/overview', self.stats.overview)
+        self.http_monitor.add_handler('/calc_stats', self.stats.calc_stats)
+        self.http_monitor.add_handler('/actions', self.stats.actions)
         self.http_monitor.add_handler('/add_job', self.api_add_job)
         self.http_monitor.add_handler('/remove_job', self.api_remove_job)
         self.http_monitor.add_handler('/update_idle_limit',
@@ -99,16 +142,26 @@ class ClusterSitter(object):
         modules = [
             sys.modules[__name__],
             actions,
+            actiontrace,
+            calcstats,
+            checkpoint,
             clusterstate,
             deploymentrecipe,
             dynect,
             eventmanager,
             jobfiller,
+            jobgraph,
+            jobstore,
             machinemonitor,
             monitoredmachine,
+            placement,
+            pollengine,
             productionjob,
             providers.aws,
+            ratelimit,
+            scheduler,
             sittercommon.machinedata,
+            telemetry,
         ]
 
         formatter = logging.Formatter(
@@ -178,6 +231,7 @@ class ClusterSitter(object):
 
         ClusterEventManager.handle(
             "Enforce Idle Limit at %s" % int(args['idle_count_per_zone']))
+        self.state.notify("api update_idle_limit")
         return "Limit set"
 
     def api_update_job(self, args):
@@ -193,6 +247,7 @@ class ClusterSitter(object):
 
         ClusterEventManager.handle(
             'Update %s started' % job_name)
+        self.state.notify("api update_job")
         return "Job update initiated"
 
     def api_add_job(self, args):
@@ -223,6 +278,7 @@ class ClusterSitter(object):
         if self.state.add_job(job):
             ClusterEventManager.handle(
                 "Added a job: %s" % job.get_name())
+            self.state.notify("api add_job")
 
             return "Job Added"
         else:
@@ -238,6 +294,7 @@ class ClusterSitter(object):
         ClusterEventManager.handle(
             "Removed jobs: %s" % ', '.join(jobs))
         if jobs:
+            self.state.notify("api remove_job")
             return "Removed: %s" % ', '.join(jobs)
         else:
             return "Job Not Found"
@@ -252,6 +309,21 @@ class ClusterSitter(object):
 
         return False
 
+    def _rate_limit(self, name, target, rate, burst, methods):
+        """
+        Wrap a provider so calls to its API are rate limited.
+
+        @param name The name to report the limit's stats under.
+        @param target The provider to wrap.
+        @param rate The number of calls allowed per second.
+        @param burst The number of calls allowed at once.
+        @param methods The names of the provider methods to limit.
+        @return The wrapped provider.
+        """
+        bucket = TokenBucket(rate, burst)
+        self.rate_limits[name] = bucket
+        return RateLimited(target, bucket, methods)
+
     def _get_recipe_class(self, recipe_class, find_func="run_deploy"):
         if isinstance(recipe_class, type):
             return recipe_class
@@ -433,30 +505,41 @@ class ClusterSitter(object):
 
         logger.info(
             "Initializing %s MachineMonitors" % self.worker_thread_count)
-        # Spin up all the monitoring threads
-        #TODO: Move monitor thread spinup to ClusterState.
+        # Spin up all the monitoring threads. ClusterState adds and removes
+        # monitors as the number of machines changes.
         for threadnum in range(self.worker_thread_count):
-            machinemonitor = MachineMonitor(parent=self,
-                                            number=threadnum)
-            thread = threading.Thread(target=machinemonitor.start,
-                                      name='Monitoring-%s' % threadnum)
-            self.state.monitors.append((machinemonitor, thread))
+            self.state.add_monitor(start=False)
 
         #TODO: Don't hard code providers.
         aws = AmazonEC2(self.provider_config['aws'])
         if aws.usable():
-            self.state.add_provider('aws', aws)
+            self.state.add_provider('aws', self._rate_limit(
+                'aws', aws, self.provider_rate_limit, self.provider_burst,
+                PROVIDER_CALLS))
 
-        for provider in self.state.get_providers().values():
-            # Note: add_machines() has to be called AFTER the monitors
-            # are initialized.
+        machines = []
+        for name, provider in self.state.get_providers().iteritems():
+            provider_machines = provider.get_machine_list()
             logger.info(
-                "adding %d machines for provider %s" % (
-                len(provider.get_machine_list()), 'aws'))
-            self.add_machines(provider.get_machine_list())
+                "found %d machines for provider %s" % (
+                len(provider_machines), name))
+            machines.extend(provider_machines)
+
+        # Machines in the last checkpoint are restored without probing them,
+        # the rest are added as new. Note: add_machines() and
+        # restore_checkpoint() have to be called AFTER the monitors are
+        # initialized.
+        machines = self.state.restore_checkpoint(machines)
+        logger.info("adding %d machines" % len(machines))
+        self.add_machines(machines)
 
         logger.info("Zone List: %s" % self.state.get_zones())
 
+        # Jobs are loaded once existing machines are known so that their
+        # running tasks are matched up with the jobs.
+        jobs = self.state.load_jobs()
+        logger.info("Loaded %s saved jobs" % len(jobs))
+
         # Kickoff all the threads at once
         if self.daemon:
             self.logmanager.setup_all()
@@ -467,6 +550,13 @@ class ClusterSitter(object):
         for monitor in self.state.monitors:
             monitor[1].start()
 
+        if self.telemetry_port is not None:
+            self.telemetry = TelemetryIngest(
+                self.state, self.telemetry_port, self.telemetry_timeout)
+            self.telemetry.start()
+            logger.info(
+                "Accepting telemetry on port %s" % self.telemetry.port)
+
         logger.info("Starting metadata calculator")
         self.state.start()
         self.start_state = "Started"
@@ -0,0 +1,258 @@
+"""
+Receive stats pushed by machine sitters, see machinesitter/statspusher.py
+for the protocol. Machines with a live push connection are not polled by
+their machine monitor.
+"""
+
+import asyncore
+import logging
+import select
+import socket
+import threading
+import time
+
+import simplejson
+
+logger = logging.getLogger(__name__)
+
+
+class TelemetryConnection(asyncore.dispatcher):
+    """
+    A connection from one machine sitter. Frames are read until the machine
+    sitter disconnects.
+    """
+
+    # Frames longer than this are a protocol error.
+    max_frame = 16 * 1024 * 1024
+
+    def __init__(self, ingest, sock, address):
+        asyncore.dispatcher.__init__(self, sock, map=ingest.socket_map)
+        self.ingest = ingest
+        self.address = address
+        self.hostnames = []
+        self.port = None
+        self.machine = None
+        self.buffer = ''
+        self.outgoing = ''
+        self.connected_time = time.time()
+        self.last_frame = self.connected_time
+        self.last_resync = 0
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data:
+            return
+
+        self.buffer += data
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            self.ingest._handle_frame(self, line)
+        if len(self.buffer) > self.max_frame:
+            logger.warn("Frame too long from %s" % (self.address, ))
+            self.handle_close()
+
+    def send_frame(self, frame):
+        self.outgoing += "%s\n" % simplejson.dumps(frame)
+
+    def writable(self):
+        return bool(self.outgoing)
+
+    def handle_write(self):
+        sent = self.send(self.outgoing)
+        self.outgoing = self.outgoing[sent:]
+
+    def handle_close(self):
+        self.close()
+        self.ingest._closed(self)
+
+    def handle_error(self):
+        import traceback
+        logger.error(traceback.format_exc())
+        self.handle_close()
+
+
+class TelemetryIngest(asyncore.dispatcher):
+    """
+    Listen for machine sitters pushing their stats and apply them to the
+    monitored machines. A machine is live while its connection is open and
+    has sent a frame within timeout seconds.
+    """
+
+    def __init__(self, state, port, timeout=30):
+        """
+        @param state The cluster state, used to find machines by hostname.
+        @param port The port to listen on.
+        @param timeout Seconds without frames after which a connection is
+            closed.
+        """
+        self.socket_map = {}
+        asyncore.dispatcher.__init__(self, map=self.socket_map)
+        self.state = state
+        self.timeout = timeout
+        self.thread = None
+        self.running = False
+
+        # Connections by machine. Unidentified connections are only kept in
+        # the socket map.
+        self.connections = {}
+
+        self.frames = 0
+        self.bytes = 0
+        self.resyncs = 0
+        self.disconnects = 0
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(('', port))
+        self.port = self.socket.getsockname()[1]
+        self.listen(128)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run,
+                                       name="TelemetryIngest")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def _run(self):
+        use_poll = hasattr(select, 'poll')
+        while self.running:
+            try:
+                asyncore.loop(timeout=1, use_poll=use_poll,
+                              map=self.socket_map, count=1)
+                self._close_stale()
+            except:
+                import traceback
+                logger.error(traceback.format_exc())
+
+        for dispatcher in self.socket_map.values():
+            dispatcher.close()
+
+    def _close_stale(self):
+        """Close connections which stopped sending frames."""
+        now = time.time()
+        for dispatcher in self.socket_map.values():
+            if (isinstance(dispatcher, TelemetryConnection) and
+                    now - dispatcher.last_frame > self.timeout):
+                logger.warn(
+                    "No telemetry from %s for %s seconds, closing" % (
+                        dispatcher.address, self.timeout))
+                dispatcher.handle_close()
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        sock, address = pair
+        TelemetryConnection(self, sock, address)
+
+    def is_live(self, machine):
+        """
+        Check if a machine is pushing its stats.
+
+        @param machine The machine to check.
+        @return True if the machine's stats are being pushed or False.
+        """
+        connection = self.connections.get(machine)
+        if connection is None:
+            return False
+        return time.time() - connection.last_frame <= self.timeout
+
+    def _find_machine(self, connection):
+        """Find the machine a connection is from, if it is monitored."""
+        names = set(connection.hostnames + [connection.address[0]])
+        machine = self.state.find_machine(names)
+        if machine is None or not machine.is_initialized():
+            return None
+        if machine.datamanager.portnum != connection.port:
+            # Not the machine sitter the monitor knows about.
+            return None
+        return machine
+
+    def _handle_frame(self, connection, line):
+        """Handle one frame from a machine sitter."""
+        self.frames += 1
+        self.bytes += len(line) + 1
+        connection.last_frame = time.time()
+        try:
+            frame = simplejson.loads(line)
+        except ValueError:
+            logger.warn("Invalid frame from %s" % (connection.address, ))
+            return
+
+        frame_type = frame.get('type')
+        if frame_type == 'hello':
+            connection.hostnames = frame.get('hostnames', [])
+            connection.port = frame.get('port')
+            logger.info("Telemetry connection from %s at %s" % (
+                connection.hostnames, connection.address))
+            return
+
+        if frame_type != 'stats':
+            return
+
+        machine = connection.machine
+        if machine is None or not self.state.has_machine(machine):
+            machine = self._find_machine(connection)
+            if machine is None:
+                # Not monitored yet. Deltas are useless without the previous
+                # stats, so ask for the full stats again, but not on every
+                # frame.
+                if time.time() - connection.last_resync > self.timeout:
+                    connection.last_resync = time.time()
+                    connection.send_frame({'type': 'resync'})
+                return
+            previous = self.connections.get(machine)
+            if previous is not None and previous is not connection:
+                previous.handle_close()
+            connection.machine = machine
+            self.connections[machine] = connection
+
+        # Malformed stats are resynced. Unlike a poll they don't mean the
+        # machine sitter doesn't serve /stats_all.
+        signature = self._get_task_signature(machine)
+        stats = frame.get('stats')
+        tasks = None
+        if isinstance(stats, dict) and 'tasks' in stats:
+            tasks = machine.datamanager.apply_stats_all(stats)
+        if tasks is None:
+            self.resyncs += 1
+            connection.send_frame({'type': 'resync'})
+            return
+
+        machine._api_update_stats(tasks)
+        if signature != self._get_task_signature(machine):
+            self.state.notify("telemetry %s" % machine.hostname)
+
+    def _get_task_signature(self, machine):
+        return set([
+            (name, bool(task.get('running')))
+            for name, task in machine.get_tasks().iteritems()])
+
+    def _closed(self, connection):
+        """Forget a closed connection and have its machine polled again."""
+        machine = connection.machine
+        if machine is not None and self.connections.get(machine) is connection:
+            del self.connections[machine]
+            self.disconnects += 1
+            logger.warn("Telemetry from %s disconnected" % machine)
+            self.state.expedite_poll([machine])
+
+    def get_stats(self):
+        """
+        Get statistics on the pushed stats.
+
+        @return A dictionary of statistics.
+        """
+        return {
+            'port': self.port,
+            'connections': len(self.socket_map) - 1,
+            'live_machines': len(self.connections),
+            'frames': self.frames,
+            'bytes': self.bytes,
+            'resyncs': self.resyncs,
+            'disconnects': self.disconnects,
+        }
@@ -6,9 +6,11 @@ import socket
 import threading
 import time
 
+import sittercommon.discovery as discovery
 import sittercommon.http_monitor as http_monitor
 import sittercommon.logmanager as logmanager
 import machinestats
+import statspusher
 import taskmanager
 
 
@@ -18,7 +20,12 @@ class MachineManager(object):
                  machine_sitter_starting_port=40000,
                  task_sitter_starting_port=50000,
                  launch_location="",
-                 daemon=False):
+                 daemon=False,
+                 telemetry=None):
+        """
+        @param telemetry The host:port of a cluster sitter to push stats to
+            as they change, see StatsPusher. Stats are only polled if None.
+        """
         self.tasks = {}
         self.launch_location = launch_location
         self.task_definition_file = task_definition_file
@@ -45,6 +52,7 @@ class MachineManager(object):
                                                      self,
                                                      self.next_port(True))
 
+        self.http_monitor.add_handler('/stats_all', self.stats.get_all_stats)
         self.http_monitor.add_handler('/start_task', self.remote_start_task)
         self.http_monitor.add_handler('/stop_task', self.remote_stop_task)
         self.http_monitor.add_handler('/remove_task', self.remote_remove_task)
@@ -56,6 +64,12 @@ class MachineManager(object):
         self.http_monitor.add_handler('/load_config',
                                       self.remote_load_config)
 
+        self.discovery = None
+        self.pusher = None
+        if telemetry:
+            host, port = telemetry.rsplit(':', 1)
+            self.pusher = statspusher.StatsPusher(self, host, int(port))
+
         print "Adding signals"
         signal.signal(signal.SIGTERM, self.exit_now)
         signal.signal(signal.SIGINT, self.exit_now)
@@ -237,6 +251,12 @@ class MachineManager(object):
         self.tasks[task.name] = task
         return task
 
+    def get_discovery_info(self):
+        return {
+            'port': self.http_monitor.port,
+            'pid': os.getpid(),
+        }
+
     def start_task(self, task_name):
         self.tasks[task_name].start()
 
@@ -273,6 +293,17 @@ class MachineManager(object):
         print "Machine Sitter Monitor started at " + \
             "http://localhost:%s" % self.http_monitor.port
 
+        # Tell clients which port we ended up on.
+        try:
+            self.discovery = discovery.DiscoveryServer(
+                self.get_discovery_info)
+            self.discovery.start()
+        except socket.error, e:
+            print "Couldn't start the discovery server: %s" % e
+
+        if self.pusher:
+            self.pusher.start()
+
         stdout_loc = self.logmanager._calculate_filename(
             self.logmanager.stdout_location)
         stderr_loc = self.logmanager._calculate_filename(
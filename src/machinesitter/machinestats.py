@@ -1,54 +1,102 @@
 import os
+import threading
+import time
+from collections import deque
+
+import simplejson
+
+from sittercommon.machinedata import SessionPool
 from tasksitter.stats_collector import StatsCollector
 
 
 class MachineStats(StatsCollector):
 
-    def get_live_data(self):
-        self.update_hostname()
+    # Version of the /stats_all response format.
+    stats_all_format = 2
+
+    # Collected task stats are served from a cache for this many seconds, so
+    # concurrent requests for /stats_all only collect them once.
+    stats_all_ttl = 1
+
+    # Seconds to wait for a task sitter to return its stats.
+    task_stats_timeout = 2
+
+    # The number of past versions of the stats which deltas can be served
+    # against. Older versions get the full stats.
+    stats_history = 60
+
+    def __init__(self, harness):
+        super(MachineStats, self).__init__(harness)
+        self.stats_all_lock = threading.Lock()
+        self.stats_all = None
+        self.stats_all_time = 0
+
+        # Task sitters are asked for their stats every tick, keep the
+        # connections to them open.
+        self.sessions = SessionPool(max_requests=1)
+
+        # The version only increases when the stats change. It starts at the
+        # current time in milliseconds and increases at most once per
+        # stats_all_ttl, so versions from before a restart are never reused.
+        self.stats_version = int(time.time() * 1000)
+        self.stats_snapshots = deque(maxlen=self.stats_history)
+
+    def get_task_live_data(self, task):
+        """
+        Get the live data of a task, keyed by metric.
+        """
         data = {}
-        for task_name, task in self.harness.tasks.items():
-            running = bool(task.is_running())
-            data["%s-running" % task.name] = running
-            if not running:
-                data["%s-start" % task.name] = \
-                    "<a href='http://%s:%s/start_task?task_name=%s'>start</a>" % (
-                    self.hostname_external,
-                    self.harness.http_monitor.port,
-                    task.name)
-                data["%s-remove" % task.name] = \
-                    "<a href='http://%s:%s/remove_task?task_name=%s'>remove</a>" % (
-                    self.hostname_external,
-                    self.harness.http_monitor.port,
-                    task.name)
-            else:
-                data["%s-stop" % task.name] = \
-                    "<a href='http://%s:%s/stop_task?task_name=%s'>stop</a>" % (
-                    self.hostname_external,
-                    self.harness.http_monitor.port,
-                    task.name)
-
-                data["%s-reboot" % task.name] = \
-                    "<a href='http://%s:%s/restart_task?task_name=%s'>restart</a>" % (
-                    self.hostname_external,
-                    self.harness.http_monitor.port,
-                    task.name)
-
-                location = "http://%s:%s" % (
-                    self.hostname_external,
-                    task.http_monitoring_port)
-                data["%s-monitoring" % task.name] = "<a href='%s'>%s</a>" % (location,
-                                                                           location)
+        running = bool(task.is_running())
+        data["running"] = running
+        if not running:
+            data["start"] = \
+                "<a href='http://%s:%s/start_task?task_name=%s'>start</a>" % (
+                self.hostname_external,
+                self.harness.http_monitor.port,
+                task.name)
+            data["remove"] = \
+                "<a href='http://%s:%s/remove_task?task_name=%s'>remove</a>" % (
+                self.hostname_external,
+                self.harness.http_monitor.port,
+                task.name)
+        else:
+            data["stop"] = \
+                "<a href='http://%s:%s/stop_task?task_name=%s'>stop</a>" % (
+                self.hostname_external,
+                self.harness.http_monitor.port,
+                task.name)
 
-        load = os.getloadavg()
-        data['load_one_min'] = load[0]
-        data['load_five_min'] = load[1]
-        data['load_fifteen_min'] = load[2]
+            data["reboot"] = \
+                "<a href='http://%s:%s/restart_task?task_name=%s'>restart</a>" % (
+                self.hostname_external,
+                self.harness.http_monitor.port,
+                task.name)
 
+            location = "http://%s:%s" % (
+                self.hostname_external,
+                task.http_monitoring_port)
+            data["monitoring"] = "<a href='%s'>%s</a>" % (location,
+                                                          location)
         return data
 
-    def get_metadata(self):
-        self.update_hostname()
+    def get_task_metadata(self, task):
+        """
+        Get the fixed metadata of a task, keyed by field.
+        """
+        return {
+            'name': task.name,
+            'command': task.command,
+        }
+
+    def get_load(self):
+        load = os.getloadavg()
+        return {
+            'load_one_min': load[0],
+            'load_five_min': load[1],
+            'load_fifteen_min': load[2],
+        }
+
+    def get_machine_metadata(self):
         data = {}
         data['hostname'] = self.hostname
         data['hostname_external'] = self.hostname_external
@@ -58,8 +106,206 @@ class MachineStats(StatsCollector):
         data['task_sitter_starting_port'] = self.harness.task_sitter_starting_port
         data['machine_sitter_starting_port'] = self.harness.machine_sitter_starting_port
         data['task_definition_file'] = self.harness.task_definition_file
+        return data
+
+    def get_live_data(self):
+        self.update_hostname()
+        data = {}
         for task_name, task in self.harness.tasks.items():
-            data["%s-name" % task.name] = task.name
-            data["%s-command" % task.name] = task.command
+            for key, value in self.get_task_live_data(task).iteritems():
+                data["%s-%s" % (task.name, key)] = value
 
+        data.update(self.get_load())
         return data
+
+    def get_metadata(self):
+        self.update_hostname()
+        data = self.get_machine_metadata()
+        for task_name, task in self.harness.tasks.items():
+            for key, value in self.get_task_metadata(task).iteritems():
+                data["%s-%s" % (task.name, key)] = value
+
+        return data
+
+    def get_all_stats(self, args=None):
+        """
+        Get the stats of the machine and of every task, including the stats
+        of each running task from its task sitter, in one response:
+
+            {
+                'format': stats_all_format,
+                'version': stats_version,
+                'time': unix_time,
+                'machine': {
+                    metric: value,
+                },
+                'tasks': {
+                    task_name: {
+                        metric: value,
+                        'stats': {
+                            metric: value,
+                        },
+                    },
+                },
+            }
+
+        Only running tasks have 'stats'. Responses are cached for
+        stats_all_ttl seconds.
+
+        With a since=<version> argument only what changed after that version
+        is returned, see get_stats_delta(). The full stats are returned if the
+        version is too old.
+        """
+        with self.stats_all_lock:
+            now = time.time()
+            if (self.stats_all is None or
+                    now - self.stats_all_time >= self.stats_all_ttl):
+                self._update_stats_all(self._collect_all_stats())
+                self.stats_all_time = now
+
+            since = (args or {}).get('since')
+            if since is None:
+                return self.stats_all
+
+            try:
+                since = int(since)
+            except ValueError:
+                return self.stats_all
+
+            for version, snapshot in self.stats_snapshots:
+                if version == since:
+                    return self.get_stats_delta(since, snapshot,
+                                                self.stats_all)
+            return self.stats_all
+
+    def _update_stats_all(self, stats):
+        """
+        Replace the cached stats, moving to a new version if they changed.
+        """
+        if self.stats_all is not None:
+            if (stats['machine'] == self.stats_all['machine'] and
+                    stats['tasks'] == self.stats_all['tasks']):
+                return
+            self.stats_version += 1
+
+        stats['version'] = self.stats_version
+        self.stats_all = stats
+        self.stats_snapshots.append((self.stats_version, stats))
+
+    def get_stats_delta(self, since, old, new):
+        """
+        Get the changes between two versions of the stats:
+
+            {
+                'format': stats_all_format,
+                'version': new_version,
+                'since': since,
+                'time': unix_time,
+                'machine': {
+                    changed_metric: value,
+                },
+                'tasks': {
+                    task_name: {
+                        changed_metric: value,
+                        'stats': {
+                            changed_metric: value,
+                        },
+                    },
+                },
+                'added': [task_name],
+                'removed': [task_name],
+                'replaced': [task_name],
+            }
+
+        Unchanged tasks are left out. Added tasks and tasks which lost a
+        metric, e.g. when they stopped, are listed in 'added' and 'replaced'
+        and have all their data in 'tasks'.
+
+        @param since The version of the old stats.
+        @param old The old stats.
+        @param new The new stats.
+        @return The delta.
+        """
+        def changes(old_data, new_data):
+            return dict([
+                (key, value) for key, value in new_data.iteritems()
+                if key not in old_data or old_data[key] != value])
+
+        machine = changes(old['machine'], new['machine'])
+        tasks = {}
+        added = []
+        replaced = []
+        for task_name, task in new['tasks'].iteritems():
+            old_task = old['tasks'].get(task_name)
+            if old_task is None:
+                added.append(task_name)
+                tasks[task_name] = task
+                continue
+
+            if old_task == task:
+                continue
+
+            old_stats = old_task.get('stats', {})
+            stats = task.get('stats', {})
+            if (set(old_task) - set(task) or set(old_stats) - set(stats)):
+                replaced.append(task_name)
+                tasks[task_name] = task
+                continue
+
+            changed = changes(old_task, task)
+            if 'stats' in changed:
+                changed['stats'] = changes(old_stats, stats)
+            tasks[task_name] = changed
+
+        return {
+            'format': self.stats_all_format,
+            'version': new['version'],
+            'since': since,
+            'time': new['time'],
+            'machine': machine,
+            'tasks': tasks,
+            'added': added,
+            'removed': [task_name for task_name in old['tasks']
+                        if task_name not in new['tasks']],
+            'replaced': replaced,
+        }
+
+    def _collect_all_stats(self):
+        self.update_hostname()
+        machine = self.get_machine_metadata()
+        machine.update(self.get_load())
+
+        tasks = {}
+        threads = []
+        for task in self.harness.tasks.values():
+            data = self.get_task_metadata(task)
+            data.update(self.get_task_live_data(task))
+            tasks[task.name] = data
+            if data['running']:
+                thread = threading.Thread(target=self._load_task_stats,
+                                          args=(task, data))
+                thread.start()
+                threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        return {
+            'format': self.stats_all_format,
+            'time': time.time(),
+            'machine': machine,
+            'tasks': tasks,
+        }
+
+    def _load_task_stats(self, task, data):
+        try:
+            response = self.sessions.request(
+                'get', "http://localhost:%s/stats?nohtml=1&format=json" % (
+                    task.http_monitoring_port),
+                timeout=self.task_stats_timeout)
+            data['stats'] = simplejson.loads(response.content)
+        except:
+            # The task sitter may not be up yet.
+            data['stats'] = {}
+            self.sessions.discard(
+                "http://localhost:%s" % task.http_monitoring_port)
@@ -29,6 +29,10 @@ def parse_args(args):
                         help='Where logs should go',
                         default='/tmp')
 
+    parser.add_argument('--telemetry', dest='telemetry',
+                        help=('host:port of a cluster sitter to push stats '
+                              'to, instead of only being polled'))
+
     parser.add_argument("--daemon", dest="daemon",
                         default=False,
                         action="store_true",
@@ -78,6 +82,9 @@ def main(sys_args=None):
     if not 'log_location' in config:
         config['log_location'] = args.log_location
 
+    if args.telemetry:
+        config['telemetry'] = args.telemetry
+
     try:
         os.makedirs(config['log_location'])
     except:
@@ -88,7 +95,8 @@ def main(sys_args=None):
                                             machine_sitter_starting_port=40000,
                                             task_sitter_starting_port=50000,
                                             launch_location=orig_dir,
-                                            daemon=args.daemon)
+                                            daemon=args.daemon,
+                                            telemetry=config.get('telemetry'))
 
     task_definitions = config['task_definitions']
 
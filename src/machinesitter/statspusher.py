@@ -0,0 +1,150 @@
+"""
+Push the machine sitter's stats to a cluster sitter as they change, instead
+of waiting to be polled. See clustersitter/telemetry.py for the other end.
+
+The stream is newline delimited JSON over a plain TCP connection. The
+machine sitter sends:
+
+    {'type': 'hello', 'hostnames': [hostname], 'port': http_port}
+    {'type': 'stats', 'stats': stats_all}
+    {'type': 'heartbeat'}
+
+The first stats frame has the full /stats_all stats, the rest are deltas
+since the previous frame. The cluster sitter answers {'type': 'resync'} when
+it needs the full stats again.
+"""
+
+import select
+import socket
+import threading
+import time
+
+import simplejson
+
+
+class StatsPusher(object):
+
+    # Seconds between checks for changed stats.
+    interval = 1
+
+    # Seconds without changes after which a heartbeat is sent.
+    heartbeat_interval = 10
+
+    # Seconds to wait before reconnecting, doubled after each failure.
+    min_backoff = 1
+    max_backoff = 60
+
+    def __init__(self, harness, host, port):
+        """
+        @param harness The machine manager.
+        @param host The cluster sitter's telemetry host.
+        @param port The cluster sitter's telemetry port.
+        """
+        self.harness = harness
+        self.stats = harness.stats
+        self.host = host
+        self.port = port
+        self.thread = None
+        self.should_stop = False
+        self.sock = None
+        self.version = None
+        self.buffer = ''
+        self.last_send = 0
+        self.frames_sent = 0
+        self.bytes_sent = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.should_stop = True
+
+    def connect(self):
+        """Connect to the cluster sitter and introduce this machine."""
+        self.sock = socket.create_connection((self.host, self.port),
+                                             timeout=10)
+        self.version = None
+        self.buffer = ''
+        self.stats.update_hostname()
+        hostnames = set([self.stats.hostname_external, self.stats.hostname])
+        self.send({
+            'type': 'hello',
+            'hostnames': [name for name in hostnames if name],
+            'port': self.harness.http_monitor.port,
+        })
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+        self.sock = None
+
+    def send(self, frame):
+        data = "%s\n" % simplejson.dumps(frame)
+        self.sock.sendall(data)
+        self.last_send = time.time()
+        self.frames_sent += 1
+        self.bytes_sent += len(data)
+
+    def push(self):
+        """
+        Send the stats if they changed since the last frame, or a heartbeat
+        if nothing was sent for a while.
+        """
+        args = {}
+        if self.version is not None:
+            args['since'] = str(self.version)
+        stats = self.stats.get_all_stats(args)
+        if stats['version'] != self.version:
+            self.send({'type': 'stats', 'stats': stats})
+            self.version = stats['version']
+        elif time.time() - self.last_send >= self.heartbeat_interval:
+            self.send({'type': 'heartbeat'})
+
+    def receive(self, timeout):
+        """
+        Wait up to timeout seconds for requests from the cluster sitter.
+        """
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        if not readable:
+            return
+
+        data = self.sock.recv(4096)
+        if not data:
+            raise socket.error("connection closed by the cluster sitter")
+
+        self.buffer += data
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            try:
+                frame = simplejson.loads(line)
+            except ValueError:
+                continue
+            if frame.get('type') == 'resync':
+                self.version = None
+
+    def _run(self):
+        backoff = self.min_backoff
+        while not self.should_stop:
+            try:
+                self.connect()
+                print "Pushing stats to %s:%s" % (self.host, self.port)
+                backoff = self.min_backoff
+                while not self.should_stop:
+                    self.push()
+                    self.receive(self.interval)
+            except (socket.error, select.error), e:
+                print "Stats push to %s:%s failed: %s" % (
+                    self.host, self.port, e)
+            except:
+                import traceback
+                traceback.print_exc()
+
+            self.close()
+            if not self.should_stop:
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
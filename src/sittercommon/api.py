@@ -35,6 +35,7 @@ class ClusterState(object):
         self.provider_config = {}
         self.login_user = None
         self.raw = None
+        self.version = None
 
     def reload(self):
         url = "%s/overview?nohtml=1&format=json&compress=1" % self.url
@@ -57,6 +58,8 @@ class ClusterState(object):
             sys.exit(1)
 
         self.raw = data
+        # Version of the clustersitter state snapshot the data was read from.
+        self.version = data.get('snapshot_version')
         self.jobs = [ProductionJob.deserialize(j) for j in data['jobs']]
         self.machines = [MonitoredMachine.deserialize(
             m) for m in data['machines']]
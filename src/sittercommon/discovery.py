@@ -0,0 +1,82 @@
+"""
+Let clients find the machine sitter without scanning ports. The machine
+sitter's HTTP monitor takes the first free port from 40000 up, so it
+answers on a well known port with where it actually is:
+
+    GET http://host:DISCOVERY_PORT/  ->  {"port": 40000, "pid": 1234}
+"""
+
+import SocketServer
+import threading
+
+import requests
+import simplejson
+
+DISCOVERY_PORT = 39999
+
+
+class DiscoveryHandler(SocketServer.StreamRequestHandler):
+
+    # Seconds to wait for the request.
+    timeout = 5
+
+    def handle(self):
+        # Read the request headers, the path does not matter.
+        for _ in range(100):
+            line = self.rfile.readline(65536)
+            if not line.strip():
+                break
+
+        body = simplejson.dumps(self.server.get_info())
+        self.wfile.write(
+            "HTTP/1.0 200 OK\r\n"
+            "Content-Type: application/json\r\n"
+            "Content-Length: %s\r\n\r\n%s" % (len(body), body))
+
+
+class DiscoveryServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, get_info, port=DISCOVERY_PORT):
+        """
+        @param get_info A callable returning a dictionary describing the
+            machine sitter, with at least its 'port'.
+        @param port The port to listen on.
+        """
+        SocketServer.TCPServer.__init__(self, ('', port), DiscoveryHandler)
+        self.get_info = get_info
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       name="DiscoveryServer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def discover(hostname, port=DISCOVERY_PORT, timeout=2):
+    """
+    Ask a host where its machine sitter is.
+
+    @param hostname The host to ask.
+    @param port The discovery port.
+    @param timeout Seconds to wait for an answer.
+    @return The machine sitter's description or None if the host did not
+        answer.
+    """
+    try:
+        response = requests.get("http://%s:%s/" % (hostname, port),
+                                timeout=timeout)
+        info = simplejson.loads(response.content)
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+
+    if not isinstance(info, dict) or 'port' not in info:
+        return None
+    return info
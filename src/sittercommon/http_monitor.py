@@ -42,6 +42,13 @@ def file_process(cmd, filename, num_lines):
 
 class HTTPMonitorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
+    # HTTP/1.1 clients get a status line and headers and may keep the
+    # connection open for more requests, older clients just get the body.
+    protocol_version = 'HTTP/1.1'
+
+    # Seconds an idle kept alive connection is held open.
+    timeout = 60
+
     def __init__(self, monitor, new_handlers, *args, **kwargs):
         self.monitor = monitor
 
@@ -88,6 +95,18 @@ class HTTPMonitorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     def add_handler(self, path, callback):
         self.handlers[path] = callback
 
+    def _respond(self, output):
+        """
+        Write a response body, with headers if the client speaks HTTP/1.1.
+        """
+        if isinstance(output, unicode):
+            output = output.encode('utf-8')
+        if self.request_version == 'HTTP/1.1':
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(output)))
+            self.end_headers()
+        self.wfile.write(output)
+
     def _get_logfile(self, args):
         # @TODO This is a bit of a security problem...
         filename = args.get('name')
@@ -172,7 +191,7 @@ class HTTPMonitorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         args = dict([(k, v[0]) for k, v in array_args.items()])
 
         if not urldata.path in self.handlers:
-            self.wfile.write(self._usage(args))
+            self._respond(self._usage(args))
             return
 
         args['engine'] = self.engine
@@ -187,12 +206,10 @@ class HTTPMonitorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 if args.get('compress'):
                     output = zlib.compress(output)
 
-                self.wfile.write(output)
-            else:
-                self.wfile.write(output)
+            self._respond(output)
         except:
             import traceback
-            self.wfile.write(traceback.format_exc())
+            self._respond(traceback.format_exc())
 
         return
 
@@ -208,24 +225,29 @@ class HTTPMonitorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             except:
                 import traceback
                 traceback.print_exc()
-                self.wfile.write("Error decoding POST data")
+                self._respond("Error decoding POST data")
                 return traceback.format_exc()
         else:
+            # Skip the body so that a kept alive connection stays in sync.
+            length = self.headers.getheader('content-length')
+            if length:
+                self.rfile.read(int(length))
             args = {}
 
         if not urldata.path in self.handlers:
-            self.wfile.write(self._usage(args))
+            self._respond(self._usage(args))
             return
 
         args['engine'] = self.engine
 
-        self.wfile.write(self.handlers[urldata.path](args))
+        self._respond(self.handlers[urldata.path](args))
 
         return
 
 
 class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
-    pass
+    # Kept alive connections must not hold up shutting down.
+    daemon_threads = True
 
 
 class HTTPMonitor(object):
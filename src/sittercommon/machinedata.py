@@ -2,84 +2,327 @@ import logging
 import re
 import requests
 import simplejson
-import thread
 import threading
 import time
 import urllib
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+from sittercommon import discovery
 
 logger = logging.getLogger(__name__)
 
 
+class SessionPool(object):
+    """
+    Keep-alive HTTP sessions shared by everything talking to the same host,
+    with at most max_requests requests to each host in flight at once.
+    """
+
+    def __init__(self, max_requests=4):
+        """
+        @param max_requests The number of concurrent requests and open
+            connections allowed per host.
+        """
+        self.max_requests = max_requests
+        self.lock = threading.Lock()
+
+        # (session, semaphore) by host:port.
+        self.hosts = {}
+        self.requests = 0
+
+    def _get_host(self, url):
+        netloc = urlparse.urlsplit(url).netloc
+        with self.lock:
+            host = self.hosts.get(netloc)
+            if host is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.max_requests)
+                session.mount('http://', adapter)
+                host = self.hosts[netloc] = (
+                    session, threading.BoundedSemaphore(self.max_requests))
+            return host
+
+    def request(self, method, url, **kwargs):
+        """
+        Make a request on the host's session, waiting for a free slot if the
+        host already has max_requests requests in flight.
+
+        @param method The HTTP method, e.g. 'get'.
+        @param url The URL to request.
+        @return The response.
+        """
+        session, semaphore = self._get_host(url)
+        with semaphore:
+            self.requests += 1
+            return session.request(method, url, **kwargs)
+
+    def discard(self, url):
+        """
+        Close the connections to a host, e.g. when it stopped answering.
+
+        @param url A URL on the host.
+        """
+        netloc = urlparse.urlsplit(url).netloc
+        with self.lock:
+            host = self.hosts.pop(netloc, None)
+        if host is not None:
+            host[0].close()
+
+    def get_stats(self):
+        return {
+            'hosts': len(self.hosts),
+            'requests': self.requests,
+        }
+
+
 class MachineData(object):
-    def __init__(self, hostname, starting_port):
+
+    # Sessions shared by all machine data objects.
+    sessions = SessionPool()
+
+    # Requests made with async=True run on a thread pool of this size shared
+    # by all machine data objects. The pool is created on first use.
+    async_workers = 16
+    executor = None
+    executor_lock = threading.Lock()
+
+    # reload() waits on the stats of each running task, which are loaded on
+    # a separate pool of this size so they never queue behind async requests.
+    task_stats_workers = 16
+    task_stats_executor = None
+
+    # Machine sitter ports by hostname, shared by all machine data objects
+    # and trusted for port_cache_ttl seconds.
+    port_cache = {}
+    port_cache_ttl = 600
+    port_cache_lock = threading.Lock()
+
+    # Where hosts answer with the port of their machine sitter, see
+    # sittercommon/discovery.py.
+    discovery_port = discovery.DISCOVERY_PORT
+
+    # Seconds to wait for requests, and for probes while looking for the
+    # machine sitter.
+    request_timeout = 5
+    probe_timeout = 2
+
+    # Seconds between full reloads of the stats from sitters which serve
+    # deltas, in case a delta was lost or misapplied.
+    full_sync_interval = 300
+
+    def __init__(self, hostname, starting_port, portnum=None):
+        """
+        @param hostname The host the machine sitter runs on.
+        @param starting_port The first port to probe for the machine sitter.
+        @param portnum The port the machine sitter was last seen on. Skips
+            probing when given, the port is probed again if a request to it
+            fails.
+        """
         self.hostname = hostname
         self.portnum = None
         self.starting_port = starting_port
         self.url = ""
-        self._find_portnum()
+        # Whether the machine sitter serves /stats_all. None until the first
+        # reload finds out.
+        self.stats_all = None
+        # The version of the stats from /stats_all that tasks is at and when
+        # the full stats were last loaded.
+        self.stats_version = None
+        self.last_full_sync = 0
+        # Stats are both polled and pushed, see clustersitter/telemetry.py.
+        # Updates to the tasks and the stats version are made one at a time.
+        self.stats_lock = threading.RLock()
+        if portnum:
+            self.portnum = portnum
+            self.url = "http://%s:%s" % (self.hostname, self.portnum)
+        else:
+            self._find_portnum(use_cache=True)
         self.tasks = {}
         self.metadata = {}
         logger.info("New Machinedata: %s:%s" % (self.hostname,
                                                 self.portnum))
 
-    def _find_portnum(self):
-        found = False
-        port = self.starting_port
-        while not found:
-            try:
-                logger.info("Attempting to connect to %s" % (
-                        "%s:%s" % (self.hostname, port)))
-
-                # Verify we can actually make an http request
-                req = requests.get("http://%s:%s" % (self.hostname,
-                                                     port),
-                                   timeout=2)
-                if not req.content:
-                    raise Exception("No content recieved!")
-
-                found = True
-                self.portnum = port
-                logger.info("Successfully connected to %s:%s" % (
-                    self.hostname, self.portnum))
-            except:
-                import traceback
-                logger.warn("Failed to connect to %s:%s" % (
-                    self.hostname, port))
-                logger.warn(traceback.format_exc().splitlines()[-1])
-                port += 1
-                if port > self.starting_port + 15:
-                    self.url = ""
-                    self.portnum = None
-                    return
+    @classmethod
+    def get_cached_port(cls, hostname):
+        """
+        Get the port a host's machine sitter was last found on.
+
+        @return The port or None if it is not known or the entry expired.
+        """
+        with cls.port_cache_lock:
+            entry = cls.port_cache.get(hostname)
+            if entry is None:
+                return None
+            port, found_time = entry
+            if time.time() - found_time > cls.port_cache_ttl:
+                del cls.port_cache[hostname]
+                return None
+            return port
+
+    @classmethod
+    def set_cached_port(cls, hostname, port):
+        """
+        Remember where a host's machine sitter is, None to forget it.
+        """
+        with cls.port_cache_lock:
+            if port is None:
+                cls.port_cache.pop(hostname, None)
+            else:
+                cls.port_cache[hostname] = (port, time.time())
+
+    def _probe_port(self, port):
+        """
+        Check if a machine sitter answers on a port.
+
+        @return True if it answered or False.
+        """
+        try:
+            # Verify we can actually make an http request
+            req = requests.get("http://%s:%s" % (self.hostname, port),
+                               timeout=self.probe_timeout)
+            if not req.content:
+                raise Exception("No content recieved!")
+            return True
+        except:
+            import traceback
+            logger.warn("Failed to connect to %s:%s" % (
+                self.hostname, port))
+            logger.warn(traceback.format_exc().splitlines()[-1])
+            return False
+
+    def _discover_portnum(self):
+        """
+        Ask the host's discovery server where its machine sitter is.
+
+        @return The port or None if the host has no discovery server.
+        """
+        info = discovery.discover(self.hostname, self.discovery_port,
+                                  self.probe_timeout)
+        if info is None:
+            return None
+        if self._probe_port(info['port']):
+            return info['port']
+        return None
+
+    def _scan_portnum(self):
+        """
+        Probe every port the machine sitter may be on at once.
+
+        @return The lowest port with a machine sitter or None.
+        """
+        ports = range(self.starting_port, self.starting_port + 16)
+        found = []
+
+        # Plain threads instead of the shared executor, this may be called
+        # from an async request running on it.
+        def probe(port):
+            if self._probe_port(port):
+                found.append(port)
+
+        threads = [threading.Thread(target=probe, args=(port, ))
+                   for port in ports]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if not found:
+            return None
+        return min(found)
+
+    def _find_portnum(self, use_cache=False):
+        """
+        Find the machine sitter, through the port cache if use_cache is True,
+        then the host's discovery server and, if neither knows, by probing
+        the ports from starting_port up.
+
+        @param use_cache Whether a cached port may be used. Ports are only
+            looked up again because the cached one stopped working, so the
+            cache is bypassed by default.
+        @return The URL of the machine sitter or None if it wasn't found.
+        """
+        logger.info("Looking for the machine sitter on %s" % self.hostname)
+        port = None
+        if use_cache:
+            port = self.get_cached_port(self.hostname)
+        if port is None:
+            port = self._discover_portnum()
+        if port is None:
+            port = self._scan_portnum()
+
+        if port is None:
+            self.url = ""
+            self.portnum = None
+            self.set_cached_port(self.hostname, None)
+            return None
+
+        self.portnum = port
+        # The sitter may have been upgraded.
+        self.stats_all = None
+        self.stats_version = None
+        self.set_cached_port(self.hostname, port)
+        logger.info("Successfully connected to %s:%s" % (
+            self.hostname, self.portnum))
 
         self.url = "http://%s:%s" % (self.hostname,
                                      self.portnum)
         return self.url
 
-    def _make_request(self, function, path, host=None, async=False):
+    @classmethod
+    def get_executor(cls):
+        """
+        Get the thread pool async requests run on.
+        """
+        with cls.executor_lock:
+            if cls.executor is None:
+                cls.executor = ThreadPool(cls.async_workers)
+            return cls.executor
+
+    @classmethod
+    def get_task_stats_executor(cls):
+        """
+        Get the thread pool task stats are loaded on by reload().
+        """
+        with cls.executor_lock:
+            if cls.task_stats_executor is None:
+                cls.task_stats_executor = ThreadPool(cls.task_stats_workers)
+            return cls.task_stats_executor
+
+    def _make_request(self, method, path, host=None, async=False):
         if not async:
-            return self.__make_request(function, path, host)
+            return self.__make_request(method, path, host)
         else:
-            thread.start_new_thread(self.__make_request,
-                                    (function, path, host))
+            self.get_executor().apply_async(self.__make_request,
+                                            (method, path, host))
 
-    def __make_request(self, function, path, host):
+    def __make_request(self, method, path, host):
         val = None
         hostname = host
         if not hostname:
             hostname = self.url
 
         try:
-            val = function("%s/%s" % (hostname, path),
-                           timeout=5)
+            val = self.sessions.request(method, "%s/%s" % (hostname, path),
+                                        timeout=self.request_timeout)
+        except requests.exceptions.Timeout:
+            # The sitter is slow, not gone. Looking for it again won't help.
+            logger.warn("Timed out executing %s/%s" % (hostname, path))
+            return None
         except:
+            self.sessions.discard(hostname)
+            if hostname != self.url:
+                # A task sitter, the machine sitter hasn't moved.
+                logger.warn("Couldn't execute %s/%s!" % (hostname, path))
+                return None
+
             self._find_portnum()
-            hostname = host
-            if not hostname:
-                hostname = self.url
+            hostname = self.url
             try:
-                val = function("%s/%s" % (hostname, path),
-                               timeout=5)
+                val = self.sessions.request(
+                    method, "%s/%s" % (hostname, path),
+                    timeout=self.request_timeout)
             except:
                 logger.warn("Couldn't execute %s/%s!" % (
                     hostname, path))
@@ -90,7 +333,7 @@ class MachineData(object):
         return val
 
     def load_generic_page(self, host, page):
-        response = self._make_request(requests.get,
+        response = self._make_request('get',
                                       path="%s?nohtml=1&format=json" % page,
                                       host=host)
         if not response:
@@ -99,14 +342,171 @@ class MachineData(object):
         data = simplejson.loads(response.content)
         return data
 
-    def reload(self):
-        response = self._make_request(requests.get,
-                                      path="stats?nohtml=1&format=json")
-        if not response:
+    def get_stats_all_url(self):
+        """
+        Get the URL of the machine sitter's combined machine and task stats.
+        Only the changes since the last load are asked for, unless a full
+        sync is due.
+        """
+        return "%s/%s" % (self.url, self._get_stats_all_path())
+
+    def _get_stats_all_path(self):
+        path = "stats_all?nohtml=1&format=json"
+        if (self.stats_version is not None and
+                time.time() - self.last_full_sync < self.full_sync_interval):
+            path += "&since=%s" % self.stats_version
+        return path
+
+    def decode_stats_all(self, content):
+        """
+        Decode a /stats_all response. Machine sitters which do not serve
+        /stats_all answer with their usage page instead, in which case they
+        are marked as not supporting it.
+
+        @param content The response body.
+        @return The decoded stats or None if they are not supported.
+        """
+        try:
+            data = simplejson.loads(content)
+        except ValueError:
+            data = None
+        return self.check_stats_all(data)
+
+    def check_stats_all(self, data):
+        """
+        Check decoded /stats_all data, see decode_stats_all().
+
+        @param data The decoded response.
+        @return The stats or None if they are not supported.
+        """
+        if not isinstance(data, dict) or 'tasks' not in data:
+            logger.info(
+                "%s:%s does not serve stats_all, using stats" % (
+                    self.hostname, self.portnum))
+            self.stats_all = False
             return None
 
-        data = simplejson.loads(response.content)
+        self.stats_all = True
+        return data
+
+    def parse_stats_all(self, data):
+        """
+        Convert /stats_all data to task data. The machine metadata is updated
+        in place.
+
+        @param data The decoded stats, see decode_stats_all().
+        @return A dictionary of task data by task name or None if the data is
+            a delta which doesn't apply to the current tasks.
+        """
+        if 'since' in data:
+            return self.apply_stats_delta(data)
+
+        version = data.get('version')
+        if (self.stats_version is not None and version is not None and
+                version < self.stats_version):
+            # Full stats from a poll which was in flight while newer stats
+            # were pushed. Versions only go up, even across restarts of the
+            # machine sitter.
+            logger.debug(
+                "Ignoring stale stats at %s from %s:%s" % (
+                    version, self.hostname, self.portnum))
+            return self.tasks
+
+        self.metadata.update(data['machine'])
+        tasks = {}
+        for task_name, task_data in data['tasks'].iteritems():
+            tasks[task_name] = self._parse_task_stats(task_data)
+
+        self.stats_version = version
+        self.last_full_sync = time.time()
+        return tasks
+
+    def apply_stats_all(self, data):
+        """
+        Replace the task data with /stats_all data.
+
+        @param data The decoded stats, see decode_stats_all().
+        @return The new task data or None if the data is a delta which
+            doesn't apply to the current tasks, in which case the task data
+            is left alone.
+        """
+        with self.stats_lock:
+            tasks = self.parse_stats_all(data)
+            if tasks is not None:
+                self.tasks = tasks
+            return tasks
+
+    def apply_stats_delta(self, data):
+        """
+        Apply a /stats_all delta to the current task data. The task data is
+        copied, not changed in place.
+
+        @param data The decoded delta, see MachineStats.get_stats_delta().
+        @return A dictionary of task data by task name or None if the delta
+            is not against the current version.
+        """
+        if (self.stats_version is not None and
+                data['since'] < self.stats_version and
+                data['version'] <= self.stats_version):
+            # A poll which was in flight while newer stats were pushed, the
+            # current tasks are already past it.
+            logger.debug(
+                "Ignoring stale stats since %s from %s:%s" % (
+                    data['since'], self.hostname, self.portnum))
+            return self.tasks
+
+        if data['since'] != self.stats_version:
+            logger.warn(
+                "Got stats since %s from %s:%s, expected since %s" % (
+                    data['since'], self.hostname, self.portnum,
+                    self.stats_version))
+            self.stats_version = None
+            return None
+
+        self.metadata.update(data['machine'])
+        tasks = dict(self.tasks)
+        for task_name in data['removed']:
+            tasks.pop(task_name, None)
 
+        replace = set(data['added']) | set(data['replaced'])
+        for task_name, task_data in data['tasks'].iteritems():
+            if task_name in replace or task_name not in tasks:
+                tasks[task_name] = self._parse_task_stats(task_data)
+                continue
+
+            task = dict(tasks[task_name])
+            task_data = dict(task_data)
+            stats = task_data.pop('stats', None)
+            task.update(task_data)
+            if stats is not None:
+                self.set_task_stats(task, stats)
+            tasks[task_name] = task
+
+        self.stats_version = data['version']
+        return tasks
+
+    def _parse_task_stats(self, task_data):
+        """Convert the /stats_all data of one task to task data."""
+        task = dict(task_data)
+        stats = task.pop('stats', None)
+        if stats is not None:
+            self.set_task_stats(task, stats)
+        return task
+
+    def get_stats_url(self):
+        """
+        Get the URL of the machine sitter's stats page.
+        """
+        return "%s/stats?nohtml=1&format=json" % self.url
+
+    def parse_stats(self, data):
+        """
+        Split the machine sitter's stats into machine metadata and tasks. The
+        metadata is updated in place.
+
+        @param data The decoded stats page.
+        @return A dictionary of task data by task name.
+        """
         task_data = {}
         new_tasks = {}
         for key, value in data.iteritems():
@@ -120,22 +520,67 @@ class MachineData(object):
                 task_data[task_name] = {}
             task_data[task_name][metric] = value
 
-        # Update all tasks in parallel
-        update_threads = []
-        for task_name in task_data.keys():
-            task_dict = task_data[task_name]
+        for task_dict in task_data.values():
             new_tasks[task_dict['name']] = task_dict
-            if task_dict['running']:
-                t = threading.Thread(target=self.run_update_task_data,
-                                     args=[new_tasks, task_dict['name']])
-                t.start()
-                update_threads.append(t)
-
-        while update_threads:
-            for thread in update_threads:
-                if not thread.isAlive():
-                    update_threads.remove(thread)
-            time.sleep(0.0001)
+        return new_tasks
+
+    def get_task_stats_url(self, task):
+        """
+        Get the URL of a task sitter's stats page.
+
+        @param task The task data.
+        """
+        return "%s/stats?nohtml=1&format=json" % self.strip_html(
+            task['monitoring'])
+
+    def set_task_stats(self, task, data):
+        """
+        Merge the stats from a task sitter into the task data.
+
+        @param task The task data.
+        @param data The decoded stats page of the task sitter.
+        """
+        stats_page = self.strip_html(task['monitoring'])
+        task.update(data)
+        task['stats_page'] = "%s/stats" % stats_page
+        task['logs_page'] = "%s/logs" % stats_page
+
+    def reload(self):
+        if self.stats_all is not False:
+            # A delta which doesn't apply resets the stats version, so it is
+            # followed by a request for the full stats. The previous tasks
+            # are kept if that fails too.
+            for attempt in range(2):
+                response = self._make_request(
+                    'get', path=self._get_stats_all_path())
+                if not response:
+                    return None
+
+                data = self.decode_stats_all(response.content)
+                if data is None:
+                    break
+                tasks = self.apply_stats_all(data)
+                if tasks is not None:
+                    return tasks
+            else:
+                return None
+
+        response = self._make_request('get',
+                                      path="stats?nohtml=1&format=json")
+        if not response:
+            return None
+
+        data = simplejson.loads(response.content)
+        new_tasks = self.parse_stats(data)
+
+        # Update all tasks in parallel
+        running = [task_name for task_name, task_dict in new_tasks.iteritems()
+                   if task_dict['running']]
+        if running:
+            self.get_task_stats_executor().map(
+                lambda task_name: self.run_update_task_data(
+                    new_tasks, task_name),
+                running)
 
         self.tasks = new_tasks
         return self.tasks
@@ -156,19 +601,18 @@ class MachineData(object):
 
     def update_task_data(self, tasks, task_name):
         stats_page = self.strip_html(tasks[task_name]['monitoring'])
-        tasks[task_name].update(
+        self.set_task_stats(
+            tasks[task_name],
             self.load_generic_page(
                 stats_page,
                 'stats'))
-        tasks[task_name]['stats_page'] = "%s/stats" % stats_page
-        tasks[task_name]['logs_page'] = "%s/logs" % stats_page
         return tasks
 
     def add_task(self, config):
         params = '&'.join(
             "%s=%s" % (
                 k, urllib.quote_plus(str(v))) for k, v in config.items())
-        val = self._make_request(requests.get,
+        val = self._make_request('get',
                                  path="add_task?%s" % params)
         if val:
             return val.content
@@ -181,7 +625,7 @@ class MachineData(object):
 
         tid = urllib.quote(task['name'])
         val = self._make_request(
-            requests.get,
+            'get',
             path="remove_task?task_name=%s" % tid)
 
         if val:
@@ -195,7 +639,7 @@ class MachineData(object):
 
         tid = urllib.quote(task['name'])
         val = self._make_request(
-            requests.get,
+            'get',
             path="start_task?task_name=%s" % tid,
             async=True)
 
@@ -210,7 +654,7 @@ class MachineData(object):
 
         tid = urllib.quote(task['name'])
         val = self._make_request(
-            requests.get,
+            'get',
             path="restart_task?task_name=%s" % tid,
             async=True)
 
@@ -225,7 +669,7 @@ class MachineData(object):
 
         tid = urllib.quote(task['name'])
         val = self._make_request(
-            requests.get,
+            'get',
             path="stop_task?task_name=%s" % tid,
             async=True)
 
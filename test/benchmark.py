@@ -0,0 +1,365 @@
+#!/usr/bin/python
+"""
+Benchmark the clustersitter state calculator against a synthetic fleet.
+
+Machines are fake MonitoredMachine objects with canned task data and machines
+are "launched" by a stub provider, so no network calls are made. Actions are
+run through the real ClusterActionManager against the fake machines. Each
+fleet size is run through the following scenarios:
+
+    steady -- Nothing changes between cycles.
+    failure -- A fraction of the fleet drops out of monitoring and has to be
+        repaired.
+    add -- A new job is added which requires new machines.
+    update -- An existing job is redeployed to every machine running it.
+
+Run from the test directory:
+
+    PYTHONPATH=.:..:../src/ python benchmark.py --sizes 1000,5000 --tasks 20
+"""
+import logging
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import sittercommon.arg_parser as argparse
+from clustersitter import clusterstate
+from clustersitter.clusterstate import ClusterState
+from clustersitter.machineconfig import MachineConfig
+from clustersitter.machinemonitor import MachineMonitor
+from clustersitter.monitoredmachine import MonitoredMachine
+from clustersitter.productionjob import ProductionJob
+from clustersitter.providers.machineprovider import MachineProvider
+
+SCENARIOS = ['steady', 'failure', 'add', 'update']
+
+
+class FakeSitter(object):
+    """Just enough of a ClusterSitter to drive ClusterState."""
+
+    def __init__(self, log_location, action_workers=32):
+        self.log_location = log_location
+        self.stats_poll_interval = 5
+        self.calculate_deadline = 30
+        self.deployment_workers = 1
+        self.action_workers = action_workers
+        self.dns_provider = None
+        self.state = ClusterState(self)
+
+    def add_machines(self, machines, update_dns=True, deploying=False):
+        for machine in machines:
+            status = None
+            if deploying:
+                status = self.state.Deploying
+            self.state.monitor_machine(machine)
+            self.state.add_machine(machine, status=status, existing=True)
+
+    def decomission_machine(self, machine):
+        self.state.unmonitor_machine(machine)
+        self.state.remove_machine(machine)
+        provider = self.state.get_zone_provider(
+            machine.config.shared_fate_zone)
+        if provider:
+            provider.decomission(machine)
+
+
+class StubProvider(MachineProvider):
+    """A machine provider which hands out fake machine configs."""
+
+    def __init__(self, zones):
+        self.zones = zones
+        self.requests = 0
+        self.launched = 0
+        self.decomissioned = 0
+
+    def get_all_shared_fate_zones(self):
+        return self.zones
+
+    def list_available_machines(self, sf_zone):
+        return []
+
+    def usable(self):
+        return True
+
+    def fill_request(self, zone, cpus, mem_per_job=None):
+        self.requests += 1
+        configs = []
+        for n in range(cpus):
+            self.launched += 1
+            configs.append(MachineConfig(
+                "new%s.%s" % (self.launched, zone), zone, 1,
+                mem_per_job or 1024))
+        return configs
+
+    def decomission(self, machine):
+        self.decomissioned += 1
+        return True
+
+
+class FakeDataManager(object):
+    """
+    A MachineData replacement that serves canned task data. Task management
+    calls update the canned data.
+    """
+
+    def __init__(self, hostname, tasks):
+        self.hostname = hostname
+        self.portnum = 40000
+        self.url = "http://%s:%s" % (hostname, self.portnum)
+        self.tasks = tasks
+
+    def reload(self):
+        return self.tasks
+
+    def add_task(self, task_configuration):
+        name = task_configuration['name']
+        self.tasks[name] = {'name': name, 'running': False}
+        return True
+
+    def start_task(self, task):
+        task['running'] = True
+        return True
+
+    def restart_task(self, task):
+        task['running'] = True
+        return True
+
+    def stop_task(self, task):
+        task['running'] = False
+        return True
+
+
+class BenchmarkJob(ProductionJob):
+    """
+    A production job which deploys to fake machines. New machines are
+    requested from the zone's stub provider.
+    """
+
+    def deploy(self, zone, machine=None, repair=False, version=None):
+        if version is not None:
+            self.recipe_options['version'] = version
+
+        if machine is None:
+            return self.deploy_new(zone, 1)[0]
+        elif repair:
+            self.sitter.state.monitor_machine(machine)
+        else:
+            machine.datamanager.add_task(self.task_configuration)
+        return machine
+
+    def deploy_new(self, zone, count):
+        provider = self.sitter.state.get_zone_provider(zone)
+        machines = []
+        for config in provider.fill_request(zone, count):
+            machine = make_machine(
+                len(self.sitter.state.machines), zone, [], config)
+            machine.datamanager.add_task(self.task_configuration)
+            self.sitter.add_machines([machine], deploying=True)
+            machines.append(machine)
+        return machines
+
+
+def make_machine(number, zone, task_names, config=None):
+    if config is None:
+        config = MachineConfig("host%s.%s" % (number, zone), zone, 1, 1024)
+    machine = MonitoredMachine(config, machine_number=number)
+    tasks = {}
+    for name in task_names:
+        tasks[name] = {'name': name, 'running': True}
+    machine.datamanager = FakeDataManager(config.hostname, tasks)
+    machine.loaded = True
+    return machine
+
+
+def make_job(sitter, name, zones, count):
+    layout = dict([(z, {'cpu': count, 'mem': 1024}) for z in zones])
+    return BenchmarkJob(
+        sitter, '', {'name': name, 'command': 'true'}, layout, None)
+
+
+def build_state(num_machines, num_tasks, num_zones, log_location,
+                action_workers=32):
+    # Repair jobs are created by the state, make sure they use fake machines.
+    clusterstate.ProductionJob = BenchmarkJob
+
+    sitter = FakeSitter(log_location, action_workers)
+    state = sitter.state
+    monitor = MachineMonitor(parent=sitter, number=0)
+    state.monitors.append((monitor, None))
+
+    zones = ["zone-%s" % z for z in range(num_zones)]
+    state.add_provider('stub', StubProvider(zones))
+
+    task_names = ["task%s" % t for t in range(num_tasks)]
+    per_zone = num_machines / num_zones
+    for name in task_names:
+        state.job_graph.add_job(make_job(sitter, name, zones, per_zone))
+
+    for number in range(num_machines):
+        machine = make_machine(number, zones[number % num_zones], task_names)
+        state.monitor_machine(machine)
+        state.add_machine(machine, existing=True)
+    return state
+
+
+def run_cycle(state):
+    """
+    Run a calculate/process cycle and wait for the actions to complete.
+
+    @return A dictionary of cycle results.
+    """
+    requests = sum([p.requests for p in state.providers.values()])
+    start = time.time()
+    state.calculate()
+    calculate_time = time.time() - start
+
+    emitted = {}
+    for action in state.actions.pending:
+        name = action.__class__.__name__
+        emitted[name] = emitted.get(name, 0) + 1
+
+    start = time.time()
+    state.process()
+    process_time = time.time() - start
+
+    start = time.time()
+    state.actions.join()
+    drain_time = time.time() - start
+    state.process()
+    requests = sum([p.requests for p in state.providers.values()]) - requests
+
+    phases = state.profiler.get_stats()['phases']
+    return {
+        'calculate': calculate_time,
+        'process': process_time,
+        'drain': drain_time,
+        'phases': dict([(p, phases[p]['last']) for p in state.phases]),
+        'actions': emitted,
+        'provider_requests': requests,
+        'action_stats': state.actions.get_stats(),
+    }
+
+
+def scenario_steady(state, args):
+    pass
+
+
+def scenario_failure(state, args):
+    machines = state.machines.keys()
+    count = int(len(machines) * args.fail)
+    for machine in machines[:count]:
+        state.unmonitor_machine(machine)
+
+
+def scenario_add(state, args):
+    zones = state.get_zones()
+    count = max(int(len(state.machines) * args.new_job / len(zones)), 1)
+    state.add_job(make_job(state.sitter, 'newtask', zones, count))
+
+
+def scenario_update(state, args):
+    job = state.get_job('task0')
+    job.recipe_options['version'] = 'v2'
+    state.add_job(job, redeploy=True)
+
+
+def get_max_rss():
+    """Get the peak resident set size of the process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_scenario(name, size, args, log_location):
+    state = build_state(
+        size, args.tasks, args.zones, log_location, args.action_workers)
+    state.deployment_workers = args.workers
+
+    # Settle the initial full reconcile before changing anything.
+    run_cycle(state)
+    globals()['scenario_%s' % name](state, args)
+
+    results = []
+    for cycle in range(args.cycles):
+        result = run_cycle(state)
+        results.append(result)
+        if name != 'steady' and not result['actions']:
+            break
+    return results
+
+
+def print_results(name, size, results):
+    print "%s x %s machines (peak rss %.1fMB)" % (name, size, get_max_rss())
+    for cycle, result in enumerate(results):
+        print "  cycle %s: calculate %.3fs, process %.3fs, drain %.3fs" % (
+            cycle, result['calculate'], result['process'], result['drain'])
+        slowest = sorted(
+            result['phases'].items(), key=lambda p: p[1], reverse=True)[:3]
+        print "    slowest phases: %s" % ', '.join(
+            ["%s %.3fs" % phase for phase in slowest])
+        if result['actions']:
+            print "    actions: %s" % ', '.join([
+                "%s=%s" % action
+                for action in sorted(result['actions'].items())])
+        if result['actions']:
+            stats = result['action_stats']
+            print "    action workers: %s, max queued %s, utilization %.2f" % (
+                stats['workers'], stats['max_queued'], stats['utilization'])
+        if result['provider_requests']:
+            print "    provider requests: %s" % result['provider_requests']
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the clustersitter state calculator")
+    parser.add_argument("--sizes", dest="sizes", default="100,1000,10000",
+                        help="Comma separated list of fleet sizes")
+    parser.add_argument("--scenarios", dest="scenarios",
+                        default=','.join(SCENARIOS),
+                        help="Comma separated list of scenarios to run")
+    parser.add_argument("--tasks", dest="tasks", type=int,
+                        default=20, help="Number of tasks per machine")
+    parser.add_argument("--zones", dest="zones", type=int,
+                        default=4, help="Number of shared fate zones")
+    parser.add_argument("--cycles", dest="cycles", type=int,
+                        default=3, help="Max number of cycles per scenario")
+    parser.add_argument("--fail", dest="fail", type=float, default=0.1,
+                        help="Fraction of machines to fail")
+    parser.add_argument("--new-job", dest="new_job", type=float,
+                        default=0.05,
+                        help="Fraction of the fleet a new job requires")
+    parser.add_argument("--workers", dest="workers", type=int, default=1,
+                        help="Number of job deployment planning threads")
+    parser.add_argument("--action-workers", dest="action_workers", type=int,
+                        default=32, help="Number of action worker threads")
+    parser.add_argument("--log-level", dest="log_level", default="CRITICAL",
+                        help="Log level for the clustersitter modules")
+    return parser.parse_args(args=args)
+
+
+def main(sys_args=None):
+    if sys_args is None:
+        sys_args = sys.argv[1:]
+    args = parse_args(sys_args)
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    scenarios = args.scenarios.split(',')
+    for name in scenarios:
+        if name not in SCENARIOS:
+            print "Unknown scenario '%s'" % name
+            return 1
+
+    for size in sizes:
+        for name in scenarios:
+            log_location = tempfile.mkdtemp()
+            try:
+                results = run_scenario(name, size, args, log_location)
+                print_results(name, size, results)
+            finally:
+                shutil.rmtree(log_location)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
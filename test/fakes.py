@@ -0,0 +1,111 @@
+"""
+Stand-ins shared by the tests for the sitter, machines, jobs and machine
+sitter stats.
+"""
+import copy
+import socket
+import tempfile
+
+from clustersitter.clusterstate import ClusterState
+from machinesitter.machinestats import MachineStats
+
+
+def closed_port():
+    """Get a port nothing listens on."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class FakeSitter(object):
+    """Just enough of a ClusterSitter to drive ClusterState."""
+
+    def __init__(self, log_location=None):
+        if log_location is None:
+            log_location = tempfile.mkdtemp()
+        self.log_location = log_location
+        self.stats_poll_interval = 5
+        self.poll_concurrency = 4
+        self.poll_timeout = 1
+        self.calculate_deadline = 30
+        self.deployment_workers = 1
+        self.action_workers = 4
+        self.rate_limits = {}
+        self.telemetry = None
+        self.state = ClusterState(self)
+
+
+class FakeConfig(object):
+
+    def __init__(self, hostname, zone='zone-a', cpus=1, mem=1024):
+        self.hostname = hostname
+        self.shared_fate_zone = zone
+        self.cpus = cpus
+        self.mem = mem
+
+
+class FakeMachine(object):
+
+    def __init__(self, hostname, zone='zone-a', cpus=1, mem=1024):
+        self.hostname = hostname
+        self.config = FakeConfig(hostname, zone, cpus, mem)
+
+    def is_initialized(self):
+        return True
+
+    def get_tasks(self):
+        return {}
+
+    def __repr__(self):
+        return self.hostname
+
+
+class FakeJob(object):
+
+    def __init__(self, name, cpu=1, mem=0, linked_job=None):
+        self.name = name
+        self.linked_job = linked_job
+        self.persistent = False
+        self.cpu = cpu
+        self.mem = mem
+
+    def get_resource_demand(self, zone):
+        return (self.cpu, self.mem)
+
+    def __str__(self):
+        return self.name
+
+
+class FakeResponse(object):
+
+    def __init__(self, content):
+        self.content = content
+
+
+class FakeMachineStats(MachineStats):
+    """Serve canned stats instead of collecting them from a harness."""
+
+    stats_all_ttl = 0
+
+    def __init__(self, machine, tasks, hostname=None):
+        """
+        @param machine The machine stats.
+        @param tasks The task stats by task name.
+        @param hostname The hostname of the machine. Optional.
+        """
+        self.fake_hostname = hostname
+        super(FakeMachineStats, self).__init__(None)
+        self.current = {
+            'format': self.stats_all_format,
+            'time': 0,
+            'machine': machine,
+            'tasks': tasks,
+        }
+
+    def update_hostname(self):
+        self.hostname = self.hostname_external = self.fake_hostname
+
+    def _collect_all_stats(self):
+        return copy.deepcopy(self.current)
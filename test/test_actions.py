@@ -0,0 +1,206 @@
+import threading
+import time
+import unittest
+
+from clustersitter.actions import (
+    PRIORITY_CLEANUP, PRIORITY_DEPLOY, PRIORITY_REPAIR, PRIORITY_TASK,
+    ClusterActionManager, KeyedWorkerPool, StartTaskAction, StopTaskAction)
+
+
+class FakeState(object):
+
+    def get_job(self, name):
+        return None
+
+
+class FakeSitter(object):
+
+    def __init__(self):
+        self.state = FakeState()
+
+
+class FakeAction(object):
+
+    def __init__(self, name, log, machine=None, release=None,
+                 priority=PRIORITY_TASK):
+        self.name = name
+        self.log = log
+        self.release = release
+        self.priority = priority
+        if machine is not None:
+            self.machine = machine
+
+    def get_key(self):
+        return None
+
+    def get_target(self):
+        return None
+
+    def run(self):
+        self.log.append(('start', self.name))
+        if self.release:
+            self.release.wait(5)
+        self.log.append(('end', self.name))
+
+    def __str__(self):
+        return self.name
+
+
+class KeyedWorkerPoolTests(unittest.TestCase):
+
+    def test_key_order(self):
+        pool = KeyedWorkerPool(4)
+        log = []
+        for n in range(20):
+            pool.add('m1', FakeAction('a%s' % n, log))
+        self.assertTrue(pool.join(5))
+
+        # Actions on the same key never overlap and keep their order.
+        expected = []
+        for n in range(20):
+            expected.extend([('start', 'a%s' % n), ('end', 'a%s' % n)])
+        self.assertEqual(log, expected)
+        self.assertEqual(pool.get_stats()['completed'], 20)
+
+    def test_bounded_workers(self):
+        pool = KeyedWorkerPool(2)
+        log = []
+        release = threading.Event()
+        for n in range(5):
+            pool.add(n, FakeAction('a%s' % n, log, release=release))
+
+        time.sleep(0.1)
+        stats = pool.get_stats()
+        self.assertEqual(stats['busy'], 2)
+        self.assertEqual(stats['queued'], 3)
+        self.assertEqual(len(pool.workers), 2)
+        self.assertFalse(pool.join(0.01))
+
+        # Queued actions are dropped on stop, running ones finish.
+        self.assertEqual(len(pool.stop()), 3)
+        release.set()
+        self.assertTrue(pool.join(5))
+        self.assertEqual(len(log), 4)
+
+    def test_priority(self):
+        pool = KeyedWorkerPool(1)
+        log = []
+        release = threading.Event()
+        pool.add('block', FakeAction('block', log, release=release))
+        time.sleep(0.05)
+        for name, priority in (('cleanup', PRIORITY_CLEANUP),
+                               ('deploy', PRIORITY_DEPLOY),
+                               ('task', PRIORITY_TASK),
+                               ('repair', PRIORITY_REPAIR)):
+            pool.add(name, FakeAction(name, log, priority=priority))
+        release.set()
+        self.assertTrue(pool.join(5))
+        self.assertEqual(
+            [name for event, name in log if event == 'start'],
+            ['block', 'repair', 'task', 'deploy', 'cleanup'])
+
+    def test_reserved_workers(self):
+        pool = KeyedWorkerPool(2, reserved=1)
+        log = []
+        release = threading.Event()
+        for n in range(2):
+            pool.add(n, FakeAction(
+                'deploy%s' % n, log, release=release,
+                priority=PRIORITY_DEPLOY))
+        pool.add('m1', FakeAction('repair', log, priority=PRIORITY_REPAIR))
+
+        # Background actions leave a worker free for the repair.
+        time.sleep(0.1)
+        self.assertEqual(log, [('start', 'deploy0'), ('start', 'repair'),
+                               ('end', 'repair')])
+        self.assertEqual(pool.get_stats()['background_busy'], 1)
+        release.set()
+        self.assertTrue(pool.join(5))
+
+    def test_manager(self):
+        notified = []
+        manager = ClusterActionManager(notify=notified.append, workers=2)
+        log = []
+        manager.add(FakeAction('a', log, machine='m1'))
+        manager.add(FakeAction('b', log, machine='m1'))
+        manager.add(FakeAction('c', log))
+        self.assertEqual(manager.get_stats()['pending'], 3)
+
+        manager.process()
+        self.assertEqual(manager.pending, [])
+        self.assertTrue(manager.join(5))
+        self.assertTrue(log.index(('end', 'a')) < log.index(('start', 'b')))
+        self.assertEqual(sorted([str(a) for a in notified]), ['a', 'b', 'c'])
+
+
+class ClusterActionManagerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sitter = FakeSitter()
+        self.notified = []
+        self.manager = ClusterActionManager(
+            notify=self.notified.append, workers=2)
+
+    def task_action(self, cls, machine='m1', task='web'):
+        return cls(self.sitter, 'zone-a', machine, task)
+
+    def test_duplicates(self):
+        self.assertTrue(self.manager.add(self.task_action(StartTaskAction)))
+        self.assertFalse(self.manager.add(self.task_action(StartTaskAction)))
+        self.assertTrue(self.manager.add(
+            self.task_action(StartTaskAction, task='db')))
+        self.manager.process()
+        self.assertTrue(self.manager.join(5))
+        self.assertEqual(len(self.notified), 2)
+
+        # Completed actions are not repeated within the grace period.
+        self.assertFalse(self.manager.add(self.task_action(StartTaskAction)))
+        self.manager.grace_period = 0
+        self.assertTrue(self.manager.add(self.task_action(StartTaskAction)))
+        self.assertEqual(self.manager.get_stats()['duplicates'], 2)
+
+    def test_superseded(self):
+        # Hold the machine queue so later actions stay queued.
+        release = threading.Event()
+        self.manager.add(FakeAction('block', [], 'm1', release))
+        self.manager.add(self.task_action(StopTaskAction))
+        self.manager.process()
+        start = self.task_action(StartTaskAction)
+        self.assertTrue(self.manager.add(start))
+        self.manager.process()
+
+        stop = self.task_action(StopTaskAction)
+        self.assertTrue(self.manager.add(stop))
+        self.assertEqual(self.manager.get_stats()['superseded'], 2)
+        self.manager.process()
+        release.set()
+        self.assertTrue(self.manager.join(5))
+        self.assertEqual([str(a) for a in self.notified],
+                         ['block', str(stop)])
+        self.assertEqual(start.trace['outcome'], 'superseded')
+        self.assertEqual(start.trace['started'], None)
+
+    def test_trace(self):
+        self.manager.grace_period = 0
+        for n in range(2):
+            self.manager.add(self.task_action(StartTaskAction))
+            self.manager.process()
+            self.assertTrue(self.manager.join(5))
+
+        # The job does not exist so the action fails and is retried.
+        trace = self.manager.get_trace()
+        self.assertEqual([(r['name'], r['outcome'], r['retries'])
+                          for r in trace['recent']],
+                         [('StartTaskAction(m1, web)', 'failed', 1),
+                          ('StartTaskAction(m1, web)', 'failed', 0)])
+        record = trace['recent'][0]
+        self.assertTrue(
+            record['enqueued'] <= record['started'] <= record['finished'])
+        stats = trace['types']['StartTaskAction']
+        self.assertEqual(stats['outcomes'], {'failed': 2})
+        self.assertEqual(stats['run']['count'], 2)
+        self.assertEqual(stats['wait']['count'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+
+from clustersitter.calcstats import CalculationProfiler, RollingHistogram
+from clustersitter.clusterstats import ClusterStats
+from fakes import FakeSitter
+
+
+class RollingHistogramTests(unittest.TestCase):
+
+    def test_stats(self):
+        histogram = RollingHistogram(size=10)
+        self.assertEqual(histogram.get_stats(), {'count': 0, 'total': 0.0})
+
+        for value in range(20):
+            histogram.add(value)
+        stats = histogram.get_stats()
+        self.assertEqual(stats['count'], 20)
+        self.assertEqual(stats['total'], sum(range(20)))
+        self.assertEqual(stats['min'], 10)
+        self.assertEqual(stats['max'], 19)
+        self.assertEqual(stats['last'], 19)
+        self.assertEqual(stats['p50'], 15)
+        self.assertEqual(stats['p99'], 19)
+
+
+class FakeAction(object):
+    pass
+
+
+class CalculationProfilerTests(unittest.TestCase):
+
+    def test_cycle(self):
+        profiler = CalculationProfiler(deadline=10)
+        profiler.start_cycle()
+        self.assertEqual(profiler.run_phase('one', lambda: 1), 1)
+        self.assertRaises(ValueError, profiler.run_phase, 'two',
+                          lambda: int('x'))
+        profiler.end_cycle([FakeAction(), FakeAction()])
+
+        stats = profiler.get_stats()
+        self.assertEqual(stats['cycles']['count'], 1)
+        self.assertEqual(stats['overruns'], 0)
+        self.assertEqual(set(stats['phases'].keys()), set(['one', 'two']))
+        self.assertEqual(stats['actions'], {'FakeAction': 2})
+        self.assertEqual(stats['current_phase'], None)
+
+    def test_deadline(self):
+        profiler = CalculationProfiler(deadline=-1)
+        self.assertFalse(profiler.check_deadline())
+
+        profiler.start_cycle()
+        self.assertTrue(profiler.check_deadline())
+        self.assertFalse(profiler.check_deadline())
+        profiler.end_cycle([])
+        self.assertEqual(profiler.get_stats()['overruns'], 1)
+
+
+class ClusterStatsTests(unittest.TestCase):
+
+    def test_calc_stats(self):
+        sitter = FakeSitter()
+        sitter.state.profiler.start_cycle()
+        sitter.state.profiler.end_cycle([FakeAction()])
+
+        # The action worker stats don't hide the action counts.
+        stats = ClusterStats(sitter).calc_stats({})
+        self.assertEqual(stats['actions'], {'FakeAction': 1})
+        self.assertEqual(stats['action_workers'],
+                         sitter.state.actions.get_stats())
@@ -0,0 +1,75 @@
+import shutil
+import tempfile
+import unittest
+
+from clustersitter.clusterstate import JobState
+from clustersitter.machineconfig import MachineConfig
+from clustersitter.machinemonitor import MachineMonitor
+from clustersitter.monitoredmachine import MonitoredMachine
+from fakes import FakeSitter
+
+
+class MonitoredSitter(FakeSitter):
+
+    def __init__(self, log_location):
+        super(MonitoredSitter, self).__init__(log_location)
+        self.state.monitors.append(
+            (MachineMonitor(parent=self, number=0), None))
+
+
+def make_config(hostname):
+    return MachineConfig(hostname, 'zone-a', 1, 1024)
+
+
+class CheckpointTests(unittest.TestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def test_restore(self):
+        state = MonitoredSitter(self.location).state
+        active = MonitoredMachine(make_config('m1'))
+        active.restore(40001, {'web': {'name': 'web', 'running': True}})
+        active.config.dns_name = '0.web.zone-a'
+        deploying = MonitoredMachine(make_config('m2'))
+        state.add_machine(active)
+        state.add_machine(deploying, status=state.Deploying)
+        state.desired_jobs.add_tasks('web', 'zone-a', [active])
+        state.desired_jobs.add_tasks('web', 'zone-a', [], create=2)
+        state.desired_jobs.set_pending_deploying('zone-a', 'web', 1)
+        self.assertTrue(state.save_checkpoint())
+
+        state = MonitoredSitter(self.location).state
+        configs = [make_config(h) for h in ('m1', 'm2', 'm3')]
+        remaining = state.restore_checkpoint(configs)
+
+        # Only the active machine is restored, the others are added as new.
+        self.assertEqual([m.hostname for m in remaining], ['m2', 'm3'])
+        machine = state.get_machines()['zone-a'][0]
+        self.assertEqual(machine.hostname, 'm1')
+        self.assertEqual(state.get_machine_status(machine), state.Active)
+        self.assertTrue(state.is_machine_monitored(machine))
+        self.assertTrue(machine.is_initialized())
+        self.assertEqual(machine.datamanager.portnum, 40001)
+        self.assertEqual(machine.config.dns_name, '0.web.zone-a')
+        self.assertEqual(machine.get_running_tasks(),
+                         [{'name': 'web', 'running': True}])
+
+        # The pending deployment is planned again.
+        self.assertEqual(state.desired_jobs.get_task_status('web', machine),
+                         JobState.Running)
+        self.assertEqual(state.desired_jobs.get_pending_tasks(),
+                         {'zone-a': {'web': 2}})
+
+    def test_no_checkpoint(self):
+        state = MonitoredSitter(self.location).state
+        configs = [make_config('m1')]
+        self.assertEqual(state.restore_checkpoint(configs), configs)
+        self.assertEqual(state.machines, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,372 @@
+import unittest
+
+from clustersitter.actions import (
+    AddTaskAction, DeployMachineAction, StartTaskAction, StopTaskAction)
+from clustersitter.clusterstate import ClusterState, JobState
+from fakes import FakeJob, FakeMachine, FakeSitter
+
+
+class JobStateTests(unittest.TestCase):
+
+    def setUp(self):
+        self.state = JobState()
+
+    def test_add_and_lookup(self):
+        self.state.add_tasks('web', 'zone-a', ['m1', 'm2'])
+        self.state.add_tasks('db', 'zone-a', ['m1'], status=JobState.Stopped)
+
+        self.assertTrue(self.state.has_task('web'))
+        self.assertTrue(self.state.has_task('web', 'm2'))
+        self.assertFalse(self.state.has_task('db', 'm2'))
+        self.assertEqual(self.state.get_machine_tasks('m1'),
+                         set(['web', 'db']))
+        self.assertEqual(
+            self.state.get_machine_tasks('m1', status=JobState.Stopped),
+            set(['db']))
+        self.assertEqual(self.state.get_task_status('db', 'm1'),
+                         JobState.Stopped)
+        self.assertEqual(self.state.flatten(), set([
+            ('zone-a', 'm1', 'web'),
+            ('zone-a', 'm2', 'web'),
+            ('zone-a', 'm1', 'db')]))
+
+    def test_machine_idle(self):
+        self.state.add_tasks('web', 'zone-a', ['m1'])
+        self.assertFalse(self.state.is_machine_idle('m1'))
+        self.assertTrue(self.state.is_machine_idle('m2'))
+
+        self.state.remove_tasks('web', ['m1'])
+        self.assertTrue(self.state.is_machine_idle('m1'))
+        self.assertFalse(self.state.has_task('web'))
+
+    def test_remove_machine(self):
+        self.state.add_tasks('web', 'zone-a', ['m1', 'm2'])
+        self.state.add_tasks('db', 'zone-a', ['m1'])
+        self.state.remove_machine('m1')
+
+        self.assertFalse(self.state.has_task('db'))
+        self.assertEqual(self.state.get_task_machines('web'),
+                         {'zone-a': ['m2']})
+        self.assertTrue(self.state.is_machine_idle('m1'))
+
+    def test_pending_tasks(self):
+        self.state.add_tasks('web', 'zone-a', ['m1'], create=2)
+        self.state.add_tasks('web', 'zone-b', [], create=1)
+        self.assertEqual(self.state.get_pending_tasks(), {
+            'zone-a': {'web': 2},
+            'zone-b': {'web': 1}})
+
+        self.state.set_pending_deploying('zone-a', 'web', 1)
+        self.assertEqual(self.state.get_pending_tasks()['zone-a'],
+                         {'web': 1})
+
+        self.state.set_pending_machines(
+            'zone-a', 'web', ['m2'], deploying=True)
+        self.assertTrue(self.state.has_task('web', 'm2'))
+        self.assertEqual(self.state.get_task_status('web', 'm2'),
+                         JobState.Deploying)
+
+        self.state.set_pending_machines('zone-a', 'web', ['m3'])
+        self.assertEqual(self.state.get_task_status('web', 'm3'),
+                         JobState.Running)
+        self.assertEqual(self.state.get_pending_tasks()['zone-a'],
+                         {'web': 0})
+
+        job_fill, job_fill_machines = self.state.get_job_fill()
+        self.assertEqual(job_fill['web'], {'zone-a': 3, 'zone-b': 1})
+        self.assertEqual(self.state.get_pending_count('web', 'zone-b'), 1)
+        self.assertEqual(job_fill_machines['web']['zone-b'], [None])
+
+    def test_complete_pending_deploying(self):
+        self.state.add_tasks('web', 'zone-a', ['m1'])
+        self.state.add_tasks('web', 'zone-a', [], create=3)
+        self.state.set_pending_deploying('zone-a', 'web', 3)
+
+        # One machine is new, one already has the task and one never came up.
+        self.state.complete_pending_deploying(
+            'zone-a', 'web', ['m1', 'm2'], 3)
+        self.assertEqual(self.state.get_task_status('web', 'm2'),
+                         JobState.Running)
+        self.assertEqual(self.state.get_pending_count('web', 'zone-a'), 1)
+        self.assertEqual(self.state.get_pending_tasks()['zone-a'],
+                         {'web': 1})
+
+    def test_update_tasks(self):
+        self.state.add_tasks('web', 'zone-a', ['m1', 'm2'], create=1)
+        self.state.update_tasks('web', JobState.Stopped, ['m1'])
+        self.assertEqual(self.state.get_task_status('web', 'm1'),
+                         JobState.Stopped)
+        self.assertEqual(self.state.get_task_status('web', 'm2'),
+                         JobState.Running)
+
+        self.state.update_tasks('web', JobState.Deploying)
+        self.assertEqual(self.state.get_pending_tasks()['zone-a'],
+                         {'web': 0})
+
+        self.assertEqual(self.state.remove_tasks('web'), ['web'])
+        self.assertEqual(self.state.get_pending_tasks(), {})
+        self.assertEqual(self.state.machines, {})
+
+    def test_journal(self):
+        self.state.add_tasks('web', 'zone-a', ['m1', 'm2'], create=1)
+        self.assertEqual(self.state.pop_dirty(),
+                         set([('web', 'm1'), ('web', 'm2')]))
+        self.assertEqual(self.state.pop_dirty(), set())
+
+        self.state.update_tasks('web', JobState.Running, ['m1'])
+        self.assertEqual(self.state.pop_dirty(), set())
+
+        self.state.update_tasks('web', JobState.Stopped, ['m1'])
+        self.state.remove_machine('m2')
+        self.assertEqual(self.state.pop_dirty(),
+                         set([('web', 'm1'), ('web', 'm2')]))
+
+        self.state.touch_machine('m1')
+        self.assertEqual(self.state.pop_dirty(), set([('web', 'm1')]))
+
+
+class ClusterStateTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sitter = FakeSitter()
+        self.state = self.sitter.state
+        self.state.job_graph.add_job(FakeJob('web'))
+
+    def add_machine(self, hostname):
+        machine = FakeMachine(hostname)
+        self.state.add_machine(machine)
+        return machine
+
+    def test_incremental_deployment(self):
+        machines = [self.add_machine('m%s' % i) for i in range(3)]
+        for jobs in (self.state.desired_jobs, self.state.current_jobs):
+            jobs.add_tasks('web', 'zone-a', machines)
+
+        self.state.calculate_job_deployment()
+        self.assertEqual(self.state.actions.pending, [])
+
+        self.state.desired_jobs.update_tasks(
+            'web', JobState.Stopped, [machines[1]])
+        self.state.current_jobs.update_tasks(
+            'web', JobState.Stopped, [machines[2]])
+        self.state.calculate_job_deployment()
+        actions = set([(a.__class__, a.machine)
+                       for a in self.state.actions.pending])
+        self.assertEqual(actions, set([
+            (StopTaskAction, machines[1]),
+            (StartTaskAction, machines[2])]))
+
+    def test_full_reconcile(self):
+        machine = self.add_machine('m0')
+        self.state.full_reconcile_interval = 2
+        self.state.desired_jobs.add_tasks('web', 'zone-a', [machine])
+        self.state.current_jobs.add_tasks(
+            'web', 'zone-a', [machine], status=JobState.Stopped)
+
+        # Unjournaled changes are only picked up by the full reconcile.
+        counts = []
+        for cycle in range(4):
+            self.state.desired_jobs.pop_dirty()
+            self.state.calculate_job_deployment()
+            counts.append(len(self.state.actions.pending))
+            self.state.actions.stop()
+        self.assertEqual(counts, [1, 0, 0, 1])
+
+    def test_machine_registry(self):
+        m0 = self.add_machine('m0')
+        m1 = self.add_machine('m1')
+        m2 = FakeMachine('m2', zone='zone-b')
+        self.state.add_machine(m2, status=ClusterState.Pending)
+        self.state.desired_jobs.add_tasks('web', 'zone-a', [m0])
+
+        self.assertEqual(self.state.get_machines(idle=True),
+                         {'zone-a': [m1], 'zone-b': [m2]})
+        self.assertEqual(
+            self.state.get_machines(status=ClusterState.Pending),
+            {'zone-a': [], 'zone-b': [m2]})
+        self.assertEqual(self.state.get_machines(zones=['zone-b']),
+                         {'zone-a': [], 'zone-b': [m2]})
+
+        self.state.update_machine(m2, ClusterState.Active)
+        self.assertEqual(
+            self.state.get_machines(status=ClusterState.Pending),
+            {'zone-a': [], 'zone-b': []})
+
+        self.state.remove_machine(m0)
+        self.assertFalse(self.state.has_machine(m0))
+        self.assertEqual(self.state.get_machines(zones=['zone-a']),
+                         {'zone-a': [m1], 'zone-b': []})
+
+    def test_snapshot(self):
+        m0 = self.add_machine('m0')
+        m1 = self.add_machine('m1')
+        self.state.current_jobs.add_tasks('web', 'zone-a', [m0])
+        version = self.state.snapshot.version
+
+        snapshot = self.state.publish_snapshot()
+        self.assertEqual(snapshot.version, version + 1)
+        self.assertTrue(snapshot.is_machine_idle(m0))
+        self.assertEqual(snapshot.job_fill, {'web': {'zone-a': 1}})
+        self.assertEqual(snapshot.job_fill_machines['web']['zone-a'], (m0,))
+
+        # Later changes are not visible in a published snapshot.
+        self.state.remove_machine(m1)
+        self.assertEqual(set(snapshot.machines['zone-a']), set([m0, m1]))
+        self.assertEqual(self.state.snapshot, snapshot)
+
+    def test_parallel_deployment(self):
+        def plan(workers):
+            sitter = FakeSitter()
+            state = sitter.state
+            state.job_graph.add_job(FakeJob('web'))
+            state.deployment_workers = workers
+            for zone in ['zone-a', 'zone-b', 'zone-c']:
+                machines = [FakeMachine('%s-m%s' % (zone, i), zone)
+                            for i in range(3)]
+                for machine in machines:
+                    state.add_machine(machine)
+                state.desired_jobs.add_tasks('web', zone, machines[:2])
+                state.current_jobs.add_tasks(
+                    'web', zone, machines[1:], status=JobState.Stopped)
+            state.calculate_job_deployment()
+            if state.pool:
+                state.pool.close()
+            return [(a.__class__.__name__, a.zone, str(a.machine))
+                    for a in state.actions.pending]
+
+        serial = plan(1)
+        self.assertEqual(len(serial), 6)
+        self.assertEqual(serial, sorted(serial, key=lambda a: a[1]))
+        self.assertEqual(plan(4), serial)
+
+    def test_packed_deployment(self):
+        big = FakeMachine('big', cpus=4, mem=4096)
+        small = FakeMachine('small', cpus=1, mem=1024)
+        self.state.add_machine(big)
+        self.state.add_machine(small)
+        for jobs in (self.state.desired_jobs, self.state.current_jobs):
+            jobs.add_tasks('web', 'zone-a', [small])
+        self.state.job_graph.add_job(FakeJob('api', cpu=2, mem=1024))
+        self.state.desired_jobs.add_tasks('api', 'zone-a', [], create=3)
+
+        # One instance fits on the big machine, the rest need new machines.
+        self.state.calculate_job_deployment()
+        actions = [(a.__class__, getattr(a, 'machine', None),
+                    getattr(a, 'count', None))
+                   for a in self.state.actions.pending]
+        self.assertEqual(sorted(actions), sorted([
+            (AddTaskAction, big, None),
+            (DeployMachineAction, None, 2)]))
+        self.assertEqual(self.state.desired_jobs.get_task_status('api', big),
+                         JobState.Deploying)
+        self.assertEqual(self.state.desired_jobs.get_pending_tasks(),
+                         {'zone-a': {'web': 0, 'api': 0}})
+
+    def test_deploy_machine_action(self):
+        state = self.state
+        new_machine = FakeMachine('new')
+
+        class DeployingJob(FakeJob):
+            def deploy_new(self, zone, count):
+                # Only one of the requested machines comes up.
+                state.add_machine(new_machine, status=state.Deploying)
+                return [new_machine]
+
+        state.job_graph.add_job(DeployingJob('api'))
+        state.desired_jobs.add_tasks('api', 'zone-a', [], create=2)
+        state.calculate_job_deployment()
+        actions = state.actions.pending
+        self.assertEqual(len(actions), 1)
+        self.assertEqual(actions[0].count, 2)
+
+        actions[0].run()
+        self.assertEqual(state.get_machine_status(new_machine), state.Active)
+        self.assertEqual(
+            state.desired_jobs.get_task_status('api', new_machine),
+            JobState.Running)
+        self.assertEqual(state.desired_jobs.get_pending_tasks(),
+                         {'zone-a': {'api': 1}})
+
+    def test_completed_add_before_poll(self):
+        class DeployableJob(FakeJob):
+            def deploy(self, zone, machine):
+                return True
+
+        self.state.job_graph.add_job(DeployableJob('api'))
+        machine = self.add_machine('m0')
+        self.state.desired_jobs.add_tasks('api', 'zone-a', [machine])
+        self.state.calculate_job_deployment()
+        self.assertEqual(
+            self.state.desired_jobs.get_task_status('api', machine),
+            JobState.Deploying)
+        self.state.actions.process()
+        self.assertTrue(self.state.actions.join(5))
+
+        # A cycle before the machine is polled plans the add again, but the
+        # duplicate is dropped and the task is not left deploying.
+        self.state.calculate_job_deployment()
+        self.assertEqual(self.state.actions.pending, [])
+        self.assertEqual(
+            self.state.desired_jobs.get_task_status('api', machine),
+            JobState.Running)
+
+        # So the task is started again when the poll finds it stopped.
+        self.state.current_jobs.add_tasks(
+            'api', 'zone-a', [machine], status=JobState.Stopped)
+        self.state.calculate_job_deployment()
+        actions = [(a.__class__, a.machine)
+                   for a in self.state.actions.pending]
+        self.assertEqual(actions, [(StartTaskAction, machine)])
+
+    def test_repeated_redeploy(self):
+        class DeployableJob(FakeJob):
+            def deploy(self, zone, machine):
+                return True
+
+            def get_shared_fate_zones(self):
+                return ['zone-a']
+
+            def get_num_required_machines_in_zone(self, zone):
+                return 1
+
+        machine = self.add_machine('m0')
+        self.state.add_job(DeployableJob('api'))
+        for jobs in (self.state.desired_jobs, self.state.current_jobs):
+            jobs.add_tasks('api', 'zone-a', [machine])
+
+        # A job updated twice in a row is redeployed twice, the second
+        # update isn't dropped as a duplicate of the completed first one.
+        for n in range(2):
+            self.state.add_job(DeployableJob('api'), redeploy=True)
+            self.assertEqual(
+                self.state.desired_jobs.get_task_status('api', machine),
+                JobState.Deploying)
+            [action] = self.state.actions.pending
+            self.assertEqual(action.revision,
+                             self.state.job_revisions['api'])
+            self.state.actions.process()
+            self.assertTrue(self.state.actions.join(5))
+            self.assertEqual(
+                self.state.desired_jobs.get_task_status('api', machine),
+                JobState.Running)
+
+        # An update while the previous one is queued supersedes it.
+        self.state.add_job(DeployableJob('api'), redeploy=True)
+        self.state.add_job(DeployableJob('api'), redeploy=True)
+        [action] = self.state.actions.pending
+        self.assertEqual(action.revision, self.state.job_revisions['api'])
+        self.assertEqual(self.state.actions.get_stats()['superseded'], 1)
+
+    def test_job_chains(self):
+        self.state.job_graph.add_job(FakeJob('log', linked_job='web'))
+        machine = self.add_machine('m0')
+        self.state.desired_jobs.add_tasks('web', 'zone-a', [machine])
+
+        # Children are assigned to the machines their master is on.
+        self.state.calculate_job_deployment()
+        self.assertTrue(self.state.desired_jobs.has_task('log', machine))
+
+        # Children are cleaned up once their master is gone.
+        self.state.remove_job('web')
+        self.state.calculate_job_cleanup()
+        self.assertEqual(self.state.jobs, {})
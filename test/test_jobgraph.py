@@ -0,0 +1,49 @@
+import unittest
+
+from clustersitter.jobgraph import JobGraph
+from fakes import FakeJob
+
+
+class JobGraphTests(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = JobGraph()
+        self.web = FakeJob('web')
+        self.log = FakeJob('log', linked_job='web')
+        self.stats = FakeJob('stats', linked_job='log')
+        for job in (self.web, self.log, self.stats):
+            self.assertTrue(self.graph.add_job(job))
+
+    def test_chains(self):
+        self.assertEqual(self.graph.get_master('stats'), self.web)
+        self.assertEqual(self.graph.get_master('web'), self.web)
+        self.assertEqual(self.graph.get_chain('web'), ['log', 'stats'])
+        self.assertEqual(self.graph.get_chain('log'), [])
+        self.assertEqual(self.graph.get_dependents('web'), [self.log])
+
+    def test_cycle(self):
+        self.assertFalse(
+            self.graph.add_job(FakeJob('web', linked_job='stats')))
+        self.assertFalse(
+            self.graph.add_job(FakeJob('loop', linked_job='loop')))
+        self.assertEqual(self.graph.get_job('web'), self.web)
+        self.assertEqual(self.graph.get_chain('web'), ['log', 'stats'])
+
+    def test_remove_and_readd(self):
+        self.assertTrue(self.graph.remove_job('log'))
+        self.assertFalse(self.graph.remove_job('log'))
+        self.assertEqual(self.graph.get_master('stats'), None)
+        self.assertEqual(self.graph.get_chain('web'), [])
+
+        self.graph.add_job(self.log)
+        self.assertEqual(self.graph.get_master('stats'), self.web)
+        self.assertEqual(self.graph.get_chain('web'), ['log', 'stats'])
+
+    def test_relink(self):
+        db = FakeJob('db')
+        self.graph.add_job(db)
+        self.graph.add_job(FakeJob('log', linked_job='db'))
+        self.assertEqual(self.graph.get_chain('web'), [])
+        self.assertEqual(self.graph.get_chain('db'), ['log', 'stats'])
+        self.assertEqual(self.graph.get_master('stats'), db)
+        self.assertEqual(self.graph.get_dependents('web'), [])
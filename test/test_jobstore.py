@@ -0,0 +1,82 @@
+import shutil
+import tempfile
+import unittest
+
+from clustersitter.jobstore import JobStore
+from clustersitter.productionjob import ProductionJob
+from fakes import FakeSitter
+
+
+def make_job(name, version=1, persistent=True):
+    return {
+        'dns_basename': '',
+        'task_configuration': {'name': name, 'command': 'true'},
+        'deployment_layout': {'zone-a': {'cpu': 1, 'mem': 1024}},
+        'deployment_recipe': None,
+        'recipe_options': {'version': version},
+        'persistent': persistent,
+        'linked_job': None,
+    }
+
+
+class JobStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.store = JobStore(self.location, compact_after=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def get_journal_lines(self):
+        with open(self.store.journal_file) as fd:
+            return fd.read().splitlines()
+
+    def test_only_changes_written(self):
+        self.assertTrue(self.store.save_job(make_job('web')))
+        self.assertFalse(self.store.save_job(make_job('web')))
+        self.assertTrue(self.store.save_job(make_job('web', version=2)))
+        self.assertEqual(len(self.get_journal_lines()), 2)
+
+        self.assertFalse(self.store.remove_job('db'))
+        self.assertEqual(len(self.get_journal_lines()), 2)
+
+    def test_load(self):
+        self.store.save_job(make_job('web'))
+        self.store.save_job(make_job('db'))
+        self.store.remove_job('web')
+        # The journal was compacted into the snapshot.
+        self.assertEqual(self.get_journal_lines(), [])
+        self.store.save_job(make_job('api'))
+
+        # Leave a partially written record at the end of the journal.
+        with open(self.store.journal_file, 'a') as fd:
+            fd.write('{"op": "remo')
+
+        store = JobStore(self.location)
+        jobs = store.load()
+        self.assertEqual(
+            [j['task_configuration']['name'] for j in jobs], ['api', 'db'])
+        self.assertFalse(store.save_job(make_job('api')))
+        self.assertEqual(self.get_journal_lines(), [])
+
+    def test_state_persistence(self):
+        sitter = FakeSitter(self.location)
+        self.assertEqual(sitter.state.load_jobs(), [])
+        for job in (make_job('web'), make_job('tmp', persistent=False)):
+            self.assertTrue(sitter.state.add_job(
+                ProductionJob.deserialize(job, sitter)))
+
+        sitter = FakeSitter(self.location)
+        self.assertEqual(sitter.state.load_jobs(), ['web'])
+        self.assertEqual(
+            sitter.state.desired_jobs.get_pending_count('web', 'zone-a'), 1)
+
+        # Jobs are dropped from the store once they are cleaned up.
+        sitter.state.desired_jobs.remove_tasks('web')
+        sitter.state.calculate_job_cleanup()
+        self.assertEqual(FakeSitter(self.location).state.load_jobs(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+import socket
+import threading
+import time
+import unittest
+
+from fakes import FakeResponse, closed_port
+from sittercommon import http_monitor
+from sittercommon.discovery import DiscoveryServer
+from sittercommon.machinedata import MachineData, SessionPool
+
+
+class FakeHarness(object):
+    logmanager = None
+
+
+class FakeStats(object):
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.open = 0
+        self.max_open = 0
+
+    def get_metadata(self):
+        return {'uptime': 10}
+
+    def get_live_data(self):
+        with self.lock:
+            self.open += 1
+            self.max_open = max(self.max_open, self.open)
+        time.sleep(self.delay)
+        with self.lock:
+            self.open -= 1
+        return {'load_one_min': 0.5}
+
+
+class SessionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = FakeStats()
+        self.monitor = http_monitor.HTTPMonitor(self.stats, FakeHarness(), 0)
+        self.monitor.start()
+        while self.monitor.httpd is None:
+            time.sleep(0.01)
+        self.port = self.monitor.httpd.server_address[1]
+
+        # Count the connections the server accepts.
+        self.connections = []
+        process_request = self.monitor.httpd.process_request
+
+        def counting_process_request(request, address):
+            self.connections.append(address)
+            process_request(request, address)
+        self.monitor.httpd.process_request = counting_process_request
+
+    def tearDown(self):
+        self.monitor.stop()
+
+    def test_keep_alive(self):
+        data = MachineData('127.0.0.1', 40000, portnum=self.port)
+        data.sessions = SessionPool()
+        for n in range(3):
+            self.assertEqual(data.load_generic_page(data.url, 'stats'),
+                             {'uptime': 10, 'load_one_min': 0.5})
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual(data.sessions.get_stats(),
+                         {'hosts': 1, 'requests': 3})
+
+    def test_http10(self):
+        # HTTP/1.0 clients still get just the body and a closed connection.
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        sock.sendall("GET /stats?nohtml=1&format=json HTTP/1.0\r\n\r\n")
+        response = ''
+        data = sock.recv(4096)
+        while data:
+            response += data
+            data = sock.recv(4096)
+        sock.close()
+        self.assertTrue(response.startswith('{'))
+
+    def test_concurrency(self):
+        self.stats.delay = 0.05
+        sessions = SessionPool(max_requests=2)
+        url = "http://127.0.0.1:%s/stats?nohtml=1" % self.port
+        threads = [
+            threading.Thread(target=sessions.request, args=('get', url))
+            for n in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.stats.max_open, 2)
+        self.assertEqual(len(self.connections), 2)
+
+
+class TaskStatsTests(unittest.TestCase):
+
+    def test_busy_executor(self):
+        # Task stats still load while every async request is stuck.
+        release = threading.Event()
+        executor = MachineData.get_executor()
+        for n in range(MachineData.async_workers):
+            executor.apply_async(release.wait, (5, ))
+
+        data = MachineData('127.0.0.1', 40000, portnum=40000)
+        data.stats_all = False
+        data._make_request = lambda method, path, host=None: FakeResponse(
+            '{"web-name": "web", "web-running": true, '
+            '"web-monitoring": "http://127.0.0.1:5000"}')
+        data.load_generic_page = lambda host, page: {'cpu_usage': 3}
+        thread = threading.Thread(target=data.reload)
+        thread.start()
+        thread.join(2)
+        release.set()
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(data.tasks['web']['cpu_usage'], 3)
+
+
+class DiscoveryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.monitor = http_monitor.HTTPMonitor(FakeStats(), FakeHarness(), 0)
+        self.monitor.start()
+        while self.monitor.httpd is None:
+            time.sleep(0.01)
+        self.port = self.monitor.httpd.server_address[1]
+        self.discovery = DiscoveryServer(lambda: {'port': self.port}, 0)
+        self.discovery.start()
+
+        MachineData.port_cache.clear()
+        self.discovery_port = MachineData.discovery_port
+        MachineData.discovery_port = self.discovery.server_address[1]
+
+    def tearDown(self):
+        MachineData.discovery_port = self.discovery_port
+        MachineData.port_cache.clear()
+        self.discovery.stop()
+        self.monitor.stop()
+
+    def test_discovery(self):
+        data = MachineData('127.0.0.1', closed_port())
+        self.assertEqual(data.portnum, self.port)
+        self.assertEqual(MachineData.get_cached_port('127.0.0.1'), self.port)
+
+        # Other machine data objects for the host use the cached port.
+        self.discovery.stop()
+        data = MachineData('127.0.0.1', closed_port())
+        self.assertEqual(data.portnum, self.port)
+
+        # Unless it expired.
+        MachineData.port_cache['127.0.0.1'] = (
+            self.port, time.time() - MachineData.port_cache_ttl - 1)
+        data = MachineData('127.0.0.1', closed_port())
+        self.assertEqual(data.portnum, None)
+        self.assertEqual(data.url, "")
+
+    def test_scan(self):
+        MachineData.discovery_port = closed_port()
+        data = MachineData('127.0.0.1', self.port)
+        self.assertEqual(data.portnum, self.port)
+
+    def test_timeout(self):
+        # A sitter which accepts connections but never answers.
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        try:
+            data = MachineData('127.0.0.1', 40000,
+                               portnum=listener.getsockname()[1])
+            data.request_timeout = 0.1
+            searches = []
+            data._find_portnum = lambda: searches.append(True)
+            self.assertEqual(data.load_generic_page(data.url, 'stats'), {})
+        finally:
+            listener.close()
+
+        # Slow sitters are not looked for on other ports.
+        self.assertEqual(searches, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
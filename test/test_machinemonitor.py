@@ -0,0 +1,159 @@
+import time
+import unittest
+
+from clustersitter.machinemonitor import MachineMonitor
+from fakes import FakeMachine, FakeSitter
+
+
+class PollScheduleTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sitter = FakeSitter()
+        self.monitor = MachineMonitor(parent=self.sitter, number=0)
+        self.sitter.state.monitors.append((self.monitor, None))
+
+    def test_due_machines(self):
+        machines = [FakeMachine('m%s' % n) for n in range(3)]
+        self.monitor.schedule_poll(machines[0], 0, jitter=False)
+        self.monitor.schedule_poll(machines[1], 60)
+        self.monitor.schedule_poll(machines[2], 0, jitter=False)
+        self.assertEqual(self.monitor.get_due_machines(),
+                         [machines[0], machines[2]])
+        self.assertEqual(self.monitor.get_due_machines(), [])
+        sleep_time = self.monitor.get_sleep_time()
+        self.assertTrue(60 * 0.8 - 1 < sleep_time <= 60 * 1.2)
+
+        # Rescheduling replaces the previous deadline.
+        self.monitor.schedule_poll(machines[1], 0, jitter=False)
+        self.assertEqual(self.monitor.get_due_machines(), [machines[1]])
+        self.assertEqual(self.monitor.get_sleep_time(),
+                         self.sitter.stats_poll_interval)
+
+    def test_jitter(self):
+        machines = [FakeMachine('m%s' % n) for n in range(20)]
+        for machine in machines:
+            self.monitor.schedule_poll(machine, 10)
+        deadlines = [entry[0] for entry in self.monitor.poll_queue]
+        self.assertTrue(max(deadlines) - min(deadlines) > 0.1)
+        self.assertTrue(max(deadlines) <= time.time() + 12)
+
+    def test_poll_interval(self):
+        state = self.sitter.state
+        machine = FakeMachine('m1')
+        state.add_machine(machine)
+        interval = self.monitor.get_poll_interval
+
+        # Stable machines back off up to the maximum.
+        for expected in (5, 10, 20, 30, 30):
+            self.monitor.schedule_poll(machine, interval(machine, True, False))
+            self.assertEqual(self.monitor.poll_intervals[machine], expected)
+
+        # Failing, changing and deploying machines are polled quickly.
+        self.assertEqual(interval(machine, False, False), 1)
+        self.assertEqual(interval(machine, True, True), 1)
+        state.update_machine(machine, state.Deploying)
+        self.assertEqual(interval(machine, True, False), 1)
+
+    def test_expedite(self):
+        state = self.sitter.state
+        machines = [FakeMachine('m%s' % n) for n in range(3)]
+        for machine in machines:
+            state.add_machine(machine)
+            self.monitor.monitored_machines.append(machine)
+            self.monitor.schedule_poll(machine, 60)
+        self.assertEqual(self.monitor.get_due_machines(), [])
+
+        state.machine_monitors[machines[1]] = self.monitor
+        state.expedite_poll([machines[1]])
+        self.assertTrue(self.monitor.wakeup.is_set())
+        self.assertEqual(self.monitor.get_due_machines(), [machines[1]])
+
+        state.expedite_poll()
+        self.assertEqual(self.monitor.get_due_machines(),
+                         [machines[0], machines[2]])
+
+    def test_poll_errors(self):
+        machines = [FakeMachine('m%s' % n) for n in range(3)]
+        for machine in machines:
+            self.sitter.state.add_machine(machine)
+            self.monitor.add_machine(machine)
+
+        # Errors handling one machine don't take the others off the
+        # schedule, nor the failing machine itself.
+        record_poll = self.monitor._record_poll
+
+        def failing_record_poll(machine, success):
+            self.monitor.stop()
+            if machine is machines[1]:
+                raise KeyError(machine)
+            record_poll(machine, success)
+        self.monitor._record_poll = failing_record_poll
+        self.monitor.start()
+        self.assertEqual(set(self.monitor.poll_entries), set(machines))
+        self.assertEqual(self.monitor.pull_failures,
+                         {machines[0]: 1, machines[1]: 0, machines[2]: 1})
+
+
+class MonitorBalanceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sitter = FakeSitter()
+        self.state = self.sitter.state
+        self.state.add_monitor(start=False)
+        self.machines = [FakeMachine('m%s' % n) for n in range(8)]
+        for machine in self.machines:
+            self.state.add_machine(machine)
+            self.state.monitor_machine(machine)
+
+    def get_counts(self):
+        return [m.num_monitored_machines() for m, _ in self.state.monitors]
+
+    def check_index(self):
+        for machine, monitor in self.state.machine_monitors.items():
+            self.assertTrue(monitor.has_machine(machine))
+        members = [m for monitor, _ in self.state.monitors
+                   for m in monitor.members]
+        self.assertEqual(sorted(members), sorted(self.state.machine_monitors))
+
+    def test_scale(self):
+        self.state.machines_per_monitor = 3
+        self.assertEqual(self.state.scale_monitors(), 2)
+        self.assertEqual(self.get_counts(), [4, 2, 2])
+        self.check_index()
+
+        # Fewer machines need fewer monitors.
+        for machine in self.machines[3:]:
+            self.state.unmonitor_machine(machine)
+        removed = [m for m, _ in self.state.monitors]
+        self.assertEqual(self.state.scale_monitors(), -2)
+        self.assertEqual(self.get_counts(), [3])
+        self.assertEqual(
+            [m.running for m in removed if m not in
+             [item[0] for item in self.state.monitors]], [False, False])
+        self.check_index()
+
+    def test_steal(self):
+        idle = self.state.add_monitor(start=False)
+        busy = self.state.monitors[0][0]
+        busy.monitored_machines.extend(busy.add_queue)
+        busy.add_queue = []
+        failing = self.machines[5]
+        busy.pull_failures[failing] = 2
+        since = busy.failing_since[failing] = time.time() - 60
+        busy.poll_intervals[failing] = 1
+
+        # Nothing moves until a monitor lags.
+        self.assertEqual(self.state.steal_machines(), 0)
+        busy.lag.add(self.state.monitor_lag_threshold + 1)
+        self.assertEqual(self.state.steal_machines(), 2)
+        self.assertEqual(self.get_counts(), [6, 2])
+        self.assertTrue(idle.has_machine(failing))
+        self.check_index()
+
+        # Failing machines keep failing after they move.
+        self.assertEqual(idle.get_poll_history(failing), (2, since, 1))
+        self.assertEqual(busy.get_poll_history(failing), (0, None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+import unittest
+
+from clustersitter.placement import ResourcePacker
+from fakes import FakeMachine
+
+
+class ResourcePackerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.packer = ResourcePacker()
+        self.small = FakeMachine('small')
+        self.large = FakeMachine('large')
+        self.packer.add_machine(self.small, 1, 1024)
+        self.packer.add_machine(self.large, 4, 8192, ['db'])
+
+    def test_best_fit(self):
+        self.assertEqual(self.packer.place('web', 1, 512), self.small)
+        self.assertEqual(self.packer.get_free(self.small), (0, 512))
+        self.assertEqual(self.packer.place('api', 1, 512), self.large)
+        self.assertEqual(self.packer.place('big', 4, 512), None)
+
+    def test_memory(self):
+        self.assertEqual(self.packer.place('web', 0.5, 2048), self.large)
+        self.assertEqual(self.packer.get_free(self.large), (3.5, 6144))
+
+    def test_one_instance_per_machine(self):
+        self.assertEqual(self.packer.place('db', 1, 0), self.small)
+        self.assertEqual(self.packer.place('db', 1, 0), None)
+
+    def test_pack_decreasing(self):
+        placements, unplaced = self.packer.pack([
+            ('web', 1, 0), ('web', 1, 0), ('api', 3, 0), ('cache', 1, 0)])
+        self.assertEqual(placements, {
+            'api': [self.large],
+            'web': [self.small, self.large]})
+        self.assertEqual(unplaced, {'cache': 1})
@@ -0,0 +1,224 @@
+import BaseHTTPServer
+import SocketServer
+import socket
+import threading
+import time
+import unittest
+
+import simplejson
+
+from clustersitter.machineconfig import MachineConfig
+from clustersitter.monitoredmachine import MonitoredMachine
+from clustersitter.pollengine import PollEngine
+from fakes import closed_port
+
+
+class SitterHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve stats the way the sitter HTTP monitors do, without headers."""
+
+    def do_GET(self):
+        location = 'http://127.0.0.1:%s/web' % self.server.server_address[1]
+        if self.path.startswith('/stats_all') and self.server.stats_all:
+            data = {
+                'version': 1,
+                'machine': {'uptime': 10},
+                'tasks': {
+                    'web-app': {
+                        'name': 'web-app',
+                        'running': True,
+                        'monitoring': "<a href='%s'>%s</a>" % (
+                            location, location),
+                        'stats': {'num_task_starts': 3},
+                    },
+                    'db': {'name': 'db', 'running': False, 'monitoring': ''},
+                },
+            }
+        elif self.path.startswith('/stats_all'):
+            # Older sitters answer unknown paths with their usage page.
+            data = 'usage'
+        elif self.path.startswith('/stats'):
+            data = {
+                'uptime': 10,
+                'web-name': 'web',
+                'web-running': True,
+                'web-monitoring': "<a href='%s'>%s</a>" % (location, location),
+                'db-name': 'db',
+                'db-running': False,
+                'db-monitoring': '',
+            }
+        elif self.path.startswith('/web/stats'):
+            data = {'num_task_starts': 3}
+        else:
+            data = {}
+
+        with self.server.lock:
+            self.server.open += 1
+            self.server.max_open = max(self.server.max_open, self.server.open)
+        time.sleep(self.server.delay)
+        with self.server.lock:
+            self.server.open -= 1
+        self.wfile.write(simplejson.dumps(data))
+
+    def log_message(self, *args):
+        pass
+
+
+class SitterServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, delay=0, stats_all=False):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), SitterHandler)
+        self.delay = delay
+        self.stats_all = stats_all
+        self.lock = threading.Lock()
+        self.open = 0
+        self.max_open = 0
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+def make_machine(port):
+    machine = MonitoredMachine(
+        MachineConfig('127.0.0.1', 'zone-a', 1, 1024))
+    machine.restore(port, {})
+    return machine
+
+
+class PollEngineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SitterServer(delay=0.05)
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_poll(self):
+        engine = PollEngine(concurrency=10, timeout=5)
+        machines = [make_machine(self.port) for n in range(30)]
+        start = time.time()
+        results = engine.poll_machines(machines)
+
+        # Requests overlap up to the concurrency limit.
+        self.assertTrue(time.time() - start < 30 * 2 * 0.05)
+        self.assertTrue(1 < self.server.max_open <= 10)
+        self.assertEqual(results, dict([(m, True) for m in machines]))
+        # One failed /stats_all, /stats and the web task's stats.
+        self.assertEqual(engine.get_stats()['requests'], 90)
+
+        machine = machines[0]
+        self.assertTrue(machine.has_loaded_data())
+        tasks = machine.get_tasks()
+        self.assertEqual(sorted(tasks.keys()), ['db', 'web'])
+        self.assertEqual(tasks['web']['num_task_starts'], 3)
+        self.assertEqual(
+            tasks['web']['stats_page'], 'http://127.0.0.1:%s/web/stats' %
+            self.port)
+        self.assertEqual(
+            [t['name'] for t in machine.get_running_tasks()], ['web'])
+        self.assertEqual(machine.datamanager.metadata['uptime'], 10)
+
+        # The sitter doesn't serve /stats_all, so it isn't asked again.
+        self.assertFalse(machine.datamanager.stats_all)
+        engine.poll_machines(machines)
+        self.assertEqual(engine.get_stats()['requests'], 150)
+
+    def test_stats_all(self):
+        server = SitterServer(stats_all=True)
+        try:
+            engine = PollEngine()
+            machines = [make_machine(server.server_address[1])
+                        for n in range(5)]
+            results = engine.poll_machines(machines)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(results, dict([(m, True) for m in machines]))
+        # A single request per machine.
+        self.assertEqual(engine.get_stats()['requests'], 5)
+
+        machine = machines[0]
+        self.assertTrue(machine.datamanager.stats_all)
+        tasks = machine.get_tasks()
+        self.assertEqual(sorted(tasks.keys()), ['db', 'web-app'])
+        self.assertEqual(tasks['web-app']['num_task_starts'], 3)
+        self.assertEqual(
+            tasks['web-app']['stats_page'],
+            'http://127.0.0.1:%s/web/stats' % server.server_address[1])
+        self.assertFalse('stats' in tasks['web-app'])
+        self.assertEqual(machine.datamanager.metadata['uptime'], 10)
+
+    def test_timeout(self):
+        # A server which accepts connections but never answers.
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        try:
+            engine = PollEngine(timeout=0.2)
+            silent = make_machine(listener.getsockname()[1])
+            machine = make_machine(self.port)
+            results = engine.poll_machines([silent, machine])
+        finally:
+            listener.close()
+
+        self.assertEqual(results, {silent: False, machine: True})
+        self.assertFalse(silent.has_loaded_data())
+        self.assertEqual(engine.get_stats()['timeouts'], 1)
+        # Timed out machines are not probed for on other ports.
+        self.assertTrue(silent.is_initialized())
+
+    def test_slow_resolve(self):
+        # A slow lookup doesn't hold up requests to other hosts.
+        gethostbyname = socket.gethostbyname
+
+        def slow_gethostbyname(host):
+            if host == 'slow.example.com':
+                time.sleep(0.5)
+            return gethostbyname('127.0.0.1')
+        socket.gethostbyname = slow_gethostbyname
+        try:
+            engine = PollEngine(timeout=0.2)
+            finished = []
+            for host in ('slow.example.com', '127.0.0.1'):
+                engine.fetch(
+                    'http://%s:%s/stats' % (host, self.port),
+                    lambda body, error, host=host: finished.append(
+                        (host, error)))
+            engine.run()
+        finally:
+            socket.gethostbyname = gethostbyname
+
+        self.assertEqual(finished, [
+            ('127.0.0.1', None), ('slow.example.com', 'timed out')])
+
+    def test_rediscover(self):
+        # Machine sitters which moved are looked for in the background.
+        machine = make_machine(closed_port())
+        found = threading.Event()
+
+        def find_portnum():
+            found.wait(5)
+            machine.datamanager.portnum = self.port
+            machine.datamanager.url = 'http://127.0.0.1:%s' % self.port
+        machine.datamanager._find_portnum = find_portnum
+
+        engine = PollEngine(timeout=1)
+        self.assertEqual(engine.poll_machines([machine]), {machine: False})
+        self.assertTrue(engine.is_rediscovering(machine))
+        self.assertEqual(engine.poll_machines([machine]), {machine: False})
+        self.assertEqual(engine.get_stats()['requests'], 1)
+
+        found.set()
+        end = time.time() + 5
+        while engine.is_rediscovering(machine) and time.time() < end:
+            time.sleep(0.01)
+        self.assertEqual(engine.poll_machines([machine]), {machine: True})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import time
+import unittest
+
+from clustersitter.ratelimit import RateLimited, TokenBucket
+
+
+class FakeProvider(object):
+
+    def __init__(self):
+        self.calls = []
+        self.name = 'fake'
+
+    def fill_request(self, count):
+        self.calls.append(('fill_request', count))
+        return count
+
+    def usable(self):
+        return True
+
+
+class TokenBucketTests(unittest.TestCase):
+
+    def test_burst(self):
+        bucket = TokenBucket(rate=20, burst=3)
+        start = time.time()
+        for n in range(3):
+            self.assertTrue(bucket.acquire())
+        self.assertTrue(time.time() - start < 0.05)
+        self.assertEqual(bucket.get_stats()['waits'], 0)
+
+        # Further calls wait for tokens to be added.
+        self.assertTrue(bucket.acquire())
+        self.assertTrue(time.time() - start >= 0.04)
+        self.assertEqual(bucket.get_stats()['waits'], 1)
+
+    def test_timeout(self):
+        bucket = TokenBucket(rate=0.1, burst=1)
+        self.assertTrue(bucket.acquire())
+        self.assertFalse(bucket.acquire(timeout=0.01))
+
+
+class RateLimitedTests(unittest.TestCase):
+
+    def test_proxy(self):
+        provider = FakeProvider()
+        bucket = TokenBucket(rate=0.1, burst=1)
+        limited = RateLimited(provider, bucket, ['fill_request'])
+        self.assertEqual(limited.fill_request(2), 2)
+        self.assertEqual(provider.calls, [('fill_request', 2)])
+
+        # Other methods and attributes are not limited.
+        self.assertTrue(limited.usable())
+        self.assertEqual(limited.name, 'fake')
+        self.assertFalse(bucket.acquire(timeout=0.01))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+import threading
+import time
+import unittest
+
+from clustersitter.scheduler import CalculationScheduler
+
+
+class CalculationSchedulerTests(unittest.TestCase):
+
+    def test_safety_tick(self):
+        scheduler = CalculationScheduler(0.05)
+        start = time.time()
+        self.assertEqual(scheduler.wait(), {})
+        self.assertTrue(time.time() - start >= 0.05)
+
+    def test_coalesce_events(self):
+        scheduler = CalculationScheduler(10, debounce=0.05)
+        scheduler.post('machine lost')
+        scheduler.post('machine lost')
+        scheduler.post('add_job')
+        self.assertEqual(scheduler.wait(),
+                         {'machine lost': 2, 'add_job': 1})
+
+    def test_wake_on_event(self):
+        scheduler = CalculationScheduler(10, debounce=0)
+        timer = threading.Timer(0.01, scheduler.post, ['action'])
+        timer.start()
+        start = time.time()
+        self.assertEqual(scheduler.wait(), {'action': 1})
+        self.assertTrue(time.time() - start < 1)
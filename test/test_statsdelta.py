@@ -0,0 +1,161 @@
+import unittest
+
+import simplejson
+
+from fakes import FakeMachineStats, FakeResponse
+from sittercommon.machinedata import MachineData
+
+
+def make_stats():
+    return FakeMachineStats(
+        {'load_one_min': 0.5, 'hostname': 'm1'},
+        {
+            'web-app': {
+                'name': 'web-app',
+                'running': True,
+                'monitoring': "<a href='http://m1:5000'>http://m1:5000</a>",
+                'stop': 'stop',
+                'stats': {'cpu_usage': 1, 'num_task_starts': 1},
+            },
+            'db': {
+                'name': 'db',
+                'running': False,
+                'monitoring': '',
+                'start': 'start',
+            },
+        })
+
+
+class StatsDeltaTests(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = make_stats()
+        self.data = MachineData('m1', 40000, portnum=40000)
+
+    def poll(self):
+        url = self.data.get_stats_all_url()
+        args = {}
+        if 'since=' in url:
+            args['since'] = url.split('since=')[1]
+        # Go through JSON like the sitter does.
+        body = simplejson.dumps(self.stats.get_all_stats(args))
+        data = self.data.decode_stats_all(body)
+        self.data.tasks = self.data.parse_stats_all(data)
+        return data
+
+    def expected_tasks(self):
+        fresh = MachineData('m1', 40000, portnum=40000)
+        return fresh.parse_stats_all(self.stats.get_all_stats())
+
+    def test_delta(self):
+        full = self.poll()
+        self.assertFalse('since' in full)
+        version = full['version']
+
+        # Nothing changed, nothing is sent.
+        delta = self.poll()
+        self.assertEqual(delta['since'], version)
+        self.assertEqual(delta['tasks'], {})
+        self.assertEqual(delta['machine'], {})
+        self.assertTrue(len(simplejson.dumps(delta)) <
+                        len(simplejson.dumps(full)))
+
+        # Only the changed metric of the changed task is sent.
+        self.stats.current['tasks']['web-app']['stats']['cpu_usage'] = 7
+        delta = self.poll()
+        self.assertEqual(delta['version'], version + 1)
+        self.assertEqual(delta['tasks'],
+                         {'web-app': {'stats': {'cpu_usage': 7}}})
+        self.assertEqual(self.data.tasks['web-app']['cpu_usage'], 7)
+        self.assertEqual(self.data.tasks['web-app']['stats_page'],
+                         'http://m1:5000/stats')
+        self.assertEqual(self.data.tasks, self.expected_tasks())
+
+    def test_structure(self):
+        self.poll()
+        tasks = self.stats.current['tasks']
+        del tasks['db']
+        tasks['cache'] = {'name': 'cache', 'running': False,
+                          'monitoring': ''}
+        tasks['web-app'] = {'name': 'web-app', 'running': False,
+                            'monitoring': '', 'start': 'start'}
+
+        delta = self.poll()
+        self.assertEqual(delta['removed'], ['db'])
+        self.assertEqual(delta['added'], ['cache'])
+        self.assertEqual(delta['replaced'], ['web-app'])
+        self.assertEqual(self.data.tasks, self.expected_tasks())
+        self.assertFalse('cpu_usage' in self.data.tasks['web-app'])
+
+    def test_resync(self):
+        version = self.poll()['version']
+
+        # Versions the sitter no longer knows get the full stats, e.g. from
+        # before it restarted.
+        self.data.stats_version = version - 100
+        self.assertFalse('since' in self.poll())
+
+        self.assertTrue('since' in self.poll())
+        self.data.last_full_sync -= self.data.full_sync_interval
+        self.assertFalse('since' in self.poll())
+
+        # Deltas the current tasks are already past are ignored, e.g. from a
+        # poll which was in flight while newer stats were pushed.
+        version = self.data.stats_version
+        delta = self.stats.get_all_stats({'since': str(version)})
+        delta['since'] = version - 1
+        self.assertEqual(self.data.parse_stats_all(delta), self.data.tasks)
+        self.assertEqual(self.data.stats_version, version)
+
+        # So are full stats older than the current tasks.
+        full = self.stats.get_all_stats()
+        full['version'] = version - 1
+        self.assertEqual(self.data.parse_stats_all(full), self.data.tasks)
+        self.assertEqual(self.data.stats_version, version)
+
+        # Deltas against another version are rejected.
+        delta['since'] = version + 1
+        delta['version'] = version + 2
+        self.assertEqual(self.data.parse_stats_all(delta), None)
+        self.assertEqual(self.data.stats_version, None)
+        self.assertFalse('since' in self.data.get_stats_all_url())
+
+    def test_reload_resync(self):
+        paths = []
+        skew = {'since': 0}
+
+        def make_request(method, path, host=None, async=False):
+            paths.append(path)
+            args = {}
+            if 'since=' in path:
+                args['since'] = path.split('since=')[1]
+            stats = self.stats.get_all_stats(args)
+            if 'since' in stats:
+                stats['since'] += skew['since']
+            return FakeResponse(simplejson.dumps(stats))
+        self.data._make_request = make_request
+
+        self.assertEqual(self.data.reload(), self.expected_tasks())
+        self.assertEqual(self.data.reload(), self.expected_tasks())
+        self.assertTrue('since' in paths[-1])
+
+        # A delta which doesn't apply is followed by the full stats.
+        skew['since'] = -1
+        self.stats.current['tasks']['web-app']['stats']['cpu_usage'] = 7
+        del paths[:]
+        self.assertEqual(self.data.reload(), self.expected_tasks())
+        self.assertEqual(['since' in path for path in paths], [True, False])
+        self.assertEqual(self.data.tasks['web-app']['cpu_usage'], 7)
+
+        # The tasks are kept if the full stats don't apply either.
+        tasks = self.data.tasks
+        self.data._get_stats_all_path = lambda: (
+            "stats_all?nohtml=1&format=json&since=%s" % (
+                self.stats.get_all_stats()['version'] - 1))
+        self.stats.current['tasks']['web-app']['stats']['cpu_usage'] = 8
+        self.assertEqual(self.data.reload(), None)
+        self.assertTrue(self.data.tasks is tasks)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import time
+import unittest
+
+from clustersitter.machineconfig import MachineConfig
+from clustersitter.monitoredmachine import MonitoredMachine
+from clustersitter.telemetry import TelemetryIngest
+from fakes import FakeMachineStats
+from machinesitter.statspusher import StatsPusher
+
+
+class FakeMonitor(object):
+
+    def __init__(self, port):
+        self.port = port
+
+
+class FakeHarness(object):
+
+    def __init__(self, port):
+        self.stats = FakeMachineStats(
+            {'uptime': 1},
+            {'web': {'name': 'web', 'running': False, 'monitoring': ''}},
+            hostname='sitter.example.com')
+        self.http_monitor = FakeMonitor(port)
+
+
+class FakeState(object):
+
+    def __init__(self, machine):
+        self.machine = machine
+        self.events = []
+        self.expedited = []
+
+    def find_machine(self, hostnames):
+        if self.machine.hostname in hostnames:
+            return self.machine
+
+    def has_machine(self, machine):
+        return machine is self.machine
+
+    def notify(self, event):
+        self.events.append(event)
+
+    def expedite_poll(self, machines=None):
+        self.expedited.extend(machines)
+
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while time.time() < end:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class TelemetryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.machine = MonitoredMachine(
+            MachineConfig('sitter.example.com', 'zone-a', 1, 1024))
+        self.machine.restore(40123, {})
+        self.state = FakeState(self.machine)
+        self.ingest = TelemetryIngest(self.state, 0, timeout=5)
+        self.ingest.start()
+        self.harness = FakeHarness(40123)
+        self.pusher = StatsPusher(self.harness, '127.0.0.1',
+                                  self.ingest.port)
+        self.pusher.interval = 0.01
+
+    def tearDown(self):
+        self.pusher.stop()
+        self.ingest.stop()
+        self.ingest.thread.join()
+
+    def test_push(self):
+        machine = self.machine
+        self.pusher.start()
+        self.assertTrue(wait_for(machine.has_loaded_data))
+        self.assertTrue(self.ingest.is_live(machine))
+        self.assertEqual(machine.get_tasks()['web']['running'], False)
+        self.assertEqual(len(self.state.events), 1)
+
+        # Changes are pushed as deltas and the state is told about them.
+        self.harness.stats.current['tasks']['web']['running'] = True
+        self.assertTrue(wait_for(
+            lambda: machine.get_tasks()['web']['running']))
+        self.assertEqual(self.state.events,
+                         ['telemetry sitter.example.com'] * 2)
+        self.assertEqual(self.ingest.get_stats()['live_machines'], 1)
+
+        # The machine is polled again once the pusher goes away.
+        self.pusher.stop()
+        self.assertTrue(wait_for(lambda: not self.ingest.is_live(machine)))
+        self.assertEqual(self.state.expedited, [machine])
+
+    def test_resync(self):
+        # Deltas which don't apply are answered with a resync, after which
+        # the full stats are sent again.
+        self.pusher.start()
+        self.assertTrue(wait_for(self.machine.has_loaded_data))
+        self.machine.datamanager.stats_version = -1
+        self.harness.stats.current['machine']['uptime'] = 2
+        self.assertTrue(wait_for(
+            lambda: self.machine.datamanager.metadata.get('uptime') == 2))
+        self.assertEqual(self.ingest.resyncs, 1)
+
+    def test_malformed_stats(self):
+        # Malformed stats are resynced without marking the machine sitter as
+        # not serving /stats_all.
+        self.pusher.start()
+        self.assertTrue(wait_for(self.machine.has_loaded_data))
+        connection = self.ingest.connections[self.machine]
+        self.ingest._handle_frame(
+            connection, '{"type": "stats", "stats": "garbage"}')
+        self.assertEqual(self.ingest.resyncs, 1)
+        self.assertEqual(self.machine.datamanager.stats_all, None)
+        self.assertEqual(self.machine.get_tasks()['web']['running'], False)
+
+    def test_unknown_port(self):
+        # Stats from a machine sitter the monitor doesn't know about are
+        # ignored.
+        self.harness.http_monitor.port = 40124
+        self.pusher.start()
+        self.assertTrue(wait_for(lambda: self.ingest.frames > 1))
+        self.assertFalse(self.ingest.is_live(self.machine))
+        self.assertFalse(self.machine.has_loaded_data())
+
+
+if __name__ == '__main__':
+    unittest.main()